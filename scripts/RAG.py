@@ -2,8 +2,12 @@ import json
 import time
 import openai
 from azure.search.documents import SearchClient
-from scripts.embeddings import get_embeddings_vector
-from scripts.env_setup import setup_clients
+from scripts.query_cache import get_query_embedding
+from scripts.env_setup import get_clients
+from scripts.search_fanout import fan_out_search
+from scripts.context_packer import pack_context
+from scripts.instrumentation import record_usage
+from scripts.resilience import get_resilient_caller, CircuitOpenError
 from scripts.vector_search import perform_vector_search
 from azure.search.documents.models import VectorizedQuery
 
@@ -30,13 +34,14 @@ def remove_doc_references(message_content):
 
 def format_output(response, query):
     """Formats the response into a more readable structure."""
-    # Parse response as JSON
-    response_dict = json.loads(response)
+    # The response object is already parsed, only the dict form of it is needed
+    response_dict = response.model_dump()
 
     # Extracting the relevant parts from the response
     message_content = response_dict["choices"][0]["message"]["content"]
     model = response_dict["model"]
     usage = response_dict["usage"]
+    record_usage(usage, model)
 
     # Remove the document references like [doc1], [doc2], etc.
     message_content = remove_doc_references(message_content)  # Remove [docX] references
@@ -59,15 +64,15 @@ def gpt_interpret_query(openai_client, user_query):
         max_tokens=150
     )
     '''
-    response = openai_client.chat.completions.create(
+    response = get_resilient_caller('chat').call(
+        openai_client.chat.completions.create,
         model='gpt-4o',
         messages=[
             {"role": "system", "content": "You are a helpful assistant for an AI learner."},
             {"role": "user", "content": user_query}
         ]
     )
-    # Parse response as JSON
-    response_dict = json.loads(response.json())
+    response_dict = response.model_dump()
 
     # Extracting the relevant parts from the response
     message_content = response_dict["choices"][0]["message"]["content"]
@@ -120,7 +125,7 @@ def RAG_ai_search():
         # Setup clients (pull from env_setup.py to use environment variables instead of hardcoding)
         # openai_client, search_client, search_index_client, embedding_model, search_index_name = setup_clients()
         (openai_client, search_customer_client, search_crm_client, search_index_client,
-         embedding_model, search_customer_index_name, search_crm_index_name, azure_search_service_admin_key) = setup_clients()
+         embedding_model, search_customer_index_name, search_crm_index_name, azure_search_service_admin_key) = get_clients()
 
         # Step 1: Interpret the query using GPT-4
         # interpretation = gpt_interpret_query(openai_client, user_query)
@@ -131,53 +136,39 @@ def RAG_ai_search():
         index_targets = classify_query(user_query, search_customer_index_name, search_crm_index_name)
 
         # Step 3: Fetch context from all relevant indexes
-        combined_context = []
+        # The query is embedded once per turn and shared by every index searched
+        query_embedding = get_query_embedding(user_query, openai_client, embedding_model)
+        vector_query = VectorizedQuery(vector=query_embedding, k_nearest_neighbors=50,
+                                       fields="vector")
+
+        # The target indexes are searched concurrently; one that fails or misses the deadline only drops its context
+        searches = {}
         for index_name in index_targets:
-            query_embedding = get_embeddings_vector(user_query, openai_client, embedding_model)
-            vector_query = VectorizedQuery(vector=query_embedding, k_nearest_neighbors=50,
-                                           fields="vector")
             if "customer" in index_name:
-                try:
-                    # Use the embedding to search for relevant documents in Azure AI Search
-                    # relevant_docs = perform_vector_search(openai_client, search_customer_client, vector_query)
-                    relevant_docs = search_customer_client.search(
-                        search_text=None,
-                        vector_queries=[vector_query],
-                        filter="CSU eq 'North'",
-                        select=["CustomerID", "Name", "Region", "Realm", "Clan", "Contact",
-                                "GeopoliticalIndex", "EconomicHealthIndex", "PreferredSeason",
-                                "TransportationCostUSD", "description", "CSU"],
-                    )
-                    if relevant_docs:
-                        combined_context.extend(relevant_docs)
-                    if not relevant_docs:
-                        print("No relevant documents found for the query.")
-                        return
-                except Exception as e:
-                    print(f"Error performing vector search: {e}")
-                    return
-
+                searches[index_name] = (search_customer_client, {
+                    'search_text': None,
+                    'vector_queries': [vector_query],
+                    'filter': "CSU eq 'North'",
+                    'select': ["CustomerID", "Name", "Region", "Realm", "Clan", "Contact",
+                               "GeopoliticalIndex", "EconomicHealthIndex", "PreferredSeason",
+                               "TransportationCostUSD", "description", "CSU"],
+                })
             elif "crm" in index_name:
-                try:
-                    # Use the embedding to search for relevant documents in Azure AI Search
-                    # relevant_docs = perform_vector_search(openai_client, search_crm_client, vector_query)
-                    relevant_docs = search_crm_client.search(
-                        search_text=None,
-                        vector_queries=[vector_query],
-                        filter="CSU eq 'North'",
-                        select=["OrderID", "CustomerID", "OfferID", "OrderDate", "DeliveryDate", "DeliveryFrom", "DeliveryTo",
-                                "Quantity", "PricePerUnitUSD", "TotalPriceUSD", "Mine", "MineLocation", "MineCapacity",
-                                "DemandIndex", "SupplyIndex", "Season", "GeopoliticalIndex", "TransportationCostUSD",
-                                "EconomicHealthIndex", "AdjustedPricePerUnitUSD", "description", "CSU"],
-                    )
-                    if relevant_docs:
-                        combined_context.extend(relevant_docs)
-                    if not relevant_docs:
-                        print("No relevant documents found for the query.")
-                        return
-                except Exception as e:
-                    print(f"Error performing vector search: {e}")
-                    return
+                searches[index_name] = (search_crm_client, {
+                    'search_text': None,
+                    'vector_queries': [vector_query],
+                    'filter': "CSU eq 'North'",
+                    'select': ["OrderID", "CustomerID", "OfferID", "OrderDate", "DeliveryDate", "DeliveryFrom", "DeliveryTo",
+                               "Quantity", "PricePerUnitUSD", "TotalPriceUSD", "Mine", "MineLocation", "MineCapacity",
+                               "DemandIndex", "SupplyIndex", "Season", "GeopoliticalIndex", "TransportationCostUSD",
+                               "EconomicHealthIndex", "AdjustedPricePerUnitUSD", "description", "CSU"],
+                })
+
+        search_results, search_errors = fan_out_search(searches)
+        for index_name, error in search_errors.items():
+            print(f"Error performing vector search on {index_name}, continuing without it: {error}")
+        # Best scoring results first, without duplicates, up to the context token budget
+        combined_context, context_tokens = pack_context([search_results[index_name] for index_name in searches])
 
         # Check if the combined context is empty
         if not combined_context:
@@ -190,85 +181,79 @@ def RAG_ai_search():
         combined_context_text = "\n".join([doc["description"] for doc in combined_context])
         history_text = "\n".join([f"Q: {pair['query']} R: {pair['response']}" for pair in query_history])
 
-        # Retry logic for calling OpenAI with the retrieved documents
-        max_retries = 3
-        retry_count = 0
-        while retry_count < max_retries:
-            try:
-                # Step 3: Pass the context and query to OpenAI for final answer generation
-                # print("Step 3: Pass the context and query to OpenAI for final answer generation")
-                #print("Context: ", combined_context)
-                response = openai_client.chat.completions.create(
-                    model='gpt-4o',
-                    messages=[
-                        {"role": "system", "content": "You are a helpful assistant for users, "
-                                                      "who want to understand the information related to the commodity "
-                                                      "called mithril, regarding its pricing, orders, offeres, customers, "
-                                                      "regions etc. use the indexes and context given to you to "
-                                                      "answer the questions. You are an expert at data analysis"},
-                        {"role": "user", "content": user_query},
-                        #{"role": "system",
-                        # "content": f"Here is some relevant information to help answer the query: {combined_context}"}
-                        {"role": "system", "content": f"Here is some relevant information to help answer the query; "
-                                                      f"Context: {combined_context_text}\nQuery History: {history_text}"}
-                    ],
-                    extra_body={  # This ensures the extra body for Azure Search is included
-                        "data_sources": [
-                            {
-                                "type": "azure_search",
-                                "parameters": {
-                                    "endpoint": search_crm_client._endpoint,
-                                    # This pulls from the SearchClient using env vars
-                                    "index_name": search_crm_index_name,
-                                    # Use the index from the environment variables
-                                    "authentication": {
-                                        "type": "api_key",
-                                        "key": azure_search_service_admin_key
-                                    }
+        # Retryable errors (throttling, timeouts, server errors) are retried with exponential backoff and jitter,
+        # the others are reported at once (see resilience.py)
+        try:
+            # Step 3: Pass the context and query to OpenAI for final answer generation
+            # print("Step 3: Pass the context and query to OpenAI for final answer generation")
+            #print("Context: ", combined_context)
+            response = get_resilient_caller('chat').call(
+                openai_client.chat.completions.create,
+                model='gpt-4o',
+                messages=[
+                    {"role": "system", "content": "You are a helpful assistant for users, "
+                                                  "who want to understand the information related to the commodity "
+                                                  "called mithril, regarding its pricing, orders, offeres, customers, "
+                                                  "regions etc. use the indexes and context given to you to "
+                                                  "answer the questions. You are an expert at data analysis"},
+                    {"role": "user", "content": user_query},
+                    #{"role": "system",
+                    # "content": f"Here is some relevant information to help answer the query: {combined_context}"}
+                    {"role": "system", "content": f"Here is some relevant information to help answer the query; "
+                                                  f"Context: {combined_context_text}\nQuery History: {history_text}"}
+                ],
+                extra_body={  # This ensures the extra body for Azure Search is included
+                    "data_sources": [
+                        {
+                            "type": "azure_search",
+                            "parameters": {
+                                "endpoint": search_crm_client._endpoint,
+                                # This pulls from the SearchClient using env vars
+                                "index_name": search_crm_index_name,
+                                # Use the index from the environment variables
+                                "authentication": {
+                                    "type": "api_key",
+                                    "key": azure_search_service_admin_key
                                 }
                             }
-                        ]
-                    }
-                )
+                        }
+                    ]
+                }
+            )
 
-                # Format and display the output
-                message_content, model, usage = format_output(response.json(), user_query)  # Parsing response as JSON
+            # Format and display the output
+            message_content, model, usage = format_output(response, user_query)
 
-                user_query = '' # reset the user query
+            user_query = '' # reset the user query
 
-                # Print the formatted output
-                print("Response:")
-                print(message_content)
+            # Print the formatted output
+            print("Response:")
+            print(message_content)
 
-                '''
-                citations = response_dict["choices"][0]["message"].get("context", {}).get("citations", [])
-                formatted_citations = "\n".join([f"- {citation['content']}" for citation in citations])
+            '''
+            citations = response_dict["choices"][0]["message"].get("context", {}).get("citations", [])
+            formatted_citations = "\n".join([f"- {citation['content']}" for citation in citations])
 
-                print("\nCitations:")
-                print(formatted_citations if formatted_citations else "No citations available.")
-                '''
+            print("\nCitations:")
+            print(formatted_citations if formatted_citations else "No citations available.")
+            '''
 
-                print("\nModel:", model)
-                print("\nUsage:")
-                print(f"- Completion Tokens: {usage['completion_tokens']}")
-                print(f"- Prompt Tokens: {usage['prompt_tokens']}")
-                print(f"- Total Tokens: {usage['total_tokens']}")
+            print("\nModel:", model)
+            print("\nUsage:")
+            print(f"- Completion Tokens: {usage['completion_tokens']}")
+            print(f"- Prompt Tokens: {usage['prompt_tokens']}")
+            print(f"- Total Tokens: {usage['total_tokens']}")
 
 
-                # user_query = input("\nYou can ask another question or type 'exit' to quit: ").strip()
+            # user_query = input("\nYou can ask another question or type 'exit' to quit: ").strip()
 
-                # print("\nYou can ask another question or type 'exit' to quit.")
-                # Return or print the response
-                # return
+            # print("\nYou can ask another question or type 'exit' to quit.")
+            # Return or print the response
+            # return
 
-            except openai.OpenAIError as e:
-                retry_count += 1
-                print(f"OpenAI error occurred: {e}. Retrying in 10 seconds... ({retry_count}/{max_retries})")
-                time.sleep(10)  # Wait for 10 seconds before retrying
+        except (openai.OpenAIError, CircuitOpenError) as e:
+            print(f"OpenAI error occurred: {e}")
 
-                if retry_count >= max_retries:
-                    print("Max retries exceeded. Exiting...")
-                    break
 
 if __name__ == '__main__':
     RAG_ai_search()
@@ -1,14 +1,23 @@
 import json
+import os
 import time
 import openai
 from azure.search.documents import SearchClient
-from scripts.embeddings import get_embeddings_vector
-from scripts.env_setup import setup_clients
+from scripts.query_cache import get_query_embedding
+from scripts.env_setup import get_clients
+from scripts.search_fanout import fan_out_search
+from scripts.context_packer import pack_context, CONTEXT_MAX_TOKENS
+from scripts.answer_stream import stream_answer, write_to_terminal
+from scripts.answer_cache import get_default_answer_cache
+from scripts.conversation_memory import ConversationMemory
+from scripts.analytics import AnalyticsEngine, answer_analytics_query
+from scripts.resilience import get_resilient_caller, CircuitOpenError
+from scripts.instrumentation import get_default_metrics, record_usage, write_metrics_file
+from scripts.tokenizer import num_tokens_from_string
+from scripts.materialized_aggregates import get_default_aggregates, aggregate_context
 from scripts.vector_search import perform_vector_search
 from azure.search.documents.models import VectorizedQuery
 
-query_history = []
-
 def filter_context(relevant_docs):
     """Filters redundant or non-informative sections from relevant documents."""
     context = []
@@ -25,19 +34,210 @@ def remove_doc_references(message_content):
     cleaned_content = re.sub(r"\[doc\d+\]", "", message_content)
     return cleaned_content
 
-def format_output(response, query):
+def count_documents(results, index_name, metrics):
+    """Passes the search results through, counting the ones read into rag_documents_retrieved_total."""
+    for document in results:
+        metrics.increment('rag_documents_retrieved_total', index=index_name)
+        yield document
+
+def format_output(response):
     """Format the response into a more readable structure."""
-    response_dict = json.loads(response)
-    message_content = response_dict["choices"][0]["message"]["content"]
-    model = response_dict["model"]
-    usage = response_dict["usage"]
+    message_content = response.choices[0].message.content
+    model = response.model
+    usage = response.usage.model_dump()
+    record_usage(usage, model)
 
     message_content = remove_doc_references(message_content)
-    query_history.append({"query": query, "response": message_content})
 
     return message_content, model, usage
 
-def RAG_ai_search(csu_name='East'):
+class QueryPipeline:
+    """
+    The answering flow of one question, over clients and caches shared by every session: the answer cache,
+    the analytics engine, the concurrent search of both indexes with the packed context and the precomputed
+    aggregates, then the generation. It holds no per-session state and can serve concurrent sessions from
+    several threads; each session passes its own ConversationMemory.
+    """
+
+    def __init__(self, clients=None, model='gpt-4o'):
+        # The clients are created once per process and keep their connections warm between queries
+        (self.openai_client, self.search_customer_client, self.search_crm_client, _, self.embedding_model,
+         self.search_customer_index_name, self.search_crm_index_name, _) = clients or get_clients()
+        self.model = model
+        self.answer_cache = get_default_answer_cache()
+        # Exact aggregates over the full CRM and customer tables
+        self.analytics_engine = AnalyticsEngine()
+
+    def new_memory(self):
+        """History of a new session, sent with each question at a bounded size."""
+        return ConversationMemory(self.openai_client, model=self.model)
+
+    def generate(self, messages, on_text=None):
+        """
+        The answer to chat messages, streamed to on_text as it is generated when given.
+        Retryable errors are retried with backoff (see resilience.py), unless part of the answer was already sent.
+        """
+        sent = []
+
+        def send(text):
+            sent.append(True)
+            on_text(text)
+
+        def create():
+            if on_text is not None:
+                return stream_answer(self.openai_client, messages, model=self.model, on_text=send)[0]
+            response = self.openai_client.chat.completions.create(model=self.model, messages=messages)
+            return format_output(response)[0]
+
+        return get_resilient_caller('chat').call(create, retry_if=lambda error: not sent)
+
+    def answer(self, user_query, csu_name, memory, on_text=None):
+        """
+        Answers a question of a session, within a CSU. Returns a dict with the 'answer' (None when nothing
+        relevant was found or the generation failed), its 'source' ('cache', 'analytics', 'search',
+        'no_context' or 'error'), the 'seconds' it took and the 'timings' of its stages. With on_text, the
+        answer is passed to it as it is generated, without the [docN] references.
+        The stages, documents and tokens are also recorded in the process metrics (see instrumentation.py).
+        """
+        started = time.perf_counter()
+        metrics = get_default_metrics()
+        timings = {}
+
+        def result(answer, source):
+            seconds = time.perf_counter() - started
+            metrics.observe('rag_request_seconds', seconds, source=source)
+            return {'answer': answer, 'source': source, 'seconds': seconds, 'timings': timings}
+
+        # The query is embedded once per turn and shared by every index searched
+        with metrics.span('embed', timings):
+            query_embedding = get_query_embedding(user_query, self.openai_client, self.embedding_model)
+
+        # A near-duplicate of an earlier question for the same CSU gets its answer without searching or generating.
+        # Only opening questions are cached: a follow-up depends on the history of its session, which the cache
+        # key does not hold
+        history_text = memory.render()
+        cacheable = not history_text
+        cached_answer = None
+        if cacheable:
+            with metrics.span('answer_cache', timings):
+                cached_answer = self.answer_cache.lookup(query_embedding, scope=csu_name, question=user_query)
+        if cached_answer is not None:
+            if on_text is not None:
+                on_text(cached_answer)
+            memory.add_turn(user_query, cached_answer)
+            return result(cached_answer, 'cache')
+
+        # Aggregate questions are computed over all rows by the analytics engine, the model only narrates the result
+        narrated = []
+
+        def narrate_text(text):
+            narrated.append(True)
+            on_text(text)
+
+        try:
+            with metrics.span('analytics', timings):
+                analytics_answer = answer_analytics_query(
+                    self.openai_client, user_query, self.analytics_engine, csu_name=csu_name, model=self.model,
+                    history_text=history_text,
+                    narrate=lambda messages: self.generate(messages, narrate_text if on_text is not None else None))
+        except (openai.OpenAIError, CircuitOpenError) as e:
+            if narrated:
+                # Part of the narration was already shown, a search answer can not follow it
+                print(f"OpenAI error occurred while narrating the analytics result: {e}")
+                return result(None, 'error')
+            print(f"OpenAI error occurred while answering from the analytics engine, falling back to search: {e}")
+            analytics_answer = None
+        if analytics_answer is not None:
+            memory.add_turn(user_query, analytics_answer)
+            if cacheable:
+                self.answer_cache.store(query_embedding, analytics_answer, scope=csu_name, question=user_query)
+            return result(analytics_answer, 'analytics')
+
+        vector_query = VectorizedQuery(vector=query_embedding, k_nearest_neighbors=100, fields="vector")
+
+        # Both indexes are searched concurrently; one that fails or misses the deadline only drops its context
+        searches = {
+            self.search_customer_index_name: (self.search_customer_client, {
+                'search_text': None,
+                'vector_queries': [vector_query],
+                'filter': f"CSU eq '{csu_name}'",
+                'select': ["CustomerID", "Name", "Region", "Realm", "Clan", "Contact",
+                           "GeopoliticalIndex", "EconomicHealthIndex", "PreferredSeason",
+                           "TransportationCostUSD", "description", "CSU"]
+            }),
+            self.search_crm_index_name: (self.search_crm_client, {
+                'search_text': None,
+                'vector_queries': [vector_query],
+                'filter': f"CSU eq '{csu_name}'",
+                'select': ["OrderID", "CustomerID", "OfferID", "OrderDate", "DeliveryDate", "DeliveryFrom",
+                           "DeliveryTo",
+                           "Quantity", "PricePerUnitUSD", "TotalPriceUSD", "Mine", "MineLocation", "MineCapacity",
+                           "DemandIndex", "SupplyIndex", "Season", "GeopoliticalIndex", "TransportationCostUSD",
+                           "EconomicHealthIndex", "AdjustedPricePerUnitUSD", "description", "CSU"]
+            }),
+        }
+        with metrics.span('search', timings):
+            search_results, search_errors = fan_out_search(searches)
+        for index_name, error in search_errors.items():
+            metrics.increment('rag_search_errors_total', index=index_name)
+            print(f"Error performing vector search on {index_name}, continuing without it: {error}")
+        # Exact figures of the CSU maintained at ingestion, so aggregates do not depend on the rows retrieved. Only
+        # for questions naming a dimension or measure, and within the same token budget as the documents
+        context_budget = int(os.getenv('CONTEXT_MAX_TOKENS', CONTEXT_MAX_TOKENS))
+        with metrics.span('aggregates', timings):
+            aggregates_text = aggregate_context(get_default_aggregates(), csu_name, user_query,
+                                                max_tokens=context_budget)
+            aggregates_tokens = num_tokens_from_string(aggregates_text) if aggregates_text else 0
+
+        # Best scoring results first, without duplicates, up to what is left of the context token budget
+        with metrics.span('pack_context', timings):
+            combined_context, context_tokens = pack_context(
+                [count_documents(search_results[index_name], index_name, metrics) for index_name in searches],
+                max_tokens=context_budget - aggregates_tokens)
+        metrics.increment('rag_context_documents_total', len(combined_context))
+        metrics.increment('rag_context_tokens_total', context_tokens + aggregates_tokens)
+
+        # If no documents found, skip GPT
+        if not combined_context and not aggregates_text:
+            return result(None, 'no_context')
+
+        # Prepare context for GPT-4
+        combined_context_text = "\n".join([doc["description"] for doc in combined_context])
+
+        messages = [
+            {"role": "system", "content": "You are an AI assistant. The user has provided an input."
+                                          "Identify whether is a question or an appreciation of something else"
+                                          "and respond appropriately. Please leverage the context provided to you"
+                                          "to answer the user's questions"},
+            {"role": "user", "content": user_query},
+            {"role": "system", "content": f" Use the context provided to you. "
+                                          f"Here is the context: "
+                                          f"{combined_context_text}\nPrecomputed aggregates: {aggregates_text}"
+                                          f"\nQuery History: {history_text}"}
+        ]
+
+        try:
+            with metrics.span('generate', timings):
+                message_content = self.generate(messages, on_text)
+        except (openai.OpenAIError, CircuitOpenError) as e:
+            print(f"OpenAI error occurred: {e}")
+            return result(None, 'error')
+        memory.add_turn(user_query, message_content)
+        if cacheable:
+            self.answer_cache.store(query_embedding, message_content, scope=csu_name, question=user_query)
+        return result(message_content, 'search')
+
+
+def RAG_ai_search(csu_name='East', stream=True):
+
+    pipeline = QueryPipeline()
+    memory = pipeline.new_memory()
+
+    def write_response(text):
+        if not printed:
+            print("\nResponse:")
+            printed.append(True)
+        write_to_terminal(text)
 
     # This loop continues until the user explicitly types "exit"
     while True:
@@ -45,6 +245,9 @@ def RAG_ai_search(csu_name='East'):
 
         if user_query.lower() == 'exit':
             print("Exiting session. Goodbye!")
+            memory.close()
+            # Stage latencies and token counts of the session, when METRICS_JSONL_PATH is set
+            write_metrics_file()
             break
 
         # Check if the user input is empty and wait for a valid query.
@@ -52,93 +255,18 @@ def RAG_ai_search(csu_name='East'):
             print("No query provided. Please enter a query.")
             continue  # Skip GPT and go back to input loop until valid input
 
-        # Setup clients
-        (openai_client, search_customer_client, search_crm_client, search_index_client,
-         embedding_model, search_customer_index_name, search_crm_index_name, azure_search_service_admin_key) = setup_clients()
-
-        # Step 1: Interpret the query using GPT-4 (if needed, not mandatory here)
-
-        # Step 2: Fetch documents based on the query
-        combined_context = []
-        for index_name in [search_customer_index_name, search_crm_index_name]:
-            query_embedding = get_embeddings_vector(user_query, openai_client, embedding_model)
-            vector_query = VectorizedQuery(vector=query_embedding, k_nearest_neighbors=100, fields="vector")
-
-            try:
-                if "customer" in index_name:
-                    relevant_docs = search_customer_client.search(
-                        search_text=None,
-                        vector_queries=[vector_query],
-                        filter=f"CSU eq '{csu_name}'",
-                        select=["CustomerID", "Name", "Region", "Realm", "Clan", "Contact",
-                                "GeopoliticalIndex", "EconomicHealthIndex", "PreferredSeason",
-                                "TransportationCostUSD", "description", "CSU"]
-                    )
-                else:
-                    relevant_docs = search_crm_client.search(
-                        search_text=None,
-                        vector_queries=[vector_query],
-                        filter=f"CSU eq '{csu_name}'",
-                        select=["OrderID", "CustomerID", "OfferID", "OrderDate", "DeliveryDate", "DeliveryFrom",
-                                "DeliveryTo",
-                                "Quantity", "PricePerUnitUSD", "TotalPriceUSD", "Mine", "MineLocation", "MineCapacity",
-                                "DemandIndex", "SupplyIndex", "Season", "GeopoliticalIndex", "TransportationCostUSD",
-                                "EconomicHealthIndex", "AdjustedPricePerUnitUSD", "description", "CSU"]
-                    )
-
-                if relevant_docs:
-                    combined_context.extend(relevant_docs)
-            except Exception as e:
-                print(f"Error performing vector search: {e}")
-                return
-
-        # Step 3: If no documents found, inform user and skip GPT
-        if not combined_context:
+        # The answer is printed as it is generated, without the [docN] references
+        printed = []
+        result = pipeline.answer(user_query, csu_name, memory, on_text=write_response if stream else None)
+        if result['source'] == 'no_context':
             print("No relevant documents found for the given query. Please try again.")
-            continue  # Go back to user input prompt
-
-        #print(f"Retrieved {len(combined_context)} documents")
-
-        # Step 4: Prepare context for GPT-4
-        combined_context_text = "\n".join([doc["description"] for doc in combined_context])
-        history_text = "\n".join([f"Q: {pair['query']} R: {pair['response']}" for pair in query_history])
-        #print("\nCombined context:", combined_context_text)
-        #print("\nQuery History:", history_text)
-
-        # Retry logic for calling GPT with documents
-        for attempt in range(3):
-            try:
-                response = openai_client.chat.completions.create(
-                    model='gpt-4o',
-                    messages=[
-                        {"role": "system", "content": "You are an AI assistant. The user has provided an input."
-                                                      "Identify whether is a question or an appreciation of something else"
-                                                      "and respond appropriately. Please leverage the context provided to you"
-                                                      "to answer the user's questions"},
-                        {"role": "user", "content": user_query},
-                        {"role": "system", "content": f" Use the context provided to you. "
-                                                      f"Here is the context: "
-                                                      f"{combined_context_text}\nQuery History: {history_text}"}
-                    ]
-                )
-
-                message_content, model, usage = format_output(response.json(), user_query)
-
-                # Print final response
+        elif result['answer'] is not None:
+            if stream:
+                print()
+            else:
                 print("\nResponse:")
-                print(message_content)
-
-                # Show model usage details
-                #print("\nModel:", model)
-                #print(f"Total tokens: {usage['total_tokens']}")
-
-                break  # Exit retry loop on success
-            except openai.OpenAIError as e:
-                print(f"OpenAI error occurred: {e}. Retrying in 10 seconds...")
-                time.sleep(10)  # Wait before retrying
-
-        # After response, reset user query and wait for another one
-        user_query = ''  # Ensure it's cleared before next loop
+                print(result['answer'])
+        #print(f"Answered from {result['source']} in {result['seconds']:.2f}s: {result['timings']}")
 
 if __name__ == '__main__':
     RAG_ai_search()
@@ -0,0 +1,267 @@
+import json
+import os
+import re
+import threading
+import pandas as pd
+from scripts.table_reader import iter_table_rows
+from scripts.file_chunking_dynamic import cast_columns
+from scripts.resilience import get_resilient_caller
+
+# Tables of the analytics engine and the data directory each one is loaded from
+ANALYTICS_TABLES = {
+    'crm': os.path.join('data', 'crm'),
+    'customers': os.path.join('data', 'customers'),
+}
+# Largest result table sent to the model for narration
+ANALYTICS_MAX_RESULT_ROWS = 50
+
+AGGREGATIONS = {'mean', 'sum', 'min', 'max', 'count', 'median', 'std', 'nunique'}
+FILTER_OPERATORS = {'eq', 'ne', 'gt', 'ge', 'lt', 'le', 'in'}
+
+# Questions that ask for figures over many rows rather than for specific records. "per" and "by" alone are in
+# most pricing questions ("price per unit", "delivered by"), so they only count before a dimension of the tables
+AGGREGATE_QUESTION_PATTERN = re.compile(
+    r"\b(average|avg|mean|total|sum|count|how many|number of|median|max(imum)?|min(imum)?|highest|lowest|"
+    r"top \d+|breakdown|trend|distribution|"
+    r"(per|by|for each) (csu|mine|location|season|region|realm|clan|customer|lane|route|month|quarter|year)s?)\b",
+    re.IGNORECASE)
+
+PLAN_PROMPT = """You translate questions about Mithril orders and customers into a JSON query plan over these tables:
+{schema}
+
+Answer with a JSON object only, in this form:
+{{"analytics": true,
+ "table": "crm" or "customers",
+ "join_customers": true to add the customer columns to crm rows (joined on CustomerID),
+ "filters": [{{"column": ..., "op": "eq|ne|gt|ge|lt|le|in", "value": ...}}],
+ "group_by": [column, ...],
+ "metrics": [{{"column": ..., "agg": "mean|sum|min|max|count|median|std|nunique"}}],
+ "order_by": {{"column": metric as "<agg>_<column>" or group column, "descending": true}},
+ "limit": number of rows}}
+If the question is not about aggregates over the data (counts, averages, totals, rankings...), answer {{"analytics": false}}."""
+
+NARRATION_PROMPT = ("You are an expert at Mithril pricing data analysis. Answer the user's question from the result "
+                    "table, computed exactly over all the matching rows. Quote the figures, do not invent any.")
+
+
+def validate_plan(plan):
+    """Checks the shape of a query plan written by the model, raising ValueError when it is malformed."""
+    if not isinstance(plan, dict):
+        raise ValueError("The query plan must be a JSON object")
+    if not isinstance(plan.get('table', 'crm'), str):
+        raise ValueError("table must be a table name")
+    for key in ('filters', 'metrics'):
+        clauses = plan.get(key) or []
+        if not isinstance(clauses, list) or not all(isinstance(clause, dict) and isinstance(clause.get('column'), str)
+                                                    for clause in clauses):
+            raise ValueError(f"{key} must be a list of objects with a column")
+    group_by = plan.get('group_by') or []
+    if not isinstance(group_by, list) or not all(isinstance(name, str) for name in group_by):
+        raise ValueError("group_by must be a list of column names")
+    if plan.get('order_by') and not isinstance(plan['order_by'], dict):
+        raise ValueError("order_by must be an object with a column")
+
+
+def is_aggregate_question(question):
+    """Cheap check that a question may be an aggregate one, before asking the model for a plan."""
+    return bool(AGGREGATE_QUESTION_PATTERN.search(question))
+
+
+def infer_field_types(columns):
+    """Index-style field types of raw string columns: numeric when every non-empty value parses as a number."""
+    field_types = {}
+    for column_name, values in columns.items():
+        numbers = pd.to_numeric(pd.Series(values), errors='coerce')
+        present = pd.Series(values).astype(str).str.strip() != ''
+        if present.any() and numbers[present].notna().all():
+            field_types[column_name] = "Edm.Int32" if (numbers[present] % 1 == 0).all() else "Edm.Double"
+        else:
+            field_types[column_name] = "Edm.String"
+    return field_types
+
+
+def load_table(directory):
+    """Reads every markdown table of a directory into one DataFrame with typed columns."""
+    rows = []
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith('.md'):
+            with open(os.path.join(directory, filename), 'rb') as file:
+                rows.extend(fields for _, fields in iter_table_rows(file))
+
+    columns = pd.DataFrame(rows, dtype=object)
+    frame, _ = cast_columns(columns, infer_field_types(columns))
+    return frame
+
+
+class AnalyticsEngine:
+    """
+    In-memory columnar engine over the CRM and customer tables, answering query plans (filters, group-by and
+    aggregates) exactly over all rows with pandas. Tables are loaded on first use and reloaded when their
+    files change.
+    """
+
+    def __init__(self, tables=None, project_root=None):
+        project_root = project_root or os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+        self.directories = {name: os.path.join(project_root, directory)
+                            for name, directory in (tables or ANALYTICS_TABLES).items()}
+        self.frames = {}
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def _version(self, directory):
+        return tuple(sorted((entry.name, entry.stat().st_mtime_ns) for entry in os.scandir(directory)
+                            if entry.name.endswith('.md')))
+
+    def table(self, name):
+        if name not in self.directories:
+            raise ValueError(f"Unknown table: {name}")
+        with self.lock:
+            version = self._version(self.directories[name])
+            if self.versions.get(name) != version:
+                self.frames[name] = load_table(self.directories[name])
+                self.versions[name] = version
+            return self.frames[name]
+
+    def describe(self):
+        """Schema of the tables for the planning prompt: column types and the values of categorical columns."""
+        lines = []
+        for name in self.directories:
+            frame = self.table(name)
+            columns = []
+            for column_name in frame.columns:
+                column = frame[column_name]
+                if pd.api.types.is_numeric_dtype(column):
+                    columns.append(f"{column_name} (number)")
+                elif column.nunique() <= 20:
+                    values = ', '.join(sorted(str(value) for value in column.dropna().unique()))
+                    columns.append(f"{column_name} (one of: {values})")
+                else:
+                    columns.append(f"{column_name} (text)")
+            lines.append(f"{name}: {'; '.join(columns)}")
+        return "\n".join(lines)
+
+    def _frame_for(self, plan):
+        frame = self.table(plan.get('table', 'crm'))
+        if plan.get('join_customers') and plan.get('table', 'crm') == 'crm':
+            # Some CustomerIDs appear more than once in the customer table; the first row is used so that
+            # the join does not duplicate orders
+            customers = self.table('customers').drop_duplicates('CustomerID')
+            # Columns both tables have (e.g. CSU, GeopoliticalIndex) keep the order's value
+            extra = [column for column in customers.columns if column not in frame.columns]
+            frame = frame.merge(customers[['CustomerID'] + extra], on='CustomerID', how='left')
+        return frame
+
+    def run(self, plan, csu_name=None):
+        """
+        Runs a query plan (see PLAN_PROMPT) and returns the result as a DataFrame of at most
+        ANALYTICS_MAX_RESULT_ROWS rows. csu_name, when given, restricts the rows to that CSU whatever the plan says.
+        Raises ValueError when the plan is malformed or names unknown tables, columns or operations.
+        """
+        validate_plan(plan)
+        frame = self._frame_for(plan)
+
+        def column(name):
+            if name not in frame.columns:
+                raise ValueError(f"Unknown column: {name}")
+            return frame[name]
+
+        mask = pd.Series(True, index=frame.index)
+        filters = list(plan.get('filters') or [])
+        if csu_name is not None:
+            filters.append({'column': 'CSU', 'op': 'eq', 'value': csu_name})
+        for clause in filters:
+            values, operator, value = column(clause['column']), clause.get('op', 'eq'), clause.get('value')
+            if operator not in FILTER_OPERATORS:
+                raise ValueError(f"Unsupported filter operator: {operator}")
+            if operator == 'in':
+                mask &= values.isin(value if isinstance(value, list) else [value])
+            elif operator == 'eq':
+                mask &= values == value
+            elif operator == 'ne':
+                mask &= values != value
+            elif operator == 'gt':
+                mask &= values > value
+            elif operator == 'ge':
+                mask &= values >= value
+            elif operator == 'lt':
+                mask &= values < value
+            else:
+                mask &= values <= value
+        frame = frame[mask.fillna(False).astype(bool)]
+
+        metrics = plan.get('metrics') or [{'column': frame.columns[0], 'agg': 'count'}]
+        # The number of rows behind each result row is always reported
+        aggregations = {'rows': (frame.columns[0], 'size')}
+        for metric in metrics:
+            column(metric['column'])
+            if metric.get('agg') not in AGGREGATIONS:
+                raise ValueError(f"Unsupported aggregation: {metric.get('agg')}")
+            aggregations[f"{metric['agg']}_{metric['column']}"] = (metric['column'], metric['agg'])
+
+        group_by = plan.get('group_by') or []
+        for name in group_by:
+            column(name)
+        if group_by:
+            result = frame.groupby(group_by, dropna=False).agg(**aggregations).reset_index()
+        else:
+            result = pd.DataFrame({name: [frame[source].agg(agg)] for name, (source, agg) in aggregations.items()})
+
+        order_by = plan.get('order_by')
+        if order_by and order_by.get('column') in result.columns:
+            result = result.sort_values(order_by['column'], ascending=not order_by.get('descending', True))
+        limit = min(int(plan.get('limit') or ANALYTICS_MAX_RESULT_ROWS), ANALYTICS_MAX_RESULT_ROWS)
+        return result.head(limit).reset_index(drop=True)
+
+
+def plan_query(openai_client, question, engine, model='gpt-4o'):
+    """Asks the model for the query plan of a question; returns None when it is not an analytics question."""
+    response = get_resilient_caller('chat').call(
+        openai_client.chat.completions.create,
+        model=model,
+        response_format={"type": "json_object"},
+        temperature=0,
+        messages=[
+            {"role": "system", "content": PLAN_PROMPT.format(schema=engine.describe())},
+            {"role": "user", "content": question}
+        ]
+    )
+    plan = json.loads(response.choices[0].message.content)
+    return plan if isinstance(plan, dict) and plan.get('analytics') else None
+
+
+def answer_analytics_query(openai_client, question, engine, csu_name=None, model='gpt-4o', history_text='',
+                           narrate=None):
+    """
+    Answers an aggregate question from the full tables: the model writes a query plan, the engine computes the
+    (small) result table, and the model only narrates that table.
+    Returns the answer, or None when the question is not an analytics one or its plan cannot be run, so the
+    caller can fall back to retrieval. narrate, when given, generates the answer from the chat messages
+    (e.g. streaming it); otherwise a plain completion is used.
+    """
+    if not is_aggregate_question(question):
+        return None
+    try:
+        plan = plan_query(openai_client, question, engine, model=model)
+        if plan is None:
+            return None
+        result = engine.run(plan, csu_name=csu_name)
+    except (ValueError, KeyError, TypeError) as e:
+        print(f"Analytics plan could not be run, falling back to search: {e}")
+        return None
+
+    messages = [
+        {"role": "system", "content": NARRATION_PROMPT},
+        {"role": "user", "content": question},
+        {"role": "system", "content": f"Result table ({'CSU ' + csu_name if csu_name else 'all CSUs'}):\n"
+                                      f"{result.to_string(index=False)}\nQuery History: {history_text}"}
+    ]
+    if narrate is not None:
+        return narrate(messages)
+    response = get_resilient_caller('chat').call(openai_client.chat.completions.create, model=model, messages=messages)
+    return response.choices[0].message.content
+
+# Example usage:
+# engine = AnalyticsEngine()
+# print(engine.run({"table": "crm", "filters": [{"column": "Season", "op": "eq", "value": "Winter"}],
+#                   "group_by": ["Mine"], "metrics": [{"column": "AdjustedPricePerUnitUSD", "agg": "mean"}]},
+#                  csu_name='East'))
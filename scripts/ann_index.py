@@ -0,0 +1,239 @@
+import json
+import os
+import numpy as np
+
+ANN_DIRECTORY_NAME = 'ann'
+DEFAULT_NPROBE = 8
+# Share of the index living in the insert segment above which add() folds it into the main segment
+COMPACT_RATIO = 0.1
+
+
+def encode_ids(ids):
+    """
+    Document ids as an array of UTF-8 byte strings, so it can be memory-mapped like the vectors. The width is
+    that of the longest id, so no id is truncated; arrays of different widths compare and concatenate as is.
+    """
+    encoded = [str(document_id).encode('utf-8') for document_id in ids]
+    return np.array(encoded, dtype=f"S{max([len(value) for value in encoded] + [1])}")
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def assign_lists(vectors, centroids, block_size=65536):
+    """Nearest centroid (by cosine similarity) of each vector, computed block by block to bound memory."""
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), block_size):
+        block = normalize(vectors[start:start + block_size])
+        assignments[start:start + block_size] = np.argmax(block @ centroids.T, axis=1)
+    return assignments
+
+
+def train_centroids(vectors, nlist, iterations=10, sample_size=None, seed=0):
+    """Spherical k-means on a sample of the vectors, returning nlist unit-length centroids."""
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), sample_size or max(256 * nlist, 10000))
+    sample = normalize(vectors[np.sort(rng.choice(len(vectors), size=sample_size, replace=False))])
+    centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        counts = np.bincount(assignments, minlength=nlist)
+        # Empty lists are restarted on a random sample vector
+        empty = counts == 0
+        sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()))]
+        centroids = normalize(sums)
+
+    return centroids
+
+
+class IVFIndex:
+    """
+    Inverted-file (IVF-Flat) approximate nearest neighbour index over cosine similarity.
+    The vectors are clustered around nlist centroids and stored grouped by cluster, so a query only scores the
+    vectors of its nprobe closest clusters. Vectors added after the build go to a small insert segment that is
+    searched alongside the main one and merged into it by compact(), without retraining the centroids.
+    Removed ids are tombstoned until the next compaction.
+    """
+
+    def __init__(self, centroids, vectors, ids, list_offsets, alive=None,
+                 delta_vectors=None, delta_ids=None, delta_lists=None, delta_alive=None):
+        self.centroids = centroids
+        self.vectors = vectors
+        self.ids = ids
+        self.list_offsets = list_offsets
+        self.alive = alive if alive is not None else np.ones(len(ids), dtype=bool)
+        dimensions = centroids.shape[1]
+        self.delta_vectors = delta_vectors if delta_vectors is not None else np.empty((0, dimensions), np.float32)
+        self.delta_ids = delta_ids if delta_ids is not None else np.empty(0, 'S1')
+        self.delta_lists = delta_lists if delta_lists is not None else np.empty(0, np.int32)
+        self.delta_alive = delta_alive if delta_alive is not None else np.ones(len(self.delta_ids), dtype=bool)
+
+    @property
+    def nlist(self):
+        return self.centroids.shape[0]
+
+    def __len__(self):
+        return int(self.alive.sum() + self.delta_alive.sum())
+
+    @classmethod
+    def build(cls, vectors, ids, nlist=None, iterations=10, seed=0):
+        """Trains the centroids on the vectors and lays the vectors out grouped by cluster."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        nlist = nlist or max(1, min(len(vectors), int(4 * np.sqrt(len(vectors)))))
+        centroids = train_centroids(vectors, nlist, iterations=iterations, seed=seed)
+        return cls._from_assignments(centroids, vectors, encode_ids(ids),
+                                     assign_lists(vectors, centroids))
+
+    @classmethod
+    def _from_assignments(cls, centroids, vectors, ids, assignments):
+        order = np.argsort(assignments, kind='stable')
+        counts = np.bincount(assignments, minlength=len(centroids))
+        list_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        return cls(centroids, normalize(vectors[order]), ids[order], list_offsets)
+
+    def add(self, vectors, ids):
+        """Inserts vectors into the insert segment, compacting it once it grows past COMPACT_RATIO of the index."""
+        vectors = normalize(vectors)
+        if not len(vectors):
+            return
+        self.delta_vectors = np.concatenate([self.delta_vectors, vectors])
+        self.delta_ids = np.concatenate([self.delta_ids, encode_ids(ids)])
+        self.delta_lists = np.concatenate([self.delta_lists, assign_lists(vectors, self.centroids)])
+        self.delta_alive = np.concatenate([self.delta_alive, np.ones(len(vectors), dtype=bool)])
+
+        if len(self.delta_ids) > COMPACT_RATIO * max(len(self.ids), 1):
+            self.compact()
+
+    def remove(self, ids):
+        """Tombstones the given ids, in both segments."""
+        ids = encode_ids(ids)
+        if not len(ids):
+            return
+        self.alive = np.array(self.alive) & ~np.isin(self.ids, ids)
+        self.delta_alive &= ~np.isin(self.delta_ids, ids)
+
+    def compact(self):
+        """Merges the insert segment into the main one and drops tombstoned vectors, keeping the centroids."""
+        main_lists = np.repeat(np.arange(self.nlist, dtype=np.int32), np.diff(self.list_offsets))
+        vectors = np.concatenate([np.asarray(self.vectors)[self.alive], self.delta_vectors[self.delta_alive]])
+        ids = np.concatenate([np.asarray(self.ids)[self.alive], self.delta_ids[self.delta_alive]])
+        assignments = np.concatenate([main_lists[self.alive], self.delta_lists[self.delta_alive]])
+        compacted = self._from_assignments(self.centroids, vectors, ids, assignments)
+        self.__dict__.update(compacted.__dict__)
+
+    def search(self, query, k=10, nprobe=DEFAULT_NPROBE, allowed_ids=None):
+        """
+        Returns the ids and cosine similarities of the approximate k nearest neighbours of query, best first.
+        allowed_ids, when given, is an array of ids the results are restricted to. When fewer than k of them are
+        in the probed clusters, all of them are scored, so a selective filter still gets its k best matches.
+        """
+        query = normalize(query)
+        nprobe = min(nprobe, self.nlist)
+        probed = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+
+        # The clusters are contiguous in the main segment, so each probed cluster is a single slice
+        positions = np.concatenate([np.arange(self.list_offsets[cluster], self.list_offsets[cluster + 1])
+                                    for cluster in probed])
+        positions = positions[self.alive[positions]]
+        candidate_ids = self.ids[positions]
+        scores = np.asarray(self.vectors[positions]) @ query
+
+        delta = np.flatnonzero(np.isin(self.delta_lists, probed) & self.delta_alive)
+        if len(delta):
+            candidate_ids = np.concatenate([candidate_ids, self.delta_ids[delta]])
+            scores = np.concatenate([scores, self.delta_vectors[delta] @ query])
+
+        if allowed_ids is not None:
+            if not (isinstance(allowed_ids, np.ndarray) and allowed_ids.dtype.kind == 'S'):
+                allowed_ids = encode_ids(allowed_ids)
+            keep = np.isin(candidate_ids, allowed_ids)
+            candidate_ids = candidate_ids[keep]
+            scores = scores[keep]
+            if len(scores) < k and nprobe < self.nlist:
+                # A selective filter leaves too few hits in the probed clusters: score all the allowed vectors
+                candidate_ids, scores = self._exact_candidates(query, allowed_ids)
+
+        k = min(k, len(scores))
+        if k == 0:
+            return [], np.empty(0, dtype=np.float32)
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [candidate_id.decode('utf-8') for candidate_id in candidate_ids[best]], scores[best]
+
+    def _exact_candidates(self, query, allowed_ids):
+        """Ids and similarities of all the live vectors of allowed_ids, in both segments."""
+        main = np.flatnonzero(np.asarray(self.alive) & np.isin(self.ids, allowed_ids))
+        delta = np.flatnonzero(self.delta_alive & np.isin(self.delta_ids, allowed_ids))
+        candidate_ids = np.concatenate([np.asarray(self.ids)[main], self.delta_ids[delta]])
+        scores = np.concatenate([np.asarray(self.vectors[main]) @ query, self.delta_vectors[delta] @ query])
+        return candidate_ids, scores
+
+    def save(self, directory):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        arrays = {
+            'centroids': self.centroids, 'vectors': self.vectors, 'ids': self.ids,
+            'list_offsets': self.list_offsets, 'alive': self.alive, 'delta_vectors': self.delta_vectors,
+            'delta_ids': self.delta_ids, 'delta_lists': self.delta_lists, 'delta_alive': self.delta_alive,
+        }
+        for name, array in arrays.items():
+            # Write next to the target and swap, as the current file may be memory-mapped by this index
+            np.save(os.path.join(directory, f'{name}.tmp.npy'), np.asarray(array))
+        for name in arrays:
+            os.replace(os.path.join(directory, f'{name}.tmp.npy'), os.path.join(directory, f'{name}.npy'))
+        with open(os.path.join(directory, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump({'nlist': self.nlist, 'dimensions': int(self.centroids.shape[1]), 'count': len(self)}, f)
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        """Loads a saved index; the main segment vectors and ids are memory-mapped unless mmap is False."""
+        mmap_mode = 'r' if mmap else None
+
+        def load_array(name, mode=None):
+            return np.load(os.path.join(directory, f'{name}.npy'), mmap_mode=mode)
+
+        return cls(load_array('centroids'), load_array('vectors', mmap_mode), load_array('ids', mmap_mode),
+                   load_array('list_offsets'), alive=load_array('alive'),
+                   delta_vectors=load_array('delta_vectors'), delta_ids=load_array('delta_ids'),
+                   delta_lists=load_array('delta_lists'), delta_alive=load_array('delta_alive'))
+
+
+def update_ann_index(store_directory, added_ids, removed_ids):
+    """
+    Brings the ANN index of a chunk store in line with an ingestion run: the vectors of added_ids are inserted,
+    removed_ids are tombstoned. The index is built from the whole store the first time.
+    """
+    from scripts.chunk_store import ChunkStoreReader
+
+    index_directory = os.path.join(store_directory, ANN_DIRECTORY_NAME)
+    reader = ChunkStoreReader(store_directory)
+
+    if not os.path.exists(os.path.join(index_directory, 'meta.json')):
+        ids = [record['id'] for _, record in reader.iter_records()]
+        if not ids:
+            return None
+        index = IVFIndex.build(reader.vectors, ids)
+        print(f"Built ANN index with {len(ids)} vectors in {index.nlist} lists")
+    else:
+        index = IVFIndex.load(index_directory)
+        index.remove(removed_ids)
+        added = set(added_ids)
+        rows = [(offset, record['id']) for offset, record in reader.iter_records() if record['id'] in added]
+        offsets = [offset for offset, _ in rows]
+        index.add(np.asarray(reader.vectors[offsets]), [record_id for _, record_id in rows])
+        print(f"Updated ANN index: {len(rows)} added, {len(removed_ids)} removed")
+
+    index.save(index_directory)
+    return index
+
+# Example usage:
+# index = IVFIndex.build(vectors, ids)
+# index.save('data/chunks/crm_store/ann')
+# ids, scores = IVFIndex.load('data/chunks/crm_store/ann').search(query_vector, k=10, nprobe=8)
@@ -0,0 +1,175 @@
+import os
+import re
+import threading
+import time
+import numpy as np
+from scripts.chunk_manifest import MANIFEST_FILE_NAME
+
+# Similarity above which two questions get the same answer, and lifetime and count of the cached answers,
+# overridable from the .env file
+ANSWER_CACHE_THRESHOLD = 0.97
+ANSWER_CACHE_TTL_SECONDS = 1800
+ANSWER_CACHE_MAX_ENTRIES = 512
+
+# Words that change the answer of a question while barely moving its embedding
+CALENDAR_WORDS = {'winter', 'spring', 'summer', 'autumn', 'fall', 'january', 'february', 'march', 'april', 'may',
+                  'june', 'july', 'august', 'september', 'october', 'november', 'december', 'q1', 'q2', 'q3', 'q4'}
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def manifest_generation(chunk_directories):
+    """
+    Version of the indexed data: the modification times of the manifests of the chunk directories.
+    A manifest is rewritten by every chunking run and every upload, so any refresh of the indexes changes it.
+    """
+    generation = []
+    for chunk_directory in chunk_directories:
+        try:
+            generation.append(os.stat(os.path.join(chunk_directory, MANIFEST_FILE_NAME)).st_mtime_ns)
+        except OSError:
+            generation.append(None)
+    return tuple(generation)
+
+
+def key_terms(question):
+    """
+    Terms two questions must share to get the same answer, however similar their embeddings: the numbers,
+    the seasons, months and quarters, and the capitalized words past the start of a sentence (names of mines,
+    customers, regions...), lowercased.
+    """
+    terms = set(re.findall(r'\b\d+(?:[.,]\d+)*\b', question))
+    for sentence in re.split(r'[.?!]\s+', question):
+        for position, word in enumerate(re.findall(r"[^\W\d_][\w'-]*", sentence)):
+            if word.lower() in CALENDAR_WORDS or (position > 0 and word[0].isupper()):
+                terms.add(word.lower())
+    return frozenset(terms)
+
+
+class SemanticAnswerCache:
+    """
+    In-memory cache of generated answers, looked up by the embedding of the question within a scope
+    (e.g. the CSU the search was filtered on). A question whose embedding has a cosine similarity of at
+    least threshold with a cached one, in the same scope, gets the cached answer. When the questions are given,
+    they must also have the same key terms (see key_terms), as "Winter" and "Summer" questions are often closer
+    than the threshold.
+
+    Entries expire after ttl_seconds, the least recently used ones are evicted beyond max_entries, and all
+    of them are dropped when generation() (e.g. manifest_generation of the chunk directories) changes.
+    """
+
+    def __init__(self, threshold=ANSWER_CACHE_THRESHOLD, ttl_seconds=ANSWER_CACHE_TTL_SECONDS,
+                 max_entries=ANSWER_CACHE_MAX_ENTRIES, generation=None):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.generation = generation
+        self.current_generation = generation() if generation else None
+        # scope -> list of [unit vector, answer, stored at, last used at, key terms]
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _check_generation(self):
+        if self.generation is None:
+            return
+        generation = self.generation()
+        if generation != self.current_generation:
+            self.current_generation = generation
+            if self.entries:
+                self.entries.clear()
+                self.invalidations += 1
+
+    def lookup(self, embedding, scope=None, question=None):
+        """
+        Returns the cached answer of the most similar question above the threshold (with the same key terms
+        as question, when given), or None.
+        """
+        query = np.asarray(embedding, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        terms = key_terms(question) if question is not None else None
+        now = time.monotonic()
+
+        with self.lock:
+            self._check_generation()
+            entries = self.entries.get(scope, [])
+            entries[:] = [entry for entry in entries if now - entry[2] <= self.ttl_seconds]
+            candidates = [entry for entry in entries if terms is None or entry[4] == terms]
+            if candidates:
+                similarities = np.stack([entry[0] for entry in candidates]) @ query
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    candidates[best][3] = now
+                    self.hits += 1
+                    return candidates[best][1]
+            self.misses += 1
+            return None
+
+    def store(self, embedding, answer, scope=None, question=None):
+        vector = np.asarray(embedding, dtype=np.float32)
+        vector = vector / (np.linalg.norm(vector) or 1.0)
+        terms = key_terms(question) if question is not None else None
+        now = time.monotonic()
+
+        with self.lock:
+            self._check_generation()
+            self.entries.setdefault(scope, []).append([vector, answer, now, now, terms])
+
+            count = sum(len(entries) for entries in self.entries.values())
+            if count > self.max_entries:
+                # Evict the least recently used entries across all scopes
+                ranked = sorted((entry[3], scope_name, id(entry)) for scope_name, entries in self.entries.items()
+                                for entry in entries)
+                evicted = {(scope_name, entry_id) for _, scope_name, entry_id in ranked[:count - self.max_entries]}
+                for scope_name, entries in self.entries.items():
+                    entries[:] = [entry for entry in entries if (scope_name, id(entry)) not in evicted]
+                self.evictions += len(evicted)
+
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+            self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'entries': sum(len(entries) for entries in self.entries.values()),
+            }
+
+
+def get_default_answer_cache():
+    """
+    The process-wide answer cache, configured from ANSWER_CACHE_THRESHOLD / ANSWER_CACHE_TTL_SECONDS /
+    ANSWER_CACHE_MAX_ENTRIES and invalidated whenever the chunk directories under
+    LOCAL_SEARCH_CHUNK_DIRECTORY (data/chunks) are re-chunked or uploaded.
+    """
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            project_root = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+            chunk_root = os.path.join(project_root, os.getenv('LOCAL_SEARCH_CHUNK_DIRECTORY', 'data/chunks'))
+            chunk_directories = [os.path.join(chunk_root, name)
+                                 for name in ('customer_store', 'crm_store', 'customer_chunks', 'crm_chunks')]
+            _default_cache = SemanticAnswerCache(
+                threshold=float(os.getenv('ANSWER_CACHE_THRESHOLD', ANSWER_CACHE_THRESHOLD)),
+                ttl_seconds=float(os.getenv('ANSWER_CACHE_TTL_SECONDS', ANSWER_CACHE_TTL_SECONDS)),
+                max_entries=int(os.getenv('ANSWER_CACHE_MAX_ENTRIES', ANSWER_CACHE_MAX_ENTRIES)),
+                generation=lambda: manifest_generation(chunk_directories))
+        return _default_cache
+
+# Example usage:
+# answer_cache = get_default_answer_cache()
+# answer = answer_cache.lookup(query_embedding, scope='East', question=user_query)
+# if answer is None:
+#     answer = ...  # retrieve and generate
+#     answer_cache.store(query_embedding, answer, scope='East', question=user_query)
@@ -0,0 +1,90 @@
+import re
+import sys
+import time
+from scripts.instrumentation import get_default_metrics, record_usage
+
+# Internal document references added by the model, e.g. [doc1]
+DOC_REFERENCE_PATTERN = re.compile(r"\[doc\d+\]")
+# A tail that may be the beginning of a reference completed by the next chunk: "[", "[d", "[do", "[doc", "[doc1"...
+PARTIAL_REFERENCE_PATTERN = re.compile(r"\[(?:d(?:o(?:c\d*)?)?)?$")
+
+
+class DocReferenceStripper:
+    """
+    Removes [docN] references from text arriving in chunks. A reference can be split across chunks, so the
+    possible start of one at the end of a chunk is held back until the next chunk shows what it is.
+    """
+
+    def __init__(self):
+        self.pending = ''
+
+    def feed(self, text):
+        """Returns the part of the text so far that can be emitted."""
+        text = DOC_REFERENCE_PATTERN.sub('', self.pending + text)
+        match = PARTIAL_REFERENCE_PATTERN.search(text)
+        if match:
+            self.pending = text[match.start():]
+            return text[:match.start()]
+        self.pending = ''
+        return text
+
+    def flush(self):
+        """Returns the text still held back, at the end of the stream."""
+        text, self.pending = self.pending, ''
+        return DOC_REFERENCE_PATTERN.sub('', text)
+
+
+def write_to_terminal(text):
+    sys.stdout.write(text)
+    sys.stdout.flush()
+
+
+def stream_answer(openai_client, messages, model='gpt-4o', on_text=write_to_terminal, **kwargs):
+    """
+    Generates a chat completion as a stream, passing the text to on_text as it arrives, with the [docN]
+    references stripped. The default on_text writes to the terminal; an API can pass its own writer.
+
+    Returns the full message content, the model, the token usage (as a dict, sent by the service at the end
+    of the stream) and the timings of the stream: time to first token and total time, in seconds.
+    """
+    start_time = time.perf_counter()
+    first_token_time = None
+    stripper = DocReferenceStripper()
+    parts = []
+    response_model = model
+    usage = None
+
+    stream = openai_client.chat.completions.create(model=model, messages=messages, stream=True,
+                                                   stream_options={"include_usage": True}, **kwargs)
+    for chunk in stream:
+        response_model = chunk.model or response_model
+        if chunk.usage is not None:
+            usage = chunk.usage.model_dump()
+        # Azure sends chunks without choices for the content filter results and for the usage
+        if not chunk.choices or not chunk.choices[0].delta.content:
+            continue
+
+        if first_token_time is None:
+            first_token_time = time.perf_counter()
+        text = stripper.feed(chunk.choices[0].delta.content)
+        if text:
+            parts.append(text)
+            on_text(text)
+
+    text = stripper.flush()
+    if text:
+        parts.append(text)
+        on_text(text)
+
+    end_time = time.perf_counter()
+    timings = {
+        'time_to_first_token': (first_token_time or end_time) - start_time,
+        'total_seconds': end_time - start_time,
+    }
+    get_default_metrics().observe('rag_time_to_first_token_seconds', timings['time_to_first_token'])
+    record_usage(usage, response_model)
+    return ''.join(parts), response_model, usage, timings
+
+# Example usage:
+# content, model, usage, timings = stream_answer(openai_client, [{"role": "user", "content": "Hello"}])
+# print(f"\nFirst token after {timings['time_to_first_token']:.2f}s, {usage['total_tokens']} tokens")
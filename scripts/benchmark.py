@@ -0,0 +1,281 @@
+import argparse
+import json
+import os
+import platform
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# Scale-ups of the bundled data benchmarked by default, and the settings of the stand-in services
+BENCHMARK_SCALES = [1, 4]
+BENCHMARK_QUERIES = 100
+BENCHMARK_CONCURRENCY = 8
+OPENAI_LATENCY_MS = 20
+SEARCH_LATENCY_MS = 5
+UPLOAD_LATENCY_MS = 10
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+# Reports are kept out of the working tree, in a directory ignored by git
+BENCHMARK_RESULTS_DIRECTORY = os.path.join(PROJECT_ROOT, 'benchmarks')
+TABLE_DIRECTORIES = ['crm', 'customers']
+ID_PATTERN = re.compile(r'\b((?:ORD|CUST|OFF)\d+)\b')
+
+QUERY_TEMPLATES = [
+    "Which orders were delivered from {place} in {season}?",
+    "Tell me about customers in {place} and their preferred season",
+    "What drives the adjusted price of orders from {mine}?",
+    "How did the demand index evolve for deliveries to {place} in {season}?",
+    "Average price per unit of {mine} in {season}",
+    "Which customers of {place} have the highest transportation cost?",
+]
+PLACES = ['Rohan', 'Gondor', 'Shire', 'Rivendell', 'Mordor', 'Lothlórien']
+SEASONS = ['Winter', 'Spring', 'Summer', 'Autumn']
+MINES = ['Iron Hills Mine', 'Khazad-dûm Mine 1', 'Erebor Mine']
+CSUS = ['North', 'South', 'East', 'West']
+
+
+def peak_rss_mb():
+    """Peak resident set size of the process so far (ru_maxrss is in KB on Linux, in bytes on macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def latency_summary(seconds):
+    milliseconds = np.array(seconds) * 1000
+    return {
+        'count': len(seconds),
+        'mean_ms': float(milliseconds.mean()),
+        'p50_ms': float(np.percentile(milliseconds, 50)),
+        'p95_ms': float(np.percentile(milliseconds, 95)),
+        'p99_ms': float(np.percentile(milliseconds, 99)),
+    }
+
+
+def scale_tables(data_directory, scale):
+    """
+    Writes the bundled CRM and customer tables scale times into data_directory. Each copy after the first
+    suffixes the order, customer and offer ids, so every row is a new document while the orders still
+    reference customers of their own copy. Returns the number of rows written per table.
+    """
+    rows = {}
+    for table in TABLE_DIRECTORIES:
+        source_directory = os.path.join(PROJECT_ROOT, 'data', table)
+        target_directory = os.path.join(data_directory, table)
+        os.makedirs(target_directory, exist_ok=True)
+        rows[table] = 0
+        for filename in sorted(os.listdir(source_directory)):
+            if not filename.endswith('.md'):
+                continue
+            with open(os.path.join(source_directory, filename), 'r', encoding='utf-8') as f:
+                header, *lines = [line for line in f.read().split('\n') if line.strip()]
+            with open(os.path.join(target_directory, filename), 'w', encoding='utf-8') as f:
+                f.write(header + '\n')
+                for copy in range(scale):
+                    for line in lines:
+                        f.write((ID_PATTERN.sub(lambda match: f"{match.group(1)}X{copy}", line) if copy else line)
+                                + '\n')
+                        rows[table] += 1
+    return rows
+
+
+def make_queries(count):
+    queries = []
+    for position in range(count):
+        template = QUERY_TEMPLATES[position % len(QUERY_TEMPLATES)]
+        queries.append((CSUS[position % len(CSUS)], template.format(
+            place=PLACES[position % len(PLACES)], season=SEASONS[(position // 2) % len(SEASONS)],
+            mine=MINES[(position // 3) % len(MINES)]) + f" (#{position})"))
+    return queries
+
+
+def benchmark_scale(scale, work_directory, args, run_id):
+    from scripts.local_backends import LocalOpenAI, LocalIndexClient, LocalUploadClient, LatencySearchClient
+    from scripts.file_chunking_dynamic import chunk_file
+    from scripts.upload_chunks import upload_chunks_to_search
+    from scripts.local_search import LocalSearchClient
+    from scripts.analytics import AnalyticsEngine
+    from scripts.answer_cache import SemanticAnswerCache, manifest_generation, ANSWER_CACHE_THRESHOLD
+    from scripts.instrumentation import get_default_metrics
+    from scripts.UpdatedRAG import QueryPipeline
+
+    scale_directory = os.path.join(work_directory, f"scale_{scale}")
+    data_directory = os.path.join(scale_directory, 'data')
+    chunk_directory = os.path.join(scale_directory, 'chunks')
+    rows = scale_tables(data_directory, scale)
+    os.environ['LOCAL_SEARCH_CHUNK_DIRECTORY'] = chunk_directory
+
+    openai_client = LocalOpenAI(dimensions=args.dimensions, latency_seconds=args.openai_latency_ms / 1000)
+    # A model name of its own per run keeps the embedding caches from answering for earlier runs
+    embedding_model = f"benchmark-{run_id}-{scale}"
+    index_client = LocalIndexClient(scale_directory)
+    result = {'scale': scale, 'rows': rows}
+
+    # Ingestion: chunking and embedding of every row, without the rate limits of a real deployment
+    start_time = time.perf_counter()
+    for table, index_name in (('customers', 'customer-index'), ('crm', 'crm-index')):
+        chunk_file(os.path.join(data_directory, table), chunk_directory, openai_client, embedding_model,
+                   index_client, index_name, tokens_per_minute=10 ** 9, requests_per_minute=10 ** 7,
+                   max_workers=args.workers, output_format='store', build_ann_index=args.ann)
+    chunk_seconds = time.perf_counter() - start_time
+    total_rows = sum(rows.values())
+    result['chunk'] = {'seconds': chunk_seconds, 'rows_per_second': total_rows / chunk_seconds,
+                       'peak_rss_mb': peak_rss_mb()}
+
+    # Upload of the chunk stores to the stand-in index
+    upload_clients = {}
+    start_time = time.perf_counter()
+    for store in ('customer_store', 'crm_store'):
+        upload_clients[store] = LocalUploadClient(latency_seconds=args.upload_latency_ms / 1000)
+        upload_chunks_to_search(upload_clients[store], os.path.join(chunk_directory, store))
+    upload_seconds = time.perf_counter() - start_time
+    documents = sum(len(client.documents) for client in upload_clients.values())
+    result['upload'] = {'seconds': upload_seconds, 'documents': documents,
+                        'docs_per_second': documents / upload_seconds,
+                        'requests': sum(client.requests for client in upload_clients.values()),
+                        'peak_rss_mb': peak_rss_mb()}
+
+    # Query path: concurrent sessions against the local search over the new stores
+    search_latency = args.search_latency_ms / 1000
+    customer_client = LatencySearchClient(LocalSearchClient(os.path.join(chunk_directory, 'customer_store'),
+                                                            index_name='customer-index', use_ann=args.ann),
+                                          search_latency)
+    crm_client = LatencySearchClient(LocalSearchClient(os.path.join(chunk_directory, 'crm_store'),
+                                                       index_name='crm-index', use_ann=args.ann),
+                                     search_latency)
+    pipeline = QueryPipeline(clients=(openai_client, customer_client, crm_client, None, embedding_model,
+                                      'customer-index', 'crm-index', None))
+    pipeline.analytics_engine = AnalyticsEngine(project_root=scale_directory)
+    # Unless asked for, every query goes through the full path (no similarity reaches 2)
+    pipeline.answer_cache = SemanticAnswerCache(
+        threshold=ANSWER_CACHE_THRESHOLD if args.answer_cache else 2.0,
+        generation=lambda: manifest_generation([os.path.join(chunk_directory, 'customer_store'),
+                                                os.path.join(chunk_directory, 'crm_store')]))
+
+    metrics = get_default_metrics()
+    metrics.reset()
+    queries = make_queries(args.queries)
+
+    def run_query(query):
+        csu_name, user_query = query
+        memory = pipeline.new_memory()
+        try:
+            answer = pipeline.answer(user_query, csu_name, memory)
+        finally:
+            memory.close()
+        return answer
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        answers = list(executor.map(run_query, queries))
+    query_seconds = time.perf_counter() - start_time
+
+    sources = {}
+    for answer in answers:
+        sources[answer['source']] = sources.get(answer['source'], 0) + 1
+    stages = {metric['labels']['stage']: {name: metric[name] for name in ('count', 'p50', 'p95', 'p99')}
+              for metric in metrics.snapshot()
+              if metric['name'] == 'rag_stage_seconds' and metric['labels'].get('status') == 'ok'}
+    result['query'] = dict(latency_summary([answer['seconds'] for answer in answers]),
+                           queries_per_second=len(answers) / query_seconds, concurrency=args.concurrency,
+                           sources=sources, stages_seconds=stages, peak_rss_mb=peak_rss_mb())
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=PROJECT_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, baseline):
+    """Prints the change of each throughput and latency figure against a baseline report, per scale."""
+    figures = [('chunk', 'rows_per_second'), ('upload', 'docs_per_second'), ('query', 'p50_ms'),
+               ('query', 'p99_ms'), ('query', 'queries_per_second'), ('query', 'peak_rss_mb')]
+    baseline_results = {result['scale']: result for result in baseline['results']}
+    print(f"Compared with {baseline.get('label') or baseline.get('commit')}:")
+    for result in report['results']:
+        previous = baseline_results.get(result['scale'])
+        if previous is None:
+            continue
+        for stage, name in figures:
+            before, after = previous[stage][name], result[stage][name]
+            change = (after - before) / before * 100 if before else 0.0
+            print(f"  scale {result['scale']:>3} {stage}.{name:<20} {before:>12.2f} -> {after:>12.2f} ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingestion throughput and query latency against local stand-ins "
+                                                 "for Azure OpenAI and Azure AI Search.")
+    parser.add_argument('--scales', default=','.join(str(scale) for scale in BENCHMARK_SCALES),
+                        help="Comma-separated multiples of the bundled data to benchmark")
+    parser.add_argument('--queries', type=int, default=BENCHMARK_QUERIES)
+    parser.add_argument('--concurrency', type=int, default=BENCHMARK_CONCURRENCY,
+                        help="Concurrent sessions of the query benchmark")
+    parser.add_argument('--workers', type=int, default=8, help="Embedding workers of the chunking")
+    parser.add_argument('--dimensions', type=int, default=1536, help="Dimensions of the stand-in embeddings")
+    parser.add_argument('--openai-latency-ms', type=float, default=OPENAI_LATENCY_MS,
+                        help="Latency added to every embedding and chat request")
+    parser.add_argument('--search-latency-ms', type=float, default=SEARCH_LATENCY_MS,
+                        help="Latency added to every search request")
+    parser.add_argument('--upload-latency-ms', type=float, default=UPLOAD_LATENCY_MS,
+                        help="Latency added to every indexing request")
+    parser.add_argument('--ann', action='store_true', help="Build and query the IVF indexes of the stores")
+    parser.add_argument('--answer-cache', action='store_true', help="Let near-duplicate questions hit the cache")
+    parser.add_argument('--work-directory', help="Where the scaled data and chunks are written (temporary "
+                                                 "directory by default)")
+    parser.add_argument('--label', help="Name of this run in the report, e.g. the version benchmarked")
+    parser.add_argument('--output', default=os.path.join(BENCHMARK_RESULTS_DIRECTORY, 'benchmark_results.json'),
+                        help="Path of the JSON report (benchmarks/benchmark_results.json by default)")
+    parser.add_argument('--compare', help="JSON report of an earlier run to compare with")
+    args = parser.parse_args()
+
+    work_directory = args.work_directory or tempfile.mkdtemp(prefix='mithril-benchmark-')
+    # The embedding cache of the benchmark is kept apart from the project's
+    os.environ['EMBEDDING_CACHE_PATH'] = os.path.join(work_directory, 'embeddings.sqlite')
+    run_id = time.strftime('%Y%m%d%H%M%S')
+
+    report = {
+        'label': args.label,
+        'commit': git_commit(),
+        'run_id': run_id,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {name: value for name, value in vars(args).items()
+                     if name not in ('output', 'compare', 'work_directory', 'label')},
+        'results': [],
+    }
+    for scale in [int(scale) for scale in args.scales.split(',')]:
+        result = benchmark_scale(scale, work_directory, args, run_id)
+        report['results'].append(result)
+        print(f"scale {scale}: {sum(result['rows'].values())} rows chunked at "
+              f"{result['chunk']['rows_per_second']:.1f} rows/s, uploaded at "
+              f"{result['upload']['docs_per_second']:.1f} docs/s; queries p50 {result['query']['p50_ms']:.1f} ms "
+              f"p99 {result['query']['p99_ms']:.1f} ms ({result['query']['queries_per_second']:.1f} q/s); "
+              f"peak RSS {result['peak_rss_mb']:.0f} MB")
+
+    output_directory = os.path.dirname(os.path.abspath(args.output))
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to {args.output}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
+
+# Example usage:
+# python -m scripts.benchmark --scales 1,4,16 --openai-latency-ms 50 --label "$(git rev-parse --short HEAD)"
+# python -m scripts.benchmark --compare benchmarks/previous.json --output benchmarks/current.json
@@ -0,0 +1,94 @@
+import argparse
+import json
+import time
+import numpy as np
+from scripts.ann_index import IVFIndex, normalize
+from scripts.chunk_store import ChunkStoreReader
+
+NPROBE_SWEEP = [1, 2, 4, 8, 16, 32]
+
+
+def make_clustered_vectors(count, dimensions, clusters=64, spread=0.3, seed=0):
+    """Synthetic embeddings: unit vectors scattered around random cluster centres, like real chunk embeddings."""
+    rng = np.random.default_rng(seed)
+    centres = normalize(rng.standard_normal((clusters, dimensions)))
+    vectors = centres[rng.integers(clusters, size=count)] + spread * rng.standard_normal((count, dimensions)) / \
+        np.sqrt(dimensions)
+    return normalize(vectors)
+
+
+def exact_top_k(vectors, queries, k):
+    scores = queries @ vectors.T
+    best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    return [set(row) for row in best]
+
+
+def benchmark(vectors, k=10, num_queries=200, nprobes=NPROBE_SWEEP, nlist=None, seed=0):
+    """Measures recall@k of the IVF index against exact search, and the query latency, for each nprobe."""
+    rng = np.random.default_rng(seed)
+    vectors = normalize(vectors)
+    ids = [str(position) for position in range(len(vectors))]
+    # Queries are perturbed corpus vectors, so that each has true neighbours to find
+    queries = normalize(vectors[rng.integers(len(vectors), size=num_queries)] +
+                        0.1 * rng.standard_normal((num_queries, vectors.shape[1])) / np.sqrt(vectors.shape[1]))
+
+    start_time = time.perf_counter()
+    index = IVFIndex.build(vectors, ids, nlist=nlist)
+    build_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    exact = exact_top_k(vectors, queries, k)
+    exact_ms = (time.perf_counter() - start_time) * 1000 / num_queries
+
+    results = []
+    for nprobe in nprobes:
+        if nprobe > index.nlist:
+            continue
+        latencies = []
+        hits = 0
+        for query, true_neighbours in zip(queries, exact):
+            start_time = time.perf_counter()
+            found, _ = index.search(query, k=k, nprobe=nprobe)
+            latencies.append((time.perf_counter() - start_time) * 1000)
+            hits += len(true_neighbours & {int(document_id) for document_id in found})
+        results.append({
+            'nprobe': nprobe,
+            'recall_at_k': hits / (k * num_queries),
+            'mean_ms': float(np.mean(latencies)),
+            'p95_ms': float(np.percentile(latencies, 95)),
+        })
+
+    return {'vectors': len(vectors), 'dimensions': int(vectors.shape[1]), 'nlist': index.nlist, 'k': k,
+            'build_seconds': build_seconds, 'exact_mean_ms': exact_ms, 'results': results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall and latency of the IVF index against exact search")
+    parser.add_argument('--store', help="Chunk store directory to benchmark on, instead of synthetic vectors")
+    parser.add_argument('--count', type=int, default=100000, help="Number of synthetic vectors")
+    parser.add_argument('--dimensions', type=int, default=1536, help="Dimensions of the synthetic vectors")
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--nlist', type=int, default=None)
+    parser.add_argument('--output', help="Path of a JSON file to save the results to")
+    args = parser.parse_args()
+
+    if args.store:
+        vectors = np.asarray(ChunkStoreReader(args.store).vectors, dtype=np.float32)
+    else:
+        vectors = make_clustered_vectors(args.count, args.dimensions)
+
+    report = benchmark(vectors, k=args.k, num_queries=args.queries, nlist=args.nlist)
+    print(f"{report['vectors']} vectors of {report['dimensions']} dimensions, {report['nlist']} lists, "
+          f"built in {report['build_seconds']:.1f}s; exact search {report['exact_mean_ms']:.2f} ms/query")
+    for result in report['results']:
+        print(f"nprobe={result['nprobe']:>3}  recall@{args.k}={result['recall_at_k']:.3f}  "
+              f"mean={result['mean_ms']:.2f} ms  p95={result['p95_ms']:.2f} ms")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
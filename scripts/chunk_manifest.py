@@ -0,0 +1,83 @@
+import hashlib
+import json
+import os
+import re
+from scripts.materialized_aggregates import AGGREGATES_FILE_NAME
+
+MANIFEST_FILE_NAME = 'manifest.json'
+
+
+def content_hash(fields):
+    """Hash of a row's values, independent of the column order."""
+    return hashlib.sha256(json.dumps(fields, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def make_document_id(fields, key_field):
+    """
+    Builds a deterministic document id from the business key of the row (e.g. OrderID) and its content hash.
+    The same row always gets the same id, while a changed row gets a new one. Characters that Azure AI Search
+    does not accept in keys are replaced by underscores.
+    """
+    business_key = re.sub(r'[^A-Za-z0-9_\-=]', '_', str(fields.get(key_field, 'unknown')))
+    return f"{business_key}-{content_hash(fields)}"
+
+
+def load_manifest(chunk_directory):
+    """
+    Loads the manifest of a chunk directory: the documents it holds (id -> chunk file name) and the
+    ids still to be upserted into or deleted from the search index.
+    Directories written before the manifest existed are described from their chunk files.
+    """
+    manifest_path = os.path.join(chunk_directory, MANIFEST_FILE_NAME)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    manifest = {'documents': {}, 'pending_upserts': [], 'pending_deletes': []}
+    if os.path.exists(chunk_directory):
+        for filename in os.listdir(chunk_directory):
+            if filename.endswith('.json') and filename != AGGREGATES_FILE_NAME:
+                with open(os.path.join(chunk_directory, filename), 'r', encoding='utf-8') as chunk_file:
+                    manifest['documents'][json.load(chunk_file)['id']] = filename
+    return manifest
+
+
+def save_manifest(chunk_directory, manifest):
+    manifest_path = os.path.join(chunk_directory, MANIFEST_FILE_NAME)
+    temp_path = manifest_path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    os.replace(temp_path, manifest_path)
+
+
+def apply_delta(manifest, current_documents):
+    """
+    Updates the manifest with the documents produced by the latest ingestion run (id -> chunk file name).
+    Returns the ids that are new and the ids that disappeared, and queues them for the next upload.
+    """
+    previous_ids = set(manifest['documents'])
+    current_ids = set(current_documents)
+    added = sorted(current_ids - previous_ids)
+    removed = sorted(previous_ids - current_ids)
+
+    pending_upserts = set(manifest['pending_upserts'])
+    pending_deletes = set(manifest['pending_deletes'])
+    for document_id in added:
+        pending_upserts.add(document_id)
+        pending_deletes.discard(document_id)
+    for document_id in removed:
+        # A document that never reached the index only needs to be dropped from the upload queue
+        if document_id in pending_upserts:
+            pending_upserts.discard(document_id)
+        else:
+            pending_deletes.add(document_id)
+
+    manifest['documents'] = dict(current_documents)
+    manifest['pending_upserts'] = sorted(pending_upserts)
+    manifest['pending_deletes'] = sorted(pending_deletes)
+    return added, removed
+
+# Example usage:
+# manifest = load_manifest('data/chunks/crm_chunks')
+# added, removed = apply_delta(manifest, {'ORD001-3f2a9c1b0d4e5f60': 'ORD001-3f2a9c1b0d4e5f60.json'})
+# save_manifest('data/chunks/crm_chunks', manifest)
@@ -0,0 +1,105 @@
+import json
+import os
+import numpy as np
+
+VECTORS_FILE_NAME = 'vectors.npy'
+RECORDS_FILE_NAME = 'records.jsonl'
+
+
+def is_chunk_store(directory):
+    return os.path.exists(os.path.join(directory, VECTORS_FILE_NAME))
+
+
+class ChunkStoreWriter:
+    """
+    Writes chunks into a columnar store directory:
+    - vectors.npy: all vectors as one contiguous float32 matrix, row i belonging to chunk i
+    - records.jsonl: one line per chunk with its id, fields and description, line i belonging to chunk i
+    Rows are streamed to temporary files and only replace the previous store on close().
+    """
+
+    def __init__(self, directory):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.records_file = open(os.path.join(directory, RECORDS_FILE_NAME + '.tmp'), 'w', encoding='utf-8')
+        self.vectors_file = open(os.path.join(directory, 'vectors.f32.tmp'), 'wb')
+        self.dimensions = None
+        self.count = 0
+
+    def append(self, document_id, fields, description, vector):
+        """Appends one chunk and returns its row offset in the store."""
+        vector = np.asarray(vector, dtype=np.float32)
+        if self.dimensions is None:
+            self.dimensions = vector.shape[0]
+        elif vector.shape[0] != self.dimensions:
+            raise ValueError(f"Vector of {document_id} has {vector.shape[0]} dimensions, expected {self.dimensions}")
+
+        self.records_file.write(json.dumps({'id': document_id, 'fields': fields, 'description': description}) + '\n')
+        self.vectors_file.write(vector.tobytes())
+        self.count += 1
+        return self.count - 1
+
+    def close(self):
+        self.records_file.close()
+        self.vectors_file.close()
+
+        raw_path = os.path.join(self.directory, 'vectors.f32.tmp')
+        vectors_path = os.path.join(self.directory, VECTORS_FILE_NAME)
+        shape = (self.count, self.dimensions or 0)
+
+        # Copy the raw float32 rows into a .npy file block by block, so the matrix is never fully in memory
+        vectors = np.lib.format.open_memmap(vectors_path + '.tmp', mode='w+', dtype=np.float32, shape=shape)
+        if self.count:
+            raw = np.memmap(raw_path, dtype=np.float32, mode='r', shape=shape)
+            for start in range(0, self.count, 65536):
+                vectors[start:start + 65536] = raw[start:start + 65536]
+            del raw
+        vectors.flush()
+        del vectors
+
+        # The previous store stays readable by open readers until both files are swapped
+        os.replace(vectors_path + '.tmp', vectors_path)
+        os.replace(os.path.join(self.directory, RECORDS_FILE_NAME + '.tmp'),
+                   os.path.join(self.directory, RECORDS_FILE_NAME))
+        os.remove(raw_path)
+
+
+class ChunkStoreReader:
+    """Reads a store written by ChunkStoreWriter, with the vectors memory-mapped rather than loaded."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.vectors = np.load(os.path.join(directory, VECTORS_FILE_NAME), mmap_mode='r')
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    def get_vector(self, offset):
+        return self.vectors[offset]
+
+    def iter_records(self):
+        """Streams (offset, record) pairs from records.jsonl without loading the whole file."""
+        with open(os.path.join(self.directory, RECORDS_FILE_NAME), 'r', encoding='utf-8') as records_file:
+            for offset, line in enumerate(records_file):
+                yield offset, json.loads(line)
+
+    def iter_documents(self, document_ids=None):
+        """
+        Streams chunks in the document layout of the search index, optionally only those in document_ids.
+        """
+        for offset, record in self.iter_records():
+            if document_ids is not None and record['id'] not in document_ids:
+                continue
+            document = record['fields']
+            document['vector'] = self.vectors[offset].tolist()
+            document['id'] = record['id']
+            document['description'] = record['description']
+            yield document
+
+# Example usage:
+# writer = ChunkStoreWriter('data/chunks/crm_store')
+# writer.append('ORD001-3f2a9c1b0d4e5f60', fields, description, vector)
+# writer.close()
+# for document in ChunkStoreReader('data/chunks/crm_store').iter_documents():
+#     print(document['id'])
@@ -0,0 +1,44 @@
+import heapq
+import os
+import re
+from scripts.tokenizer import num_tokens_from_string
+
+# Token budget of the retrieved context in the generation prompt, overridable from the .env file
+CONTEXT_MAX_TOKENS = 6000
+
+
+def pack_context(result_lists, max_tokens=None, text_field='description'):
+    """
+    Selects the search results that go into the prompt, best first, within a token budget.
+    result_lists are the results of each index searched, each already ordered by decreasing '@search.score'
+    (as returned by search), and are merged on that score. fan_out_search reads each search only up to this
+    budget, so the pages of results that could not fit are never requested.
+    Results whose text repeats an earlier one are dropped.
+
+    Returns the selected documents and the number of tokens of their text.
+    """
+    if max_tokens is None:
+        max_tokens = int(os.getenv('CONTEXT_MAX_TOKENS', CONTEXT_MAX_TOKENS))
+
+    packed = []
+    seen = set()
+    total_tokens = 0
+    for doc in heapq.merge(*result_lists, key=lambda doc: -(doc.get('@search.score') or 0.0)):
+        text = doc.get(text_field) or ''
+        fingerprint = re.sub(r'\s+', ' ', text).strip().lower()
+        if not fingerprint or fingerprint in seen:
+            continue
+        seen.add(fingerprint)
+
+        # One line per document in the prompt
+        tokens = num_tokens_from_string(text) + 1
+        if total_tokens + tokens > max_tokens:
+            break
+        packed.append(doc)
+        total_tokens += tokens
+
+    return packed, total_tokens
+
+# Example usage:
+# docs, tokens = pack_context([customer_results, crm_results], max_tokens=4000)
+# context_text = "\n".join(doc["description"] for doc in docs)
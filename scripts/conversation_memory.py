@@ -0,0 +1,126 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from scripts.tokenizer import get_encoding, num_tokens_from_string, truncate_to_tokens
+from scripts.resilience import get_resilient_caller
+
+# Shape of the history sent with each question, overridable from the .env file
+MEMORY_RECENT_TURNS = 4
+MEMORY_MAX_TOKENS = 1500
+MEMORY_SUMMARY_MAX_TOKENS = 400
+
+SUMMARY_PROMPT = ("Summarize this conversation between an analyst and an assistant about Mithril pricing, orders "
+                  "and customers. Keep the figures, CSUs, regions, seasons and entities it mentions, and the "
+                  "conclusions reached. Be concise.")
+
+
+def format_turn(turn):
+    return f"Q: {turn['query']} R: {turn['response']}"
+
+
+class ConversationMemory:
+    """
+    History of one conversation, sent to the model with each question at a bounded size.
+    The last recent_turns turns are kept verbatim; older turns are folded into a running summary, which
+    openai_client rewrites in the background so that answering is never blocked on it. Without a client,
+    the summary is the tail of the older turns. The history rendered for the prompt never exceeds max_tokens.
+    """
+
+    def __init__(self, openai_client=None, model='gpt-4o', recent_turns=None, max_tokens=None,
+                 summary_max_tokens=None):
+        self.openai_client = openai_client
+        self.model = model
+        self.recent_turns = recent_turns or int(os.getenv('MEMORY_RECENT_TURNS', MEMORY_RECENT_TURNS))
+        self.max_tokens = max_tokens or int(os.getenv('MEMORY_MAX_TOKENS', MEMORY_MAX_TOKENS))
+        self.summary_max_tokens = summary_max_tokens or int(os.getenv('MEMORY_SUMMARY_MAX_TOKENS',
+                                                                      MEMORY_SUMMARY_MAX_TOKENS))
+        self.turns = []
+        self.summary = ''
+        # Turns moved out of self.turns and not yet folded into the summary
+        self.unsummarized = []
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='memory')
+        self.pending_summary = None
+
+    def add_turn(self, query, response):
+        with self.lock:
+            self.turns.append({'query': query, 'response': response})
+            if len(self.turns) > self.recent_turns:
+                self.unsummarized.extend(self.turns[:-self.recent_turns])
+                self.turns = self.turns[-self.recent_turns:]
+            # At most one summarization runs at a time; turns moved out meanwhile wait for the next one
+            if self.unsummarized and (self.pending_summary is None or self.pending_summary.done()):
+                self.pending_summary = self.executor.submit(self._refresh_summary)
+
+    def _refresh_summary(self):
+        with self.lock:
+            summary = self.summary
+            folded = list(self.unsummarized)
+        conversation = "\n".join(format_turn(turn) for turn in folded)
+
+        if self.openai_client is not None:
+            try:
+                response = get_resilient_caller('chat').call(
+                    self.openai_client.chat.completions.create,
+                    model=self.model,
+                    max_tokens=self.summary_max_tokens,
+                    messages=[
+                        {"role": "system", "content": SUMMARY_PROMPT},
+                        {"role": "user", "content": f"Summary so far: {summary}\n\nNew turns:\n{conversation}"}
+                    ]
+                )
+                new_summary = response.choices[0].message.content or ''
+            except Exception as e:
+                # Keep the turns queued, the next refresh will include them
+                print(f"Error summarizing the conversation: {e}")
+                return
+        else:
+            # Keep the most recent part of the older turns
+            encoding = get_encoding()
+            tokens = encoding.encode(f"{summary}\n{conversation}".strip(), disallowed_special=())
+            new_summary = encoding.decode(tokens[-self.summary_max_tokens:])
+
+        with self.lock:
+            self.summary = truncate_to_tokens(new_summary, self.summary_max_tokens)
+            self.unsummarized = self.unsummarized[len(folded):]
+            if self.unsummarized:
+                self.pending_summary = self.executor.submit(self._refresh_summary)
+
+    def render(self):
+        """The history text for the prompt: the summary of older turns, then the recent turns."""
+        with self.lock:
+            summary = self.summary
+            # Turns waiting for the summary are shown as they are, budget permitting
+            turns = self.unsummarized + self.turns
+
+        parts = []
+        used = 0
+        if summary:
+            parts.append(f"Summary of the earlier conversation: {summary}")
+            used = num_tokens_from_string(parts[0])
+
+        recent = []
+        for turn in reversed(turns):
+            text = format_turn(turn)
+            tokens = num_tokens_from_string(text)
+            if used + tokens > self.max_tokens:
+                break
+            recent.append(text)
+            used += tokens
+
+        return "\n".join(parts + recent[::-1])
+
+    def wait(self):
+        """Waits for the background summarization, if one is running."""
+        pending = self.pending_summary
+        while pending is not None and not pending.done():
+            pending.result()
+            pending = self.pending_summary
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+# Example usage:
+# memory = ConversationMemory(openai_client)
+# memory.add_turn("Average price in Winter?", "About 52,000 USD per unit.")
+# history_text = memory.render()
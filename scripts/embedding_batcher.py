@@ -0,0 +1,162 @@
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from scripts.embeddings import get_embeddings_vectors
+
+# Time a query waits for others to share its embedding request, largest batch, and batches in flight,
+# overridable from the .env file (QUERY_BATCH_WINDOW_MS=0 embeds every query on its own)
+QUERY_BATCH_WINDOW_MS = 5
+QUERY_BATCH_MAX_SIZE = 64
+QUERY_BATCH_MAX_IN_FLIGHT = 4
+
+# Number of recent batches the metrics are computed over
+METRICS_WINDOW = 1000
+
+_default_batchers = {}
+_default_batchers_lock = threading.Lock()
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class EmbeddingBatcher:
+    """
+    Micro-batcher of embedding requests across threads: texts submitted within window_ms of the first one
+    waiting (and at most max_batch_size of them) are embedded with one embeddings.create call, and each caller
+    gets its own vector. Identical texts in a batch are embedded once. Up to max_in_flight batches are sent
+    at a time, so the next batch collects while the previous one is answered.
+    A text arriving while no batch is in flight and no other text is waiting is sent at once, so a single
+    user (e.g. the terminal loop) never waits for the window.
+    """
+
+    def __init__(self, openai_client, embedding_model, window_ms=QUERY_BATCH_WINDOW_MS,
+                 max_batch_size=QUERY_BATCH_MAX_SIZE, max_in_flight=QUERY_BATCH_MAX_IN_FLIGHT):
+        self.openai_client = openai_client
+        self.embedding_model = embedding_model
+        self.window_seconds = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.pending = queue.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='embedding-batch')
+        self.lock = threading.Lock()
+        self.batch_sizes = deque(maxlen=METRICS_WINDOW)
+        self.wait_seconds = deque(maxlen=METRICS_WINDOW)
+        self.batches = 0
+        self.texts = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.closed = False
+        self.collector = threading.Thread(target=self._collect, name='embedding-batcher', daemon=True)
+        self.collector.start()
+
+    def submit(self, text):
+        """Queues a text; returns a Future of its vector."""
+        if self.closed:
+            raise RuntimeError("EmbeddingBatcher is closed")
+        future = Future()
+        self.pending.put((text, future, time.monotonic()))
+        return future
+
+    def embed(self, text):
+        """Embeds a text with the next batch, blocking until its vector is available."""
+        return self.submit(text).result()
+
+    def _collect(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            batch = [item]
+            with self.lock:
+                idle = self.in_flight == 0
+                self.in_flight += 1
+            # The window starts when the first text of the batch arrived; with nothing else going on, there is
+            # nothing to wait for
+            deadline = item[2] + self.window_seconds if not idle or not self.pending.empty() else 0
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.pending.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.pending.put(None)
+                    break
+                batch.append(item)
+            self.executor.submit(self._send, batch)
+
+    def _send(self, batch):
+        sent_at = time.monotonic()
+        texts = list(dict.fromkeys(text for text, _, _ in batch))
+        try:
+            vectors = dict(zip(texts, get_embeddings_vectors(texts, self.openai_client, self.embedding_model)))
+        except Exception as e:
+            with self.lock:
+                self.in_flight -= 1
+                self.errors += 1
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+
+        with self.lock:
+            self.in_flight -= 1
+            self.batches += 1
+            self.texts += len(batch)
+            self.batch_sizes.append(len(batch))
+            self.wait_seconds.extend(sent_at - submitted_at for _, _, submitted_at in batch)
+        for text, future, _ in batch:
+            future.set_result(vectors[text])
+
+    def stats(self):
+        """Batch size and queueing time (from submission to the request being sent) of the recent batches."""
+        with self.lock:
+            sizes = list(self.batch_sizes)
+            waits = [seconds * 1000 for seconds in self.wait_seconds]
+            return {
+                'batches': self.batches,
+                'texts': self.texts,
+                'errors': self.errors,
+                'mean_batch_size': sum(sizes) / len(sizes) if sizes else 0.0,
+                'max_batch_size': max(sizes, default=0),
+                'mean_wait_ms': sum(waits) / len(waits) if waits else 0.0,
+                'p95_wait_ms': percentile(waits, 0.95),
+            }
+
+    def close(self):
+        self.closed = True
+        self.pending.put(None)
+        self.collector.join()
+        self.executor.shutdown(wait=True)
+
+
+def get_default_embedding_batcher(openai_client, embedding_model):
+    """
+    The process-wide batcher of an OpenAI client and embedding model, configured from QUERY_BATCH_WINDOW_MS /
+    QUERY_BATCH_MAX_SIZE / QUERY_BATCH_MAX_IN_FLIGHT, or None when QUERY_BATCH_WINDOW_MS is 0.
+    """
+    window_ms = float(os.getenv('QUERY_BATCH_WINDOW_MS', QUERY_BATCH_WINDOW_MS))
+    if window_ms <= 0:
+        return None
+    key = (id(openai_client), embedding_model)
+    with _default_batchers_lock:
+        batcher = _default_batchers.get(key)
+        if batcher is None:
+            batcher = EmbeddingBatcher(
+                openai_client, embedding_model, window_ms=window_ms,
+                max_batch_size=int(os.getenv('QUERY_BATCH_MAX_SIZE', QUERY_BATCH_MAX_SIZE)),
+                max_in_flight=int(os.getenv('QUERY_BATCH_MAX_IN_FLIGHT', QUERY_BATCH_MAX_IN_FLIGHT)))
+            _default_batchers[key] = batcher
+        return batcher
+
+# Example usage:
+# batcher = get_default_embedding_batcher(openai_client, azure_openai_embedding_model)
+# vector = batcher.embed("Average price in Winter?")  # called from many threads at once
+# print(batcher.stats())
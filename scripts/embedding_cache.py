@@ -0,0 +1,164 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+
+# Default location and size of the on-disk cache, overridable from the .env file
+EMBEDDING_CACHE_PATH = os.path.join('data', 'cache', 'embeddings.sqlite')
+EMBEDDING_CACHE_MAX_MB = 512
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def make_cache_key(embedding_model, text):
+    """Content address of an embedding: a hash of the embedding model and the exact input text."""
+    return hashlib.sha256(f"{embedding_model}\0{text}".encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    SQLite-backed cache of embedding vectors keyed by make_cache_key.
+    Vectors are stored as float32 blobs. When the stored vectors exceed max_bytes, the least recently
+    used entries are evicted until the cache is back under 90% of the limit.
+    """
+
+    def __init__(self, path, max_bytes=EMBEDDING_CACHE_MAX_MB * 1024 * 1024):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+        # The connection is shared by the ingestion worker threads, access is serialized by self.lock
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self.connection.commit()
+        self.total_bytes = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+
+    def get_many(self, embedding_model, texts):
+        """Returns the cached vector for each text, or None for the texts that are not cached."""
+        keys = [make_cache_key(embedding_model, text) for text in texts]
+        found = {}
+
+        with self.lock:
+            # Stay well below SQLite's limit on the number of query parameters
+            for start in range(0, len(keys), 500):
+                key_batch = keys[start:start + 500]
+                placeholders = ','.join('?' * len(key_batch))
+                rows = self.connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", key_batch
+                ).fetchall()
+                found.update(rows)
+
+            now = time.time()
+            self.connection.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?",
+                                        [(now, key) for key in found])
+            self.connection.commit()
+            self.hits += sum(1 for key in keys if key in found)
+            self.misses += sum(1 for key in keys if key not in found)
+
+        return [array('f', found[key]).tolist() if key in found else None for key in keys]
+
+    def get(self, embedding_model, text):
+        return self.get_many(embedding_model, [text])[0]
+
+    def put_many(self, embedding_model, texts, vectors):
+        now = time.time()
+        rows = {}
+        for text, vector in zip(texts, vectors):
+            blob = array('f', vector).tobytes()
+            key = make_cache_key(embedding_model, text)
+            rows[key] = (key, blob, len(blob), now)
+        rows = list(rows.values())
+
+        with self.lock:
+            for start in range(0, len(rows), 500):
+                row_batch = rows[start:start + 500]
+                placeholders = ','.join('?' * len(row_batch))
+                # Entries being overwritten must not be counted twice in total_bytes
+                replaced = self.connection.execute(
+                    f"SELECT COALESCE(SUM(size), 0) FROM embeddings WHERE key IN ({placeholders})",
+                    [row[0] for row in row_batch]
+                ).fetchone()[0]
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vector, size, last_used) VALUES (?, ?, ?, ?)", row_batch
+                )
+                self.total_bytes += sum(row[2] for row in row_batch) - replaced
+
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+            self.connection.commit()
+
+    def put(self, embedding_model, text, vector):
+        self.put_many(embedding_model, [text], [vector])
+
+    def _evict(self):
+        target = int(self.max_bytes * 0.9)
+        while self.total_bytes > target:
+            rows = self.connection.execute(
+                "SELECT key, size FROM embeddings ORDER BY last_used LIMIT 1000"
+            ).fetchall()
+            if not rows:
+                self.total_bytes = 0
+                break
+
+            evicted = []
+            for key, size in rows:
+                evicted.append((key,))
+                self.total_bytes -= size
+                if self.total_bytes <= target:
+                    break
+            self.connection.executemany("DELETE FROM embeddings WHERE key = ?", evicted)
+            self.evictions += len(evicted)
+
+    def stats(self):
+        """Hit/miss counters and current size of the cache."""
+        with self.lock:
+            entries = self.connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'entries': entries,
+            'bytes': self.total_bytes,
+        }
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def get_default_cache():
+    """
+    Returns the process-wide embedding cache, opening it on first use.
+    The file lives at EMBEDDING_CACHE_PATH (relative paths are resolved from the project root).
+    """
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            script_directory = os.path.dirname(os.path.abspath(__file__))
+            project_root = os.path.abspath(os.path.join(script_directory, '..'))
+            path = os.path.join(project_root, os.getenv('EMBEDDING_CACHE_PATH', EMBEDDING_CACHE_PATH))
+            max_bytes = int(float(os.getenv('EMBEDDING_CACHE_MAX_MB', EMBEDDING_CACHE_MAX_MB)) * 1024 * 1024)
+            _default_cache = EmbeddingCache(path, max_bytes=max_bytes)
+        return _default_cache
+
+# Example usage:
+# cache = get_default_cache()
+# vector = cache.get(azure_openai_embedding_model, "Sample text")
+# print(cache.stats())
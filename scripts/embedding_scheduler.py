@@ -0,0 +1,166 @@
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import openai
+from scripts.embeddings import batch_texts_by_tokens, EMBEDDING_MAX_INPUT_TOKENS
+from scripts.tokenizer import fit_to_token_limit
+from scripts.embedding_cache import get_default_cache
+from scripts.resilience import get_retry_after
+
+# Default budget of the embedding deployment, overridable from the .env file
+EMBEDDING_TOKENS_PER_MINUTE = 120000
+EMBEDDING_REQUESTS_PER_MINUTE = 720
+EMBEDDING_MAX_WORKERS = 8
+
+
+class RateLimiter:
+    """Token bucket limiting both the requests and the tokens sent per minute."""
+
+    def __init__(self, tokens_per_minute, requests_per_minute):
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        self.available_tokens = tokens_per_minute
+        self.available_requests = requests_per_minute
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed_minutes = (now - self.last_refill) / 60
+        self.available_tokens = min(self.tokens_per_minute,
+                                    self.available_tokens + elapsed_minutes * self.tokens_per_minute)
+        self.available_requests = min(self.requests_per_minute,
+                                      self.available_requests + elapsed_minutes * self.requests_per_minute)
+        self.last_refill = now
+
+    def acquire(self, tokens):
+        """Blocks until one request carrying `tokens` tokens fits in the budget."""
+        # A batch larger than the whole budget would wait forever, so cap it at a full bucket
+        tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.available_tokens >= tokens and self.available_requests >= 1:
+                    self.available_tokens -= tokens
+                    self.available_requests -= 1
+                    return
+                missing_tokens = max(0, tokens - self.available_tokens)
+                missing_requests = max(0, 1 - self.available_requests)
+                wait = max(missing_tokens / self.tokens_per_minute, missing_requests / self.requests_per_minute) * 60
+            time.sleep(wait)
+
+
+class EmbeddingScheduler:
+    """
+    Runs embedding batches on a pool of worker threads under a tokens-per-minute and requests-per-minute budget.
+    The number of requests in flight starts at max_workers, is halved whenever the service answers 429
+    (all workers then pause for the Retry-After delay) and grows back by one after each run of successes.
+    """
+
+    def __init__(self, openai_client, embedding_model, tokens_per_minute=None, requests_per_minute=None,
+                 max_workers=None, max_retries=6, cache=None, max_input_tokens=EMBEDDING_MAX_INPUT_TOKENS):
+        tokens_per_minute = tokens_per_minute or int(os.getenv('EMBEDDING_TOKENS_PER_MINUTE',
+                                                               EMBEDDING_TOKENS_PER_MINUTE))
+        requests_per_minute = requests_per_minute or int(os.getenv('EMBEDDING_REQUESTS_PER_MINUTE',
+                                                                   EMBEDDING_REQUESTS_PER_MINUTE))
+        max_workers = max_workers or int(os.getenv('EMBEDDING_MAX_WORKERS', EMBEDDING_MAX_WORKERS))
+
+        self.openai_client = openai_client
+        self.embedding_model = embedding_model
+        self.cache = cache or get_default_cache()
+        self.rate_limiter = RateLimiter(tokens_per_minute, requests_per_minute)
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.max_input_tokens = max_input_tokens
+
+        self.concurrency = max_workers
+        self.in_flight = 0
+        self.resume_at = 0.0
+        self.successes_since_throttle = 0
+        self.throttled_count = 0
+        self.condition = threading.Condition()
+
+    def _acquire_slot(self):
+        with self.condition:
+            while True:
+                pause = self.resume_at - time.monotonic()
+                if pause > 0:
+                    self.condition.wait(pause)
+                elif self.in_flight >= self.concurrency:
+                    self.condition.wait()
+                else:
+                    self.in_flight += 1
+                    return
+
+    def _release_slot(self, throttled_for=None, succeeded=True):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled_for is not None:
+                self.throttled_count += 1
+                self.successes_since_throttle = 0
+                self.concurrency = max(1, self.concurrency // 2)
+                self.resume_at = max(self.resume_at, time.monotonic() + throttled_for)
+                print(f"Embedding requests throttled, pausing {throttled_for:.1f}s "
+                      f"with concurrency {self.concurrency}")
+            elif succeeded:
+                self.successes_since_throttle += 1
+                if self.concurrency < self.max_workers and self.successes_since_throttle >= self.concurrency:
+                    self.concurrency += 1
+                    self.successes_since_throttle = 0
+            self.condition.notify_all()
+
+    def _embed_batch(self, texts, batch, tokens):
+        attempt = 0
+        while True:
+            self._acquire_slot()
+            self.rate_limiter.acquire(tokens)
+            try:
+                response = self.openai_client.embeddings.create(
+                    input=[texts[position] for position in batch],
+                    model=self.embedding_model,
+                )
+            except openai.RateLimitError as e:
+                delay = get_retry_after(e) or min(60, 2 ** attempt) + random.random()
+                self._release_slot(throttled_for=delay)
+                error = e
+            except (openai.APIConnectionError, openai.InternalServerError) as e:
+                # Transient failures: back off this batch only, without touching the shared concurrency
+                self._release_slot(succeeded=False)
+                error = e
+                time.sleep(min(60, 2 ** attempt) + random.random())
+            else:
+                self._release_slot()
+                return batch, response
+
+            attempt += 1
+            if attempt > self.max_retries:
+                raise error
+
+    def embed(self, texts):
+        """
+        Embeds a list of texts concurrently, returning the vectors in the same order as the input texts.
+        Texts already in the embedding cache are not sent to the service, texts longer than max_input_tokens
+        are truncated before they are.
+        """
+        vectors = self.cache.get_many(self.embedding_model, texts)
+        missing = [position for position, vector in enumerate(vectors) if vector is None]
+        missing_texts = [texts[position] for position in missing]
+        request_texts, token_counts = fit_to_token_limit(missing_texts, self.max_input_tokens)
+        batches = batch_texts_by_tokens(request_texts, token_counts=token_counts)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self._embed_batch, request_texts, batch, tokens) for batch, tokens in batches]
+            for future in futures:
+                batch, response = future.result()
+                for item in response.data:
+                    vectors[missing[batch[item.index]]] = item.embedding
+                self.cache.put_many(self.embedding_model, [missing_texts[position] for position in batch],
+                                    [vectors[missing[position]] for position in batch])
+
+        return vectors
+
+# Example usage:
+# scheduler = EmbeddingScheduler(openai_client, azure_openai_embedding_model, tokens_per_minute=240000)
+# vectors = scheduler.embed(["Sample text", "Another text"])
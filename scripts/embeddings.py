@@ -1,11 +1,91 @@
+from scripts.tokenizer import num_tokens_from_strings, fit_to_token_limit
+from scripts.embedding_cache import get_default_cache
+from scripts.resilience import get_resilient_caller
 
-def get_embeddings_vector(text, openai_client, embedding_model):
-    response = openai_client.embeddings.create(
-        input=text,
+# Limits for a single input and a single embeddings.create request (text-embedding-ada-002)
+EMBEDDING_MAX_INPUT_TOKENS = 8191
+EMBEDDING_MAX_BATCH_TOKENS = 8191
+EMBEDDING_MAX_BATCH_SIZE = 2048
+
+
+def get_embeddings_vector(text, openai_client, embedding_model, cache=None,
+                          max_input_tokens=EMBEDDING_MAX_INPUT_TOKENS):
+    # Reuse the vector from the on-disk cache when this exact text was embedded before
+    cache = cache or get_default_cache()
+    embedding = cache.get(embedding_model, text)
+    if embedding is not None:
+        return embedding
+
+    # As in get_embeddings_vectors, a text longer than the input limit is truncated rather than rejected
+    (request_text,), _ = fit_to_token_limit([text], max_input_tokens)
+    response = get_resilient_caller('embeddings').call(
+        openai_client.embeddings.create,
+        input=request_text,
         model=embedding_model,
     )
     embedding = response.data[0].embedding
+    cache.put(embedding_model, text, embedding)
     return embedding
 
+
+def batch_texts_by_tokens(texts, max_batch_tokens=EMBEDDING_MAX_BATCH_TOKENS, max_batch_size=EMBEDDING_MAX_BATCH_SIZE,
+                          token_counts=None):
+    """
+    Groups texts into batches that stay under the token and input count limits of one embeddings request.
+    Each batch is a (positions, tokens) pair: the positions into `texts`, so results can be mapped back
+    in order, and the total token count of the batch. token_counts can be passed when already known.
+    """
+    if token_counts is None:
+        token_counts = num_tokens_from_strings(texts)
+
+    batches = []
+    current_batch = []
+    current_tokens = 0
+
+    for position, tokens in enumerate(token_counts):
+
+        if current_batch and (current_tokens + tokens > max_batch_tokens or len(current_batch) >= max_batch_size):
+            batches.append((current_batch, current_tokens))
+            current_batch = []
+            current_tokens = 0
+
+        # A text larger than the limit still gets its own batch
+        current_batch.append(position)
+        current_tokens += tokens
+
+    if current_batch:
+        batches.append((current_batch, current_tokens))
+
+    return batches
+
+
+def get_embeddings_vectors(texts, openai_client, embedding_model, cache=None,
+                           max_input_tokens=EMBEDDING_MAX_INPUT_TOKENS, max_batch_tokens=EMBEDDING_MAX_BATCH_TOKENS,
+                           max_batch_size=EMBEDDING_MAX_BATCH_SIZE):
+    """
+    Embeds a list of texts with as few embeddings.create calls as possible, skipping cached texts.
+    Texts longer than max_input_tokens are truncated. Returns the vectors in the same order as the input texts.
+    """
+    cache = cache or get_default_cache()
+    vectors = cache.get_many(embedding_model, texts)
+    missing = [position for position, vector in enumerate(vectors) if vector is None]
+    missing_texts = [texts[position] for position in missing]
+    request_texts, token_counts = fit_to_token_limit(missing_texts, max_input_tokens)
+
+    for batch, _ in batch_texts_by_tokens(request_texts, max_batch_tokens, max_batch_size, token_counts):
+        response = get_resilient_caller('embeddings').call(
+            openai_client.embeddings.create,
+            input=[request_texts[position] for position in batch],
+            model=embedding_model,
+        )
+        # response.data carries the index of each input within the request
+        for item in response.data:
+            vectors[missing[batch[item.index]]] = item.embedding
+        cache.put_many(embedding_model, [missing_texts[position] for position in batch],
+                       [vectors[missing[position]] for position in batch])
+
+    return vectors
+
 # Example usage:
 # vector = get_embeddings_vector("Sample text", openai_client, azure_openai_embedding_model)
+# vectors = get_embeddings_vectors(["Sample text", "Another text"], openai_client, azure_openai_embedding_model)
@@ -1,13 +1,52 @@
 
 import os
+import threading
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
 from openai import AzureOpenAI
+from azure.core.pipeline.transport import RequestsTransport
 from azure.search.documents import SearchClient
 from azure.search.documents.indexes import SearchIndexClient
 from azure.identity import DefaultAzureCredential
 from dotenv import load_dotenv, dotenv_values
 from azure.core.credentials import AzureKeyCredential
 
-def setup_clients():
+# Connection pool of the shared HTTP clients, overridable from the .env file
+CLIENT_POOL_SIZE = 20
+CLIENT_KEEPALIVE_SECONDS = 60
+CLIENT_TIMEOUT_SECONDS = 60
+
+_clients = None
+_clients_lock = threading.Lock()
+
+
+def make_http_clients(pool_size=CLIENT_POOL_SIZE, keepalive_seconds=CLIENT_KEEPALIVE_SECONDS,
+                      timeout_seconds=CLIENT_TIMEOUT_SECONDS):
+    """
+    Pooled HTTP clients to build the service clients on: an httpx.Client for Azure OpenAI and a requests
+    transport for Azure AI Search, each keeping up to pool_size connections alive between calls.
+    """
+    http_client = httpx.Client(
+        limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size,
+                            keepalive_expiry=keepalive_seconds),
+        timeout=httpx.Timeout(timeout_seconds, connect=10.0))
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    search_transport = RequestsTransport(session=session, session_owner=False,
+                                         connection_timeout=10, read_timeout=timeout_seconds)
+    return http_client, search_transport
+
+
+def setup_clients(http_client=None, search_transport=None):
+    """
+    Builds the OpenAI and search clients from the environment. http_client and search_transport, when given,
+    are the connection pools the clients send their requests through (see make_http_clients).
+    Use get_clients() to share one set of clients across the process.
+    """
     if os.path.exists('.env'):
         load_dotenv(override=True)
         config = dotenv_values('.env')
@@ -22,21 +61,71 @@ def setup_clients():
     search_customer_index_name = os.getenv('SEARCH_CUSTOMER_INDEX_NAME')
     search_crm_index_name = os.getenv('SEARCH_CRM_INDEX_NAME')
 
-    openai_client = AzureOpenAI(
-        azure_endpoint=azure_openai_endpoint,
-        api_key=azure_openai_api_key,
-        api_version="2024-06-01"
-    )
+    # OPENAI_BACKEND=local replaces Azure OpenAI with deterministic stand-ins, to run the pipeline offline
+    if os.getenv('OPENAI_BACKEND', 'azure') == 'local':
+        from scripts.local_backends import LocalOpenAI
+        openai_client = LocalOpenAI(latency_seconds=float(os.getenv('LOCAL_OPENAI_LATENCY_SECONDS', '0')))
+        azure_openai_embedding_model = azure_openai_embedding_model or 'local-embedding'
+    else:
+        openai_client = AzureOpenAI(
+            azure_endpoint=azure_openai_endpoint,
+            api_key=azure_openai_api_key,
+            # 2024-10-21 is the first GA version reporting token usage at the end of streamed completions
+            api_version="2024-10-21",
+            http_client=http_client,
+            # Retries are made by scripts.resilience only, not again inside the SDK
+            max_retries=0
+        )
+
+    # SEARCH_BACKEND=local answers searches in-process from the local chunk stores instead of Azure AI Search
+    if os.getenv('SEARCH_BACKEND', 'azure') == 'local':
+        from scripts.local_search import LocalSearchClient
+        project_root = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+        chunk_directory = os.path.join(project_root, os.getenv('LOCAL_SEARCH_CHUNK_DIRECTORY', 'data/chunks'))
+        use_ann = os.getenv('LOCAL_SEARCH_ANN', 'false').lower() == 'true'
+        nprobe = int(os.getenv('LOCAL_SEARCH_NPROBE', '8'))
+        search_customer_client = LocalSearchClient(os.path.join(chunk_directory, 'customer_store'),
+                                                   index_name=search_customer_index_name, use_ann=use_ann,
+                                                   nprobe=nprobe)
+        search_crm_client = LocalSearchClient(os.path.join(chunk_directory, 'crm_store'),
+                                              index_name=search_crm_index_name, use_ann=use_ann, nprobe=nprobe)
+        # The index schemas are inferred from the data, so the local stores can be chunked without Azure
+        from scripts.local_backends import LocalIndexClient
+        return (openai_client, search_customer_client, search_crm_client,
+                LocalIndexClient(project_root), azure_openai_embedding_model, search_customer_index_name,
+                search_crm_index_name, azure_search_service_admin_key)
 
     #credential = DefaultAzureCredential()
     credential = AzureKeyCredential(azure_search_service_admin_key)
-    search_customer_client = SearchClient(endpoint=azure_search_service_endpoint,
-                                 credential=credential, index_name=search_customer_index_name)
-    search_crm_client = SearchClient(endpoint=azure_search_service_endpoint,
-                                          credential=credential, index_name=search_crm_index_name)
+    # The three search clients share the transport, and so its connection pool
+    transport_kwargs = {'transport': search_transport} if search_transport is not None else {}
+    # As for OpenAI, the retry policy of azure-core is turned off: scripts.resilience is the only retry layer
+    search_customer_client = SearchClient(endpoint=azure_search_service_endpoint, credential=credential,
+                                          index_name=search_customer_index_name, retry_total=0, **transport_kwargs)
+    search_crm_client = SearchClient(endpoint=azure_search_service_endpoint, credential=credential,
+                                     index_name=search_crm_index_name, retry_total=0, **transport_kwargs)
     search_index_client = SearchIndexClient(endpoint=azure_search_service_endpoint,
-                                            credential=credential)
+                                            credential=credential, retry_total=0, **transport_kwargs)
 
     return (openai_client, search_customer_client, search_crm_client,
             search_index_client, azure_openai_embedding_model, search_customer_index_name,
             search_crm_index_name, azure_search_service_admin_key)
+
+
+def get_clients():
+    """
+    The process-wide clients, in the same tuple as setup_clients(). They are built once, on first use, over
+    pooled connections sized by CLIENT_POOL_SIZE / CLIENT_KEEPALIVE_SECONDS, so every later query reuses warm
+    connections. The clients are thread-safe and can be shared by concurrent sessions.
+    """
+    global _clients
+    with _clients_lock:
+        if _clients is None:
+            if os.path.exists('.env'):
+                load_dotenv(override=True)
+            http_client, search_transport = make_http_clients(
+                pool_size=int(os.getenv('CLIENT_POOL_SIZE', CLIENT_POOL_SIZE)),
+                keepalive_seconds=float(os.getenv('CLIENT_KEEPALIVE_SECONDS', CLIENT_KEEPALIVE_SECONDS)),
+                timeout_seconds=float(os.getenv('CLIENT_TIMEOUT_SECONDS', CLIENT_TIMEOUT_SECONDS)))
+            _clients = setup_clients(http_client=http_client, search_transport=search_transport)
+        return _clients
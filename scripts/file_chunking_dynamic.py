@@ -1,13 +1,24 @@
-import uuid
 import json
 import os
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents.indexes import SearchIndexClient
-from scripts.tokenizer import num_tokens_from_string
-from scripts.embeddings import get_embeddings_vector
+from scripts.embedding_scheduler import EmbeddingScheduler
+from scripts.chunk_manifest import make_document_id, load_manifest, save_manifest, apply_delta
+from scripts.chunk_store import ChunkStoreWriter, ChunkStoreReader, is_chunk_store
+from scripts.ann_index import update_ann_index
+from scripts.materialized_aggregates import MaterializedAggregates, update_aggregates
 from scripts.file_processing import clean_markdown_content
+from scripts.table_reader import iter_table_rows
+from scripts.resilience import get_resilient_caller
 from datetime import datetime
 
+# Number of rows read, embedded and written together while streaming an input file
+ROWS_PER_WINDOW = 2000
+
+# Business key of the rows in each kind of input file, used to build deterministic document ids
+CUSTOMER_KEY_FIELD = 'CustomerID'
+CRM_KEY_FIELD = 'OrderID'
+
 # Function to check if a string is a valid date (format: YYYY-MM-DD)
 def is_date(string):
     try:
@@ -34,7 +45,7 @@ def get_index_schema(search_client, index_name):
     Retrieves the schema of the specified Azure Search index and returns a dictionary
     mapping field names to their data types (e.g., Edm.String, Edm.Double).
     """
-    schema = search_client.get_index(index_name)
+    schema = get_resilient_caller('search_index').call(search_client.get_index, index_name)
     field_types = {}
 
     for field in schema.fields:
@@ -43,39 +54,100 @@ def get_index_schema(search_client, index_name):
     return field_types
 
 
-def cast_value_to_type(value, field_type):
-    """
-    Casts the given value to the type specified by the field_type.
-    For example, if the field_type is Edm.Double, cast the value to float.
-    """
+def _to_string(value):
     if value is None or value == '':
         return None  # Handle missing or empty values
+    return str(value)
+
+
+def _to_int(value):
+    if value is None or value == '':
+        return None
     try:
-        if field_type == "Edm.Int32":
-            return int(value)
-        elif field_type == "Edm.Double":
-            # Ensure the value is a valid float before casting
-            return float(value) if is_float(value) else value
-        elif field_type == 'Edm.Boolean':
-            return value.lower() in ('true', '1')
-        elif field_type == "Edm.String":
-            return str(value)
-        else:
-            # Default to string for unsupported types
-            return str(value)
+        return int(value)
     except ValueError as e:
-        print(f"Warning: Could not convert {value} to {field_type} due to {e}. Treating as string.")
+        print(f"Warning: Could not convert {value} to Edm.Int32 due to {e}. Treating as string.")
         return str(value)
 
-def is_float(value):
-    """
-    Helper function to check if a value can be converted to a float.
-    """
+
+def _to_float(value):
+    if value is None or value == '':
+        return None
+    # Values that are not valid floats are kept as they are
     try:
-        float(value)
-        return True
+        return float(value)
     except ValueError:
-        return False
+        return value
+
+
+def _to_bool(value):
+    if value is None or value == '':
+        return None
+    return value.lower() in ('true', '1')
+
+
+# Converter for each Edm type, anything else is treated as a string
+CONVERTERS = {
+    "Edm.Int32": _to_int,
+    "Edm.Double": _to_float,
+    "Edm.Boolean": _to_bool,
+    "Edm.String": _to_string,
+}
+
+
+def build_caster_plan(field_types):
+    """
+    Compiles the index schema (as returned by get_index_schema) into one converter per column,
+    so each cell is converted with a single function call instead of comparing type names.
+    """
+    return {field_name: CONVERTERS.get(field_type, _to_string) for field_name, field_type in field_types.items()}
+
+
+def cast_value_to_type(value, field_type):
+    """
+    Casts the given value to the type specified by the field_type.
+    For example, if the field_type is Edm.Double, cast the value to float.
+    """
+    return CONVERTERS.get(field_type, _to_string)(value)
+
+
+def cast_columns(columns, field_types):
+    """
+    Bulk version of the caster plan: converts whole columns at once with pandas.
+    columns is a DataFrame (or a dict of column name to list) of raw string values.
+    Returns the converted DataFrame and the bad cells as (row, column, value) tuples; bad numeric cells become NaN.
+    """
+    import pandas as pd
+
+    frame = pd.DataFrame(columns).copy()
+    bad_cells = []
+
+    for column_name in frame.columns:
+        field_type = field_types.get(column_name, "Edm.String")
+        raw = frame[column_name]
+        missing = raw.isna() | (raw.astype(str).str.strip() == '')
+
+        if field_type in ("Edm.Int32", "Edm.Double"):
+            converted = pd.to_numeric(raw, errors='coerce')
+            invalid = converted.isna() & ~missing
+            if field_type == "Edm.Int32":
+                fractional = converted.notna() & (converted % 1 != 0)
+                invalid |= fractional
+                converted = converted.where(~fractional).astype('Int32')
+            else:
+                converted = converted.astype('float64')
+        elif field_type == "Edm.Boolean":
+            lowered = raw.astype(str).str.strip().str.lower()
+            converted = lowered.isin(['true', '1']).astype('boolean').where(~missing)
+            invalid = ~missing & ~lowered.isin(['true', 'false', '1', '0'])
+        else:
+            converted = raw.where(~missing).astype('string')
+            invalid = pd.Series(False, index=raw.index)
+
+        bad_cells.extend((row, column_name, raw[row]) for row in raw.index[invalid])
+        frame[column_name] = converted
+
+    return frame, bad_cells
 
 def generate_customer_description(customer_data):
     """Generate a text description for a customer record."""
@@ -105,7 +177,46 @@ def generate_crm_description(crm_data):
     )
 
 
-def chunk_file(input_directory, output_directory, openai_client, embedding_model, search_client, index_name, max_tokens=8191):
+def iter_windows(items, size):
+    """Groups a stream of items into lists of at most size items."""
+    window = []
+    for item in items:
+        window.append(item)
+        if len(window) >= size:
+            yield window
+            window = []
+    if window:
+        yield window
+
+
+def iter_chunk_fields(chunk_directory, documents, document_ids, store=None):
+    """
+    Yields the fields of the given chunks, read from the chunk store when given, otherwise from the JSON chunk
+    files named in documents (document id -> file name).
+    """
+    if store is not None:
+        for _, record in store.iter_records():
+            if record['id'] in document_ids:
+                yield record['fields']
+        return
+    for document_id in document_ids:
+        chunk_path = os.path.join(chunk_directory, documents[document_id])
+        if os.path.exists(chunk_path):
+            with open(chunk_path, 'r', encoding='utf-8') as chunk_file:
+                yield json.load(chunk_file)['fields']
+
+
+def chunk_file(input_directory, output_directory, openai_client, embedding_model, search_client, index_name, max_tokens=8191,
+               tokens_per_minute=None, requests_per_minute=None, max_workers=None, output_format='json',
+               rows_per_window=ROWS_PER_WINDOW, build_ann_index=False, build_aggregates=True):
+    """
+    Chunks the markdown tables of input_directory into one chunk per row, with its fields, description and
+    embedding vector. output_format 'json' writes one JSON file per chunk into customer_chunks / crm_chunks,
+    'store' writes a columnar chunk store (float32 vectors.npy + records.jsonl) into customer_store / crm_store,
+    and with build_ann_index also keeps the store's approximate nearest neighbour index up to date.
+    With build_aggregates, the materialized pricing aggregates of each output directory are updated from the
+    rows added and removed by the run (see materialized_aggregates.py).
+    """
     # Get the absolute path of the directory where the script is located
     script_directory = os.path.dirname(os.path.abspath(__file__))
     print(f"Script is located in: {script_directory}")
@@ -127,10 +238,20 @@ def chunk_file(input_directory, output_directory, openai_client, embedding_model
     # Fetch the index schema from Azure Search
     field_types = get_index_schema(search_client, index_name)
     print(f"Field types: {field_types}")
+    caster_plan = build_caster_plan(field_types)
+
+    # Embedding requests run concurrently within the rate limits of the deployment
+    scheduler = EmbeddingScheduler(openai_client, embedding_model, tokens_per_minute=tokens_per_minute,
+                                   requests_per_minute=requests_per_minute, max_workers=max_workers,
+                                   max_input_tokens=max_tokens)
 
     # Create separate directories for Customer and CRM chunks if applicable
-    customer_output_dir = os.path.join(output_directory, 'customer_chunks')
-    crm_output_dir = os.path.join(output_directory, 'crm_chunks')
+    if output_format == 'store':
+        customer_output_dir = os.path.join(output_directory, 'customer_store')
+        crm_output_dir = os.path.join(output_directory, 'crm_store')
+    else:
+        customer_output_dir = os.path.join(output_directory, 'customer_chunks')
+        crm_output_dir = os.path.join(output_directory, 'crm_chunks')
 
     # Create directories if they don't exist
     if not os.path.exists(customer_output_dir):
@@ -141,7 +262,17 @@ def chunk_file(input_directory, output_directory, openai_client, embedding_model
     print(f"Chunking Files in: {input_directory}")
     print("***************")
 
-    chunk_index = 0
+    # Manifests of the chunk directories written by this run, and the documents each one now holds
+    manifests = {}
+    current_documents = {}
+    # In store format, the new snapshot of each store and the previous one unchanged vectors are copied from
+    store_writers = {}
+    previous_stores = {}
+    # Aggregates of each directory as of the previous run (None when it has none yet), to which the new rows
+    # are added window by window, and the number added
+    aggregates = {}
+    aggregated_counts = {}
+
     # List files in the directory and log them for debugging
     files_in_directory = os.listdir(input_directory)
     if not files_in_directory:
@@ -154,67 +285,138 @@ def chunk_file(input_directory, output_directory, openai_client, embedding_model
             if filename.endswith('.md'):
                 file_path = os.path.join(input_directory, filename)
                 print(f"Processing file: {file_path}")
-                with open(file_path, 'r', encoding='utf-8') as file:
-                    content = file.read()
-
-                    # Split content into rows
-                    rows = content.split('\n')
-
-                    # Parse the header, ensuring each column is treated as a single entity between pipes
-                    header = [h.strip() for h in rows[0].split('|') if h.strip()]  # Handle empty columns safely
-
-                    # Skip the second row (table separator) and process the data rows
-                    for row in rows[2:]:
-                        if not row.strip():  # Skip empty rows
-                            continue
-
-                        chunk_index += 1
-
-                        # Use the pipes to split row values correctly, handling multiword values.
-                        row_data = [r.strip() for r in row.split('|') if r.strip()]
-
-                        if len(row_data) != len(header):
-                            print(f"Skipping malformed row: {row}")
-                            continue
-
-                        # Initialize fields dictionary for this row
-                        fields = {}
-
-                        # Map header to row_data while maintaining the correct column-value mapping
-                        for i, column_name in enumerate(header):
-                            value = row_data[i] if i < len(row_data) else None  # Handle missing values
-                            fields[column_name] = cast_value_to_type(value, field_types.get(column_name, "Edm.String"))
-
-                        # Get the embedding vector for the chunk
-                        vector = get_embeddings_vector(json.dumps(fields), openai_client, embedding_model)
-
-                        # create the description for the chunk/row
-                        description = ""
-                        if 'customer' in filename.lower():
-                            description = generate_customer_description(fields)
-                        else:
-                            description = generate_crm_description(fields)
-
-                        # Create the chunk data
-                        chunk_data = {
-                            "id": str(uuid.uuid4()),
-                            'fields': fields,
-                            'description': description,
-                            'vector': vector
-                        }
-
-                        # Clean and format the chunk file name
-                        chunk_file_name = f'chunk_{chunk_index}_{filename.replace(".md", "")}.json'.replace('?', '').replace(':', '').replace("'", '').replace('|', '').replace('/', '').replace('\\', '')
-
-                        # Write chunk into JSON file in the appropriate directory (Customer or CRM based on file type)
-                        if 'customer' in filename.lower():
-                            output_dir = customer_output_dir
-                        else:
-                            output_dir = crm_output_dir
-
-                        with open(os.path.join(output_dir, chunk_file_name), 'w') as f:
-                            json.dump(chunk_data, f)
 
+                # Write chunks into the appropriate directory (Customer or CRM based on file type)
+                if 'customer' in filename.lower():
+                    output_dir = customer_output_dir
+                    key_field = CUSTOMER_KEY_FIELD
+                else:
+                    output_dir = crm_output_dir
+                    key_field = CRM_KEY_FIELD
+
+                if output_dir not in manifests:
+                    manifests[output_dir] = load_manifest(output_dir)
+                    current_documents[output_dir] = {}
+                    if build_aggregates:
+                        aggregates[output_dir] = MaterializedAggregates.load(output_dir)
+                        aggregated_counts[output_dir] = 0
+                    if output_format == 'store':
+                        previous_stores[output_dir] = ChunkStoreReader(output_dir) if is_chunk_store(output_dir) \
+                            else None
+                        store_writers[output_dir] = ChunkStoreWriter(output_dir)
+                known_documents = manifests[output_dir]['documents']
+                documents = current_documents[output_dir]
+                previous_store = previous_stores.get(output_dir)
+
+                # Stream the rows of the file in windows, so memory does not grow with the size of the file
+                embedded_count = 0
+                unchanged_count = 0
+                with open(file_path, 'rb') as file:
+                    for window in iter_windows(iter_table_rows(file, caster_plan), rows_per_window):
+                        file_rows = []
+                        changed_rows = []
+                        for _, fields in window:
+                            # Rows with the same key and content keep their id, so only new or changed rows are embedded
+                            document_id = make_document_id(fields, key_field)
+                            if document_id in documents:
+                                continue  # Exact duplicate of a row already seen in this run
+                            documents[document_id] = f'{document_id}.json'
+                            file_rows.append((document_id, fields))
+
+                            if output_format == 'store':
+                                unchanged = previous_store is not None and document_id in known_documents
+                            else:
+                                unchanged = known_documents.get(document_id) == documents[document_id] and \
+                                    os.path.exists(os.path.join(output_dir, documents[document_id]))
+                            if unchanged:
+                                unchanged_count += 1
+                                continue
+
+                            changed_rows.append((document_id, fields))
+                            # Without previous aggregates they are built from the chunks at the end of the run
+                            if aggregates.get(output_dir) is not None and document_id not in known_documents:
+                                aggregates[output_dir].add(fields)
+                                aggregated_counts[output_dir] += 1
+
+                        # Get the embedding vectors for the new chunks of the window in as few requests as possible
+                        vectors = scheduler.embed([json.dumps(fields) for _, fields in changed_rows])
+                        embedded_count += len(vectors)
+                        new_vectors = {document_id: vector for (document_id, _), vector in zip(changed_rows, vectors)}
+
+                        for document_id, fields in file_rows:
+                            # JSON chunks of unchanged rows are already on disk
+                            if output_format != 'store' and document_id not in new_vectors:
+                                continue
+
+                            # create the description for the chunk/row
+                            description = ""
+                            if 'customer' in filename.lower():
+                                description = generate_customer_description(fields)
+                            else:
+                                description = generate_crm_description(fields)
+
+                            # The store holds a full snapshot, with the vectors of unchanged rows taken from the previous one
+                            if output_format == 'store':
+                                vector = new_vectors.get(document_id)
+                                if vector is None:
+                                    vector = previous_store.get_vector(known_documents[document_id])
+                                documents[document_id] = store_writers[output_dir].append(document_id, fields,
+                                                                                          description, vector)
+                                continue
+                            vector = new_vectors[document_id]
+
+                            # Create the chunk data
+                            chunk_data = {
+                                "id": document_id,
+                                'fields': fields,
+                                'description': description,
+                                'vector': vector
+                            }
+
+                            with open(os.path.join(output_dir, documents[document_id]), 'w') as f:
+                                json.dump(chunk_data, f)
+
+                print(f"Embedded {embedded_count} new or changed rows from {filename}, {unchanged_count} unchanged "
+                      f"({scheduler.throttled_count} throttled requests so far)")
+
+    # Record the delta for the uploader and drop the chunks of rows that disappeared
+    for output_dir, manifest in manifests.items():
+        # The fields of removed rows are read before the previous chunks are replaced or deleted
+        # (a store without a previous snapshot has none to read)
+        removed_fields = []
+        if build_aggregates and (output_dir not in store_writers or previous_stores.get(output_dir) is not None):
+            removed_ids = set(manifest['documents']) - set(current_documents[output_dir])
+            removed_fields = list(iter_chunk_fields(output_dir, manifest['documents'], removed_ids,
+                                                    previous_stores.get(output_dir)))
+
+        if output_dir in store_writers:
+            store_writers[output_dir].close()
+        previous_documents = dict(manifest['documents'])
+        added, removed = apply_delta(manifest, current_documents[output_dir])
+        if build_aggregates:
+            documents = current_documents[output_dir]
+            update_aggregates(output_dir, aggregates[output_dir], removed_fields,
+                              lambda: iter_chunk_fields(output_dir, documents, set(documents),
+                                                        ChunkStoreReader(output_dir) if output_dir in store_writers
+                                                        else None),
+                              added_count=aggregated_counts[output_dir])
+        if output_dir in store_writers:
+            if build_ann_index:
+                update_ann_index(output_dir, added, removed)
+            save_manifest(output_dir, manifest)
+            print(f"{output_dir}: {len(added)} added, {len(removed)} removed, "
+                  f"{len(manifest['pending_upserts'])} pending upserts, "
+                  f"{len(manifest['pending_deletes'])} pending deletes")
+            continue
+        for document_id in removed:
+            removed_path = os.path.join(output_dir, previous_documents[document_id])
+            if os.path.exists(removed_path):
+                os.remove(removed_path)
+        save_manifest(output_dir, manifest)
+        print(f"{output_dir}: {len(added)} added, {len(removed)} removed, "
+              f"{len(manifest['pending_upserts'])} pending upserts, {len(manifest['pending_deletes'])} pending deletes")
+
+    print(f"Embedding cache: {scheduler.cache.stats()}")
     print("***************")
 
 
@@ -1,7 +1,7 @@
 
 import os
 import re
-from scripts.tokenizer import num_tokens_from_string
+from scripts.tokenizer import num_tokens_from_string, split_by_tokens
 
 def clean_markdown_content(content: str) -> str:
     # Remove links
@@ -18,16 +18,25 @@ def clean_markdown_content(content: str) -> str:
 
     return content
 
-def process_markdown_files(input_directory: str):
-    i = 0
+def process_markdown_files(input_directory: str, max_tokens: int = 8191):
+    """
+    Reads the markdown files of a directory and returns their content as pieces that fit in max_tokens,
+    as a dict of file name to list of pieces. Files over the limit are split instead of being rejected later by the API.
+    """
+    pieces = {}
     for filename in os.listdir(input_directory):
         if filename.endswith('.md'):
             file_path = os.path.join(input_directory, filename)
             with open(file_path, 'r', encoding='utf-8') as file:
                 content = file.read()
                 tokens = num_tokens_from_string(content)
-                if tokens > 8191:
-                    print(f'File {filename} has {tokens} tokens which is more than 8191 (max) tokens')
+                if tokens > max_tokens:
+                    pieces[filename] = split_by_tokens(content, max_tokens)
+                    print(f'File {filename} has {tokens} tokens which is more than {max_tokens} (max) tokens, '
+                          f'split into {len(pieces[filename])} pieces')
+                else:
+                    pieces[filename] = [content]
+    return pieces
 
 # Example usage:
 # process_markdown_files('./data/azure-ai-docs/')
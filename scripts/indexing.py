@@ -16,6 +16,7 @@ from azure.search.documents.indexes.models import (
 )
 import os
 from dotenv import load_dotenv
+from scripts.resilience import get_resilient_caller
 
 def create_mithril_index(type):
 
@@ -88,7 +89,7 @@ def create_customer_index(customer_index_name, search_index_client):
     customer_index = SearchIndex(name=customer_index_name, fields=fields, vector_search=vector_search,
                                  semantic_search=semantic_search)
 
-    result = search_index_client.create_or_update_index(customer_index)
+    result = get_resilient_caller('search_index').call(search_index_client.create_or_update_index, customer_index)
     print(f'Customer Index {result.name} created')
     return result
 
@@ -157,7 +158,7 @@ def create_crm_index(crm_index_name, search_index_client):
     crm_index = SearchIndex(name=crm_index_name, fields=fields, vector_search=vector_search,
                             semantic_search=semantic_search)
 
-    result = search_index_client.create_or_update_index(crm_index)
+    result = get_resilient_caller('search_index').call(search_index_client.create_or_update_index, crm_index)
     print(f'CRM Index {result.name} created')
     return result
 
@@ -0,0 +1,190 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the latency histogram buckets, and the number of recent observations the
+# percentiles are computed over
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+METRICS_SAMPLE_SIZE = 2048
+PERCENTILES = (0.5, 0.95, 0.99)
+
+_default_metrics = None
+_default_metrics_lock = threading.Lock()
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+class Histogram:
+    """Cumulative bucket counts and sum of the observations, as Prometheus has them, plus a window of recent
+    observations for the percentiles."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS, sample_size=METRICS_SAMPLE_SIZE):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.samples = deque(maxlen=sample_size)
+
+    def observe(self, value):
+        self.bucket_counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.samples.append(value)
+
+    def summary(self):
+        summary = {'count': self.count, 'sum': self.sum}
+        for fraction in PERCENTILES:
+            summary[f"p{int(fraction * 100)}"] = percentile(self.samples, fraction)
+        return summary
+
+
+class Metrics:
+    """
+    Counters and histograms of the pipeline, keyed by name and labels, e.g.
+    metrics.increment('rag_documents_retrieved_total', 12, index='crm') or
+    metrics.observe('rag_stage_seconds', 0.3, stage='search'). span() times a block into rag_stage_seconds.
+    Exported as Prometheus text (to_prometheus) or JSON lines (to_json_lines).
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def span(self, stage, timings=None, **labels):
+        """
+        Times a stage of a request into the rag_stage_seconds histogram, and into timings[stage] when a dict
+        is given (the timings of that request). Failed stages are timed as well, with status="error".
+        """
+        started = time.perf_counter()
+        status = 'ok'
+        try:
+            yield
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            seconds = time.perf_counter() - started
+            self.observe('rag_stage_seconds', seconds, stage=stage, status=status, **labels)
+            if timings is not None:
+                timings[stage] = timings.get(stage, 0.0) + seconds
+
+    def snapshot(self):
+        """The current value of every counter and the summary (count, sum, p50/p95/p99) of every histogram."""
+        with self.lock:
+            counters = [{'name': name, 'labels': dict(labels), 'type': 'counter', 'value': value}
+                        for (name, labels), value in sorted(self.counters.items())]
+            histograms = [dict({'name': name, 'labels': dict(labels), 'type': 'histogram'}, **histogram.summary())
+                          for (name, labels), histogram in sorted(self.histograms.items())]
+        return counters + histograms
+
+    def to_json_lines(self):
+        timestamp = time.time()
+        return ''.join(json.dumps(dict(metric, timestamp=timestamp)) + '\n' for metric in self.snapshot())
+
+    def write_json_lines(self, path):
+        """Appends the current metrics to a JSON lines file, one line per series."""
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(self.to_json_lines())
+
+    def to_prometheus(self):
+        """The metrics in the Prometheus text exposition format; percentiles are exported as gauges."""
+        lines = []
+        with self.lock:
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} counter")
+                    typed.add(name)
+                lines.append(f"{name}{format_labels(labels)} {value}")
+
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} histogram")
+                    typed.add(name)
+                cumulative = 0
+                bounds = [str(bound) for bound in histogram.buckets] + ['+Inf']
+                for bound, count in zip(bounds, histogram.bucket_counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                for fraction in PERCENTILES:
+                    value = percentile(histogram.samples, fraction)
+                    if value is not None:
+                        gauge = f"{name}_p{int(fraction * 100)}"
+                        if gauge not in typed:
+                            lines.append(f"# TYPE {gauge} gauge")
+                            typed.add(gauge)
+                        lines.append(f"{gauge}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+def get_default_metrics():
+    """The process-wide metrics of the pipeline."""
+    global _default_metrics
+    with _default_metrics_lock:
+        if _default_metrics is None:
+            _default_metrics = Metrics()
+        return _default_metrics
+
+
+def record_usage(usage, model=None):
+    """Counts the prompt and completion tokens of a chat completion (usage as a dict)."""
+    if not usage:
+        return
+    metrics = get_default_metrics()
+    labels = {'model': model} if model else {}
+    metrics.increment('rag_prompt_tokens_total', usage.get('prompt_tokens') or 0, **labels)
+    metrics.increment('rag_completion_tokens_total', usage.get('completion_tokens') or 0, **labels)
+    metrics.increment('rag_completions_total', **labels)
+
+
+def write_metrics_file(path=None):
+    """Appends the metrics to METRICS_JSONL_PATH (or path) as JSON lines, if one is set."""
+    path = path or os.getenv('METRICS_JSONL_PATH')
+    if path:
+        get_default_metrics().write_json_lines(path)
+
+# Example usage:
+# metrics = get_default_metrics()
+# with metrics.span('search', timings):
+#     results = fan_out_search(searches)
+# print(metrics.to_prometheus())
@@ -0,0 +1,195 @@
+import functools
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from types import SimpleNamespace
+import numpy as np
+
+# Dimensions of the stand-in embeddings, the same as text-embedding-ada-002
+LOCAL_EMBEDDING_DIMENSIONS = 1536
+
+
+class LocalUsage(SimpleNamespace):
+    def model_dump(self):
+        return dict(self.__dict__)
+
+
+class LocalCompletion(SimpleNamespace):
+    def model_dump(self):
+        return {
+            'model': self.model,
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': self.choices[0].message.content}}],
+            'usage': self.usage.model_dump(),
+        }
+
+
+def count_words(text):
+    return len(text.split())
+
+
+@functools.lru_cache(maxsize=65536)
+def word_vector(word, dimensions):
+    seed = int.from_bytes(hashlib.sha256(word.encode('utf-8')).digest()[:8], 'little')
+    vector = np.random.default_rng(seed).standard_normal(dimensions).astype(np.float32)
+    vector.flags.writeable = False
+    return vector
+
+
+class LocalEmbeddings:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def embed(self, text):
+        """
+        Deterministic embedding of a text: the normalized sum of a pseudo-random vector per word,
+        so that texts sharing words are close, as with a real embedding model.
+        """
+        vector = np.zeros(self.backend.dimensions, dtype=np.float32)
+        for word in re.findall(r'\w+', text.lower()):
+            vector += word_vector(word, self.backend.dimensions)
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def create(self, input, model, **kwargs):
+        texts = input if isinstance(input, list) else [input]
+        self.backend.wait()
+        data = [SimpleNamespace(index=position, embedding=self.embed(text)) for position, text in enumerate(texts)]
+        tokens = sum(count_words(text) for text in texts)
+        return SimpleNamespace(data=data, model=model,
+                               usage=LocalUsage(prompt_tokens=tokens, total_tokens=tokens))
+
+
+class LocalChatCompletions:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def answer(self, messages, response_format=None):
+        if response_format and response_format.get('type') == 'json_object':
+            # No query plans: questions go through retrieval
+            return json.dumps({'analytics': False})
+        question = next((message['content'] for message in messages if message['role'] == 'user'), '')
+        context = [message['content'] for message in messages if message['role'] == 'system'][1:]
+        lines = [line for text in context for line in text.split('\n') if line.strip()]
+        first_line = lines[0][:300] if lines else 'no context'
+        return f"Local answer to \"{question}\" from {len(lines)} lines of context. First: {first_line}"
+
+    def create(self, model, messages, stream=False, stream_options=None, response_format=None, **kwargs):
+        content = self.answer(messages, response_format)
+        prompt_tokens = sum(count_words(message['content']) for message in messages)
+        usage = LocalUsage(prompt_tokens=prompt_tokens, completion_tokens=count_words(content),
+                           total_tokens=prompt_tokens + count_words(content))
+        self.backend.wait()
+
+        if not stream:
+            return LocalCompletion(model=model, usage=usage,
+                                   choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+        def chunks():
+            words = content.split(' ')
+            for position, word in enumerate(words):
+                text = word if position == 0 else ' ' + word
+                yield SimpleNamespace(model=model, usage=None,
+                                      choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])
+                if self.backend.token_latency_seconds:
+                    time.sleep(self.backend.token_latency_seconds)
+            if stream_options and stream_options.get('include_usage'):
+                yield SimpleNamespace(model=model, usage=usage, choices=[])
+        return chunks()
+
+
+class LocalOpenAI:
+    """
+    Stand-in for the AzureOpenAI client, to run the pipeline without the service: deterministic word-hash
+    embeddings, and chat completions that describe the context they were given (streamed word by word).
+    latency_seconds is added to every request and token_latency_seconds between streamed words,
+    to mimic the service.
+    """
+
+    def __init__(self, dimensions=LOCAL_EMBEDDING_DIMENSIONS, latency_seconds=0.0, token_latency_seconds=0.0):
+        self.dimensions = dimensions
+        self.latency_seconds = latency_seconds
+        self.token_latency_seconds = token_latency_seconds
+        self.embeddings = LocalEmbeddings(self)
+        self.chat = SimpleNamespace(completions=LocalChatCompletions(self))
+
+    def wait(self):
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+
+
+class LocalIndexClient:
+    """
+    Stand-in for the SearchIndexClient: get_index() describes the fields of the customer or CRM index with
+    the types inferred from the markdown tables, as chunk_file needs them.
+    """
+
+    def __init__(self, project_root=None):
+        self.project_root = project_root or os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                         '..'))
+
+    def get_index(self, index_name):
+        from scripts.analytics import ANALYTICS_TABLES, load_table
+
+        table = 'customers' if 'customer' in (index_name or '').lower() else 'crm'
+        frame = load_table(os.path.join(self.project_root, ANALYTICS_TABLES[table]))
+        fields = []
+        for column_name in frame.columns:
+            dtype = str(frame[column_name].dtype)
+            field_type = "Edm.Int32" if dtype == 'Int32' else "Edm.Double" if dtype == 'float64' else "Edm.String"
+            fields.append(SimpleNamespace(name=column_name, type=field_type))
+        return SimpleNamespace(name=index_name, fields=fields)
+
+class LocalIndexingResult(SimpleNamespace):
+    pass
+
+
+class LocalUploadClient:
+    """
+    Stand-in for the SearchClient of an index on the upload side: merge_or_upload_documents and delete_documents
+    keep the documents in memory and report every one as succeeded, after latency_seconds per request.
+    """
+
+    def __init__(self, latency_seconds=0.0):
+        self.latency_seconds = latency_seconds
+        self.documents = {}
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def _index(self, documents, delete=False):
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        with self.lock:
+            self.requests += 1
+            for document in documents:
+                if delete:
+                    self.documents.pop(document['id'], None)
+                else:
+                    self.documents[document['id']] = document
+        return [LocalIndexingResult(key=document['id'], succeeded=True, status_code=200, error_message=None)
+                for document in documents]
+
+    def merge_or_upload_documents(self, documents, **kwargs):
+        return self._index(documents)
+
+    def delete_documents(self, documents, **kwargs):
+        return self._index(documents, delete=True)
+
+
+class LatencySearchClient:
+    """Wraps a search client (e.g. LocalSearchClient), adding latency_seconds to every search."""
+
+    def __init__(self, search_client, latency_seconds=0.0):
+        self.search_client = search_client
+        self.latency_seconds = latency_seconds
+
+    def search(self, **kwargs):
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        return self.search_client.search(**kwargs)
+
+# Example usage:
+# openai_client = LocalOpenAI(latency_seconds=0.05)
+# vector = openai_client.embeddings.create(input="Average price in Winter", model="local").data[0].embedding
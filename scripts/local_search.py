@@ -0,0 +1,201 @@
+import json
+import os
+import re
+import numpy as np
+from scripts.chunk_manifest import MANIFEST_FILE_NAME
+from scripts.materialized_aggregates import AGGREGATES_FILE_NAME
+from scripts.chunk_store import ChunkStoreReader, is_chunk_store
+from scripts.ann_index import IVFIndex, ANN_DIRECTORY_NAME, DEFAULT_NPROBE, encode_ids
+
+# OData comparisons supported in filters, e.g. "CSU eq 'East' and Quantity ge 5"
+FILTER_CLAUSE_PATTERN = re.compile(r"^\s*(\w+)\s+(eq|ne|gt|ge|lt|le)\s+('(?:[^']|'')*'|[-+\w.]+)\s*$")
+
+
+def parse_filter_value(literal):
+    if literal.startswith("'"):
+        return literal[1:-1].replace("''", "'")
+    if literal in ('true', 'false'):
+        return literal == 'true'
+    if literal == 'null':
+        return None
+    return float(literal)
+
+
+def load_chunk_documents(chunk_directory):
+    """
+    Loads the chunks of a chunk store or of a directory of JSON chunks.
+    Returns the documents (fields, id and description) and their vectors as a float32 matrix.
+    """
+    if is_chunk_store(chunk_directory):
+        reader = ChunkStoreReader(chunk_directory)
+        documents = []
+        for _, record in reader.iter_records():
+            document = record['fields']
+            document['id'] = record['id']
+            document['description'] = record['description']
+            documents.append(document)
+        return documents, np.array(reader.vectors, dtype=np.float32)
+
+    documents = []
+    vectors = []
+    # A directory not chunked yet is an empty index
+    for filename in sorted(os.listdir(chunk_directory)) if os.path.isdir(chunk_directory) else []:
+        if filename.endswith('.json') and filename not in (MANIFEST_FILE_NAME, AGGREGATES_FILE_NAME):
+            with open(os.path.join(chunk_directory, filename), 'r', encoding='utf-8') as chunk_file:
+                chunk_data = json.load(chunk_file)
+            document = chunk_data['fields']
+            document['id'] = chunk_data['id']
+            document['description'] = chunk_data['description']
+            documents.append(document)
+            vectors.append(chunk_data['vector'])
+    if not vectors:
+        return documents, np.zeros((0, 0), dtype=np.float32)
+    return documents, np.array(vectors, dtype=np.float32)
+
+
+class LocalSearchClient:
+    """
+    In-process exact vector search over a local chunk directory, answering the same search() calls as
+    azure.search.documents.SearchClient for vector queries with OData equality/range filters.
+    Vectors are kept L2-normalized in one matrix, so the cosine similarities of a query against the whole
+    corpus are a single matrix-vector product.
+    With use_ann, queries go through the chunk store's persisted IVF index (see ann_index.py) instead,
+    scoring only the nprobe closest clusters.
+    """
+
+    def __init__(self, chunk_directory, index_name=None, use_ann=False, nprobe=DEFAULT_NPROBE):
+        self.chunk_directory = chunk_directory
+        self.index_name = index_name or os.path.basename(os.path.normpath(chunk_directory))
+        self.documents, vectors = load_chunk_documents(chunk_directory)
+
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        self.vectors = vectors / norms
+
+        self.columns = {}
+        self.filter_masks = {}
+
+        self.ann_index = None
+        self.nprobe = nprobe
+        ann_directory = os.path.join(chunk_directory, ANN_DIRECTORY_NAME)
+        if use_ann and os.path.exists(os.path.join(ann_directory, 'meta.json')):
+            self.ann_index = IVFIndex.load(ann_directory)
+            self.position_of = {document['id']: position for position, document in enumerate(self.documents)}
+            self.document_ids = encode_ids(document['id'] for document in self.documents)
+        print(f"Loaded {len(self.documents)} chunks from {chunk_directory} for local search"
+              f"{' with ANN index' if self.ann_index is not None else ''}")
+
+    def get_document_count(self):
+        return len(self.documents)
+
+    def _column(self, field_name):
+        if field_name not in self.columns:
+            self.columns[field_name] = np.array([document.get(field_name) for document in self.documents],
+                                                dtype=object)
+        return self.columns[field_name]
+
+    def _filter_mask(self, filter_expression):
+        """Evaluates a filter into a boolean mask over the documents, cached per filter expression."""
+        if filter_expression in self.filter_masks:
+            return self.filter_masks[filter_expression]
+
+        mask = np.ones(len(self.documents), dtype=bool)
+        for clause in re.split(r'\s+and\s+', filter_expression.strip(), flags=re.IGNORECASE):
+            match = FILTER_CLAUSE_PATTERN.match(clause)
+            if not match:
+                raise ValueError(f"Unsupported filter clause for local search: {clause}")
+            field_name, operator, literal = match.groups()
+            column = self._column(field_name)
+            value = parse_filter_value(literal)
+
+            if operator == 'eq':
+                mask &= column == value
+            elif operator == 'ne':
+                mask &= column != value
+            else:
+                numeric = np.array([item if isinstance(item, (int, float)) else np.nan for item in column],
+                                   dtype=float)
+                with np.errstate(invalid='ignore'):
+                    if operator == 'gt':
+                        mask &= numeric > value
+                    elif operator == 'ge':
+                        mask &= numeric >= value
+                    elif operator == 'lt':
+                        mask &= numeric < value
+                    else:
+                        mask &= numeric <= value
+
+        if len(self.filter_masks) >= 256:
+            self.filter_masks.clear()
+        self.filter_masks[filter_expression] = mask
+        return mask
+
+    def _result(self, position, score, select):
+        document = self.documents[position]
+        if select:
+            result = {field_name: document.get(field_name) for field_name in select}
+        else:
+            result = dict(document)
+        result['@search.score'] = score
+        return result
+
+    def search(self, search_text=None, vector_queries=None, filter=None, select=None, top=None, **kwargs):
+        """
+        Returns the top matches of the vector queries as a list of dicts, best first, with their '@search.score'.
+        As in Azure AI Search, filters are applied before the nearest neighbours are selected.
+        """
+        if search_text not in (None, '', '*'):
+            raise ValueError("Local search only supports vector queries")
+
+        mask = self._filter_mask(filter) if filter else np.ones(len(self.documents), dtype=bool)
+        candidates = np.flatnonzero(mask)
+
+        if not vector_queries:
+            limit = top or 50
+            return [self._result(position, 1.0, select) for position in candidates[:limit]]
+
+        if len(candidates) == 0:
+            return []
+        if self.ann_index is not None:
+            return self._search_ann(vector_queries, mask if filter else None, select, top)
+
+        # Several vector queries are combined by summing their scores
+        scores = np.zeros(len(candidates), dtype=np.float32)
+        k = 0
+        for vector_query in vector_queries:
+            query = np.asarray(vector_query.vector, dtype=np.float32)
+            norm = np.linalg.norm(query)
+            if norm:
+                query = query / norm
+            similarities = self.vectors[candidates] @ query if len(candidates) < len(self.documents) \
+                else self.vectors @ query
+            # Same scale as the service for cosine: 1 / (1 + cosine distance)
+            scores += 1.0 / (2.0 - similarities)
+            k = max(k, vector_query.k_nearest_neighbors or 50)
+
+        limit = min(top or k, len(candidates))
+        if limit == 0:
+            return []
+        best = np.argpartition(-scores, limit - 1)[:limit]
+        best = best[np.argsort(-scores[best])]
+        return [self._result(candidates[position], float(scores[position]), select) for position in best]
+
+    def _search_ann(self, vector_queries, mask, select, top):
+        allowed_ids = self.document_ids[mask] if mask is not None else None
+        scores = {}
+        k = 0
+        for vector_query in vector_queries:
+            k = max(k, vector_query.k_nearest_neighbors or 50)
+            ids, similarities = self.ann_index.search(vector_query.vector, k=top or k, nprobe=self.nprobe,
+                                                      allowed_ids=allowed_ids)
+            for document_id, similarity in zip(ids, similarities):
+                if document_id in self.position_of:
+                    scores[document_id] = scores.get(document_id, 0.0) + 1.0 / (2.0 - float(similarity))
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top or k]
+        return [self._result(self.position_of[document_id], score, select) for document_id, score in ranked]
+
+# Example usage:
+# local_client = LocalSearchClient('data/chunks/crm_store')
+# results = local_client.search(search_text=None, vector_queries=[vector_query], filter="CSU eq 'East'",
+#                               select=["OrderID", "description"])
@@ -43,15 +43,15 @@ def main():
     # Call chunking for Customer data
     print("Step 2: Chunking files")
     chunk_file('data/customers', 'data/chunks', openai_client, azure_openai_embedding_model,
-               search_index_client, search_customer_index_name)
+               search_index_client, search_customer_index_name, output_format='store', build_ann_index=True)
 
     # Call chunking for CRM data
     chunk_file('data/crm', 'data/chunks', openai_client, azure_openai_embedding_model,
-               search_index_client, search_crm_index_name)
+               search_index_client, search_crm_index_name, output_format='store', build_ann_index=True)
 
     print("Step 3: uploading chunks to Azure AI Search")
-    #upload_chunks_to_search(search_customer_client, 'data/chunks/customer_chunks')
-    #upload_chunks_to_search(search_crm_client, 'data/chunks/crm_chunks')
+    #upload_chunks_to_search(search_customer_client, 'data/chunks/customer_store')
+    #upload_chunks_to_search(search_crm_client, 'data/chunks/crm_store')
 
     # Step 3: Simulate a user query
     query = "Explain Azure AI"
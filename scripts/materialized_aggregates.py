@@ -0,0 +1,259 @@
+import json
+import os
+import re
+import threading
+from scripts.tokenizer import num_tokens_from_string
+
+AGGREGATES_FILE_NAME = 'aggregates.json'
+
+# Dimensions the aggregates are grouped by, each within a CSU; Lane is DeliveryFrom->DeliveryTo
+DIMENSIONS = ['Mine', 'MineLocation', 'Season', 'Region', 'Lane']
+MEASURES = ['PricePerUnitUSD', 'AdjustedPricePerUnitUSD', 'TotalPriceUSD', 'Quantity', 'MineCapacity', 'DemandIndex',
+            'SupplyIndex', 'GeopoliticalIndex', 'EconomicHealthIndex', 'TransportationCostUSD']
+# Groupings shown when the question names a measure but no dimension, and measures shown when it names a
+# dimension but no measure
+DEFAULT_CONTEXT_GROUPINGS = ['CSU', 'CSU|Season', 'CSU|Mine']
+DEFAULT_CONTEXT_MEASURES = ['AdjustedPricePerUnitUSD', 'PricePerUnitUSD', 'Quantity', 'TotalPriceUSD']
+AGGREGATE_CONTEXT_MAX_ROWS = 40
+
+_default_aggregates = {}
+_default_aggregates_lock = threading.Lock()
+
+
+def row_dimensions(fields):
+    dimensions = {name: fields.get(name) for name in ['CSU'] + DIMENSIONS if fields.get(name) is not None}
+    if fields.get('DeliveryFrom') is not None and fields.get('DeliveryTo') is not None:
+        dimensions['Lane'] = f"{fields['DeliveryFrom']}->{fields['DeliveryTo']}"
+    return dimensions
+
+
+def group_keys(fields):
+    """The (grouping, key) pairs a row counts towards: its CSU, and its CSU with each of its dimensions."""
+    dimensions = row_dimensions(fields)
+    csu = dimensions.get('CSU')
+    if csu is None:
+        return []
+    keys = [('CSU', str(csu))]
+    for name in DIMENSIONS:
+        if name in dimensions:
+            keys.append((f"CSU|{name}", f"{csu}|{dimensions[name]}"))
+    return keys
+
+
+def row_measures(fields):
+    return {name: float(fields[name]) for name in MEASURES
+            if isinstance(fields.get(name), (int, float)) and not isinstance(fields.get(name), bool)}
+
+
+class MaterializedAggregates:
+    """
+    Count, sum, min and max of the pricing measures for each CSU and each CSU x dimension value, maintained
+    incrementally: add() and remove() adjust the group of every row that enters or leaves the data.
+    A removal can not update a min or max it equals, so the group is flagged stale until refresh_stale()
+    recomputes it from the current rows. Stored as one JSON file next to the chunks.
+    """
+
+    def __init__(self, groups=None):
+        # grouping -> key -> {'count': rows, 'measures': {measure: {'count', 'sum', 'min', 'max'}}, 'stale': bool}
+        self.groups = groups or {}
+
+    def _group(self, grouping, key):
+        return self.groups.setdefault(grouping, {}).setdefault(key, {'count': 0, 'measures': {}, 'stale': False})
+
+    def add(self, fields):
+        measures = row_measures(fields)
+        for grouping, key in group_keys(fields):
+            group = self._group(grouping, key)
+            group['count'] += 1
+            for name, value in measures.items():
+                measure = group['measures'].setdefault(name, {'count': 0, 'sum': 0.0, 'min': value, 'max': value})
+                measure['count'] += 1
+                measure['sum'] += value
+                measure['min'] = min(measure['min'], value)
+                measure['max'] = max(measure['max'], value)
+
+    def remove(self, fields):
+        measures = row_measures(fields)
+        for grouping, key in group_keys(fields):
+            group = self.groups.get(grouping, {}).get(key)
+            if group is None:
+                continue
+            group['count'] -= 1
+            if group['count'] <= 0:
+                del self.groups[grouping][key]
+                continue
+            for name, value in measures.items():
+                measure = group['measures'].get(name)
+                if measure is None:
+                    continue
+                measure['count'] -= 1
+                measure['sum'] -= value
+                if measure['count'] <= 0:
+                    del group['measures'][name]
+                elif value <= measure['min'] or value >= measure['max']:
+                    group['stale'] = True
+
+    def stale_keys(self):
+        return {(grouping, key) for grouping, groups in self.groups.items() for key, group in groups.items()
+                if group['stale']}
+
+    def refresh_stale(self, rows):
+        """Recomputes the stale groups from an iterable of the fields of all current rows."""
+        stale = self.stale_keys()
+        if not stale:
+            return 0
+        rebuilt = MaterializedAggregates()
+        for fields in rows:
+            if any(group_key in stale for group_key in group_keys(fields)):
+                rebuilt.add(fields)
+        for grouping, key in stale:
+            self.groups[grouping][key] = rebuilt.groups.get(grouping, {}).get(key) or \
+                {'count': 0, 'measures': {}, 'stale': False}
+        return len(stale)
+
+    def rows(self, grouping, csu_name=None):
+        """Aggregate rows of a grouping (optionally of one CSU), with the mean of each measure."""
+        rows = []
+        for key, group in sorted(self.groups.get(grouping, {}).items()):
+            values = key.split('|')
+            if csu_name is not None and values[0] != csu_name:
+                continue
+            row = dict(zip(grouping.split('|'), values))
+            row['count'] = group['count']
+            for name, measure in group['measures'].items():
+                row[name] = {'mean': measure['sum'] / measure['count'], 'min': measure['min'],
+                             'max': measure['max'], 'sum': measure['sum']}
+            rows.append(row)
+        return rows
+
+    def save(self, directory):
+        path = os.path.join(directory, AGGREGATES_FILE_NAME)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.groups, f)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, directory):
+        """Loads the aggregates of a chunk directory, or returns None if it has none yet."""
+        path = os.path.join(directory, AGGREGATES_FILE_NAME)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls(json.load(f))
+
+
+def update_aggregates(directory, aggregates, removed_rows, current_rows, added_count=0):
+    """
+    Brings the aggregates of a chunk directory in line with an ingestion run. aggregates are those of the
+    directory before the run (None if it had none yet), to which the run already added its added_count new rows
+    as it emitted them; removed_rows are the fields of the rows it removed. current_rows is a callable returning
+    the fields of all rows now in the directory; it is only read to build the aggregates the first time, or to
+    recompute groups whose min/max went stale.
+    """
+    if aggregates is None:
+        aggregates = MaterializedAggregates()
+        for fields in current_rows():
+            aggregates.add(fields)
+        print(f"Built materialized aggregates for {directory}")
+    else:
+        removed_count = 0
+        for fields in removed_rows:
+            aggregates.remove(fields)
+            removed_count += 1
+        refreshed = aggregates.refresh_stale(current_rows())
+        print(f"Updated materialized aggregates: {added_count} rows added, {removed_count} removed, "
+              f"{refreshed} groups recomputed")
+    aggregates.save(directory)
+    return aggregates
+
+
+def format_number(value):
+    return f"{value:,.2f}" if abs(value) < 1e15 else f"{value:.3e}"
+
+
+def aggregate_context(aggregates_list, csu_name, question='', max_rows=AGGREGATE_CONTEXT_MAX_ROWS, max_tokens=None):
+    """
+    Compact text of the precomputed aggregates relevant to a question, for the prompt: the CSU totals and the
+    groupings by the dimensions the question names (by dimension name or by value), or DEFAULT_CONTEXT_GROUPINGS,
+    with the measures it names, or DEFAULT_CONTEXT_MEASURES. Empty when the question names neither a dimension
+    nor a measure. At most max_rows lines, and max_tokens tokens when given.
+    """
+    question = question.lower()
+    # Measure names are matched on their words, e.g. "supply index" for SupplyIndex
+    measures = [name for name in MEASURES
+                if ' '.join(re.findall(r'[A-Z][a-z]+|USD', name)).lower().replace(' usd', '') in question
+                or name.lower() in question]
+
+    groupings = []
+    for name in DIMENSIONS:
+        grouping = f"CSU|{name}"
+        named = name.lower() in question or (name == 'Lane' and re.search(r'\b(lane|route|deliver)', question))
+        valued = any(row[name].lower() in question for aggregates in aggregates_list
+                     for row in aggregates.rows(grouping, csu_name))
+        if named or valued:
+            groupings.append(grouping)
+    if not groupings and not measures:
+        return ''
+    groupings = ['CSU'] + groupings if groupings else DEFAULT_CONTEXT_GROUPINGS
+    measures = measures or DEFAULT_CONTEXT_MEASURES
+
+    lines = []
+    used_tokens = 0
+    for aggregates in aggregates_list:
+        for grouping in groupings:
+            for row in aggregates.rows(grouping, csu_name):
+                if len(lines) >= max_rows:
+                    break
+                label = ', '.join(f"{name}={row[name]}" for name in grouping.split('|'))
+                values = '; '.join(
+                    f"{name} mean {format_number(row[name]['mean'])} min {format_number(row[name]['min'])} "
+                    f"max {format_number(row[name]['max'])}"
+                    + (f" total {format_number(row[name]['sum'])}" if name in ('TotalPriceUSD', 'Quantity') else '')
+                    for name in measures if name in row)
+                line = f"{label}: {row['count']} rows; {values}"
+                if max_tokens is not None:
+                    # One more token for the line break
+                    tokens = num_tokens_from_string(line) + 1
+                    if used_tokens + tokens > max_tokens:
+                        return "\n".join(lines)
+                    used_tokens += tokens
+                lines.append(line)
+    return "\n".join(lines)
+
+
+def get_aggregates(directories):
+    """The aggregates of the given chunk directories, cached and reloaded when their files change."""
+    loaded = []
+    with _default_aggregates_lock:
+        for directory in directories:
+            path = os.path.join(directory, AGGREGATES_FILE_NAME)
+            try:
+                version = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+            cached = _default_aggregates.get(directory)
+            if cached is None or cached[0] != version:
+                cached = (version, MaterializedAggregates.load(directory))
+                _default_aggregates[directory] = cached
+            loaded.append(cached[1])
+    return loaded
+
+def get_default_aggregates():
+    """
+    The aggregates of the chunk directories under LOCAL_SEARCH_CHUNK_DIRECTORY (data/chunks), one per table:
+    a table chunked in both formats (after a change of output_format) is read from its store only, so that
+    its rows are not counted twice.
+    """
+    project_root = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    chunk_root = os.path.join(project_root, os.getenv('LOCAL_SEARCH_CHUNK_DIRECTORY', 'data/chunks'))
+    directories = []
+    for table in ('crm', 'customer'):
+        for name in (f'{table}_store', f'{table}_chunks'):
+            if os.path.exists(os.path.join(chunk_root, name, AGGREGATES_FILE_NAME)):
+                directories.append(os.path.join(chunk_root, name))
+                break
+    return get_aggregates(directories)
+
+# Example usage:
+# aggregates = get_aggregates(['data/chunks/crm_store', 'data/chunks/customer_store'])
+# print(aggregate_context(aggregates, 'East', "Average price per mine in Winter?"))
@@ -0,0 +1,107 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from scripts.embeddings import get_embeddings_vector
+from scripts.embedding_batcher import get_default_embedding_batcher
+
+# Size and lifetime of the in-memory query embedding cache, overridable from the .env file
+QUERY_CACHE_MAX_ENTRIES = 1024
+QUERY_CACHE_TTL_SECONDS = 3600
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def normalize_query(query):
+    """Case- and whitespace-insensitive form of a query, so trivially different phrasings share an entry."""
+    return re.sub(r'\s+', ' ', query).strip().lower()
+
+
+class QueryEmbeddingCache:
+    """
+    Thread-safe in-memory LRU cache of query embeddings keyed by (embedding model, normalized query).
+    Entries expire ttl_seconds after they were stored, and the least recently used entry is evicted
+    once max_entries is reached.
+    """
+
+    def __init__(self, max_entries=QUERY_CACHE_MAX_ENTRIES, ttl_seconds=QUERY_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, embedding_model, query):
+        key = (embedding_model, normalize_query(query))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.monotonic() - entry[1] > self.ttl_seconds:
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, embedding_model, query, embedding):
+        key = (embedding_model, normalize_query(query))
+        with self.lock:
+            self.entries[key] = (embedding, time.monotonic())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+            }
+
+
+def get_default_query_cache():
+    """The process-wide query embedding cache, configured from QUERY_CACHE_MAX_ENTRIES / QUERY_CACHE_TTL_SECONDS."""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = QueryEmbeddingCache(
+                max_entries=int(os.getenv('QUERY_CACHE_MAX_ENTRIES', QUERY_CACHE_MAX_ENTRIES)),
+                ttl_seconds=float(os.getenv('QUERY_CACHE_TTL_SECONDS', QUERY_CACHE_TTL_SECONDS)))
+        return _default_cache
+
+
+def get_query_embedding(query, openai_client, embedding_model, cache=None):
+    """
+    Embeds a user query, reusing the embedding of an earlier identical (after normalization) query.
+    Compute it once per turn and share it across all the indexes searched for that turn.
+    Queries of concurrent sessions missing the cache are embedded together (see embedding_batcher.py).
+    """
+    cache = cache or get_default_query_cache()
+    embedding = cache.get(embedding_model, query)
+    if embedding is None:
+        text = re.sub(r'\s+', ' ', query).strip()
+        batcher = get_default_embedding_batcher(openai_client, embedding_model)
+        if batcher is not None:
+            embedding = batcher.embed(text)
+        else:
+            embedding = get_embeddings_vector(text, openai_client, embedding_model)
+        cache.put(embedding_model, query, embedding)
+    return embedding
+
+# Example usage:
+# query_embedding = get_query_embedding("Average price in Winter?", openai_client, azure_openai_embedding_model)
+# print(get_default_query_cache().stats())
@@ -0,0 +1,292 @@
+import argparse
+import asyncio
+import json
+import os
+import re
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from scripts.UpdatedRAG import QueryPipeline
+from scripts.embedding_batcher import get_default_embedding_batcher
+from scripts.resilience import resilience_stats
+from scripts.instrumentation import get_default_metrics, write_metrics_file
+
+# Questions answered at once (each holds a worker thread), idle time after which a session and its history
+# are dropped, and the largest request body accepted, overridable from the .env file
+SERVICE_MAX_CONCURRENCY = 32
+SERVICE_SESSION_TTL_SECONDS = 3600
+SERVICE_MAX_BODY_BYTES = 64 * 1024
+# Interval of the export of the metrics to METRICS_JSONL_PATH, when it is set
+METRICS_EXPORT_SECONDS = 60
+
+# CSU names go into the search filters, so only plain names are accepted
+CSU_PATTERN = re.compile(r"^[A-Za-z][A-Za-z0-9 _-]{0,63}$")
+SESSION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Session:
+    def __init__(self, memory):
+        self.memory = memory
+        # Questions of a session are answered one after the other, so each sees the previous answers
+        self.lock = asyncio.Lock()
+        self.last_used = time.monotonic()
+
+
+class QueryService:
+    """
+    HTTP front end of the assistant serving many sessions at once. Each request names its session and CSU;
+    a session keeps its own conversation history, while every session shares the pipeline (clients, caches,
+    analytics engine). Questions run on a pool of max_concurrency threads; the event loop only does the I/O.
+
+    POST /query   {"query": ..., "csu": ..., "session_id": optional, "stream": optional}
+                  -> {"session_id", "answer", "source", "seconds"}, or the answer as chunked text when streaming
+    DELETE /sessions/<session_id>
+    GET /metrics (Prometheus text), GET /metrics.jsonl (JSON lines), GET /health, GET /stats
+    """
+
+    def __init__(self, pipeline=None, max_concurrency=None, session_ttl_seconds=None):
+        self.pipeline = pipeline or QueryPipeline()
+        self.max_concurrency = max_concurrency or int(os.getenv('SERVICE_MAX_CONCURRENCY', SERVICE_MAX_CONCURRENCY))
+        self.session_ttl_seconds = session_ttl_seconds or float(os.getenv('SERVICE_SESSION_TTL_SECONDS',
+                                                                          SERVICE_SESSION_TTL_SECONDS))
+        self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='query')
+        self.sessions = {}
+        self.requests = 0
+        self.answers_by_source = {}
+
+    def session(self, session_id):
+        session = self.sessions.get(session_id)
+        if session is None:
+            session = Session(self.pipeline.new_memory())
+            self.sessions[session_id] = session
+        session.last_used = time.monotonic()
+        return session
+
+    def drop_session(self, session_id):
+        session = self.sessions.pop(session_id, None)
+        if session is not None:
+            self.executor.submit(session.memory.close)
+        return session is not None
+
+    async def expire_sessions(self):
+        while True:
+            await asyncio.sleep(min(60.0, self.session_ttl_seconds))
+            now = time.monotonic()
+            for session_id, session in list(self.sessions.items()):
+                if now - session.last_used > self.session_ttl_seconds and not session.lock.locked():
+                    self.drop_session(session_id)
+
+    def stats(self):
+        stats = {
+            'sessions': len(self.sessions),
+            'requests': self.requests,
+            'answers_by_source': dict(self.answers_by_source),
+            'answer_cache': self.pipeline.answer_cache.stats(),
+            'calls': resilience_stats(),
+        }
+        batcher = get_default_embedding_batcher(self.pipeline.openai_client, self.pipeline.embedding_model)
+        if batcher is not None:
+            stats['query_embedding_batches'] = batcher.stats()
+        return stats
+
+    def parse_query(self, body):
+        try:
+            payload = json.loads(body or b'{}')
+        except ValueError:
+            raise HTTPError(400, "Body must be JSON")
+        if not isinstance(payload, dict):
+            raise HTTPError(400, "Body must be a JSON object")
+        query = str(payload.get('query') or '').strip()
+        csu_name = str(payload.get('csu') or '').strip()
+        session_id = str(payload.get('session_id') or uuid.uuid4().hex)
+        if not query:
+            raise HTTPError(400, "No query provided")
+        if not CSU_PATTERN.match(csu_name):
+            raise HTTPError(400, "A valid csu is required")
+        if not SESSION_ID_PATTERN.match(session_id):
+            raise HTTPError(400, "Invalid session_id")
+        return query, csu_name, session_id, bool(payload.get('stream', False))
+
+    async def answer(self, query, csu_name, session_id, on_text=None):
+        session = self.session(session_id)
+        async with session.lock:
+            result = await asyncio.get_running_loop().run_in_executor(
+                self.executor, lambda: self.pipeline.answer(query, csu_name, session.memory, on_text=on_text))
+        session.last_used = time.monotonic()
+        self.answers_by_source[result['source']] = self.answers_by_source.get(result['source'], 0) + 1
+        return result
+
+    async def handle_query(self, body, writer):
+        query, csu_name, session_id, stream = self.parse_query(body)
+        if not stream:
+            result = await self.answer(query, csu_name, session_id)
+            await send_json(writer, 200, dict(result, session_id=session_id))
+            return
+
+        # The worker thread hands the text over to the event loop, which writes it as it arrives
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue()
+
+        def on_text(text):
+            loop.call_soon_threadsafe(chunks.put_nowait, text)
+
+        task = asyncio.ensure_future(self.answer(query, csu_name, session_id, on_text=on_text))
+        task.add_done_callback(lambda _: chunks.put_nowait(None))
+        writer.write(f"HTTP/1.1 200 OK\r\nContent-Type: text/plain; charset=utf-8\r\n"
+                     f"Transfer-Encoding: chunked\r\nX-Session-Id: {session_id}\r\n\r\n".encode('ascii'))
+        while True:
+            text = await chunks.get()
+            if text is None:
+                break
+            if text:
+                data = text.encode('utf-8')
+                writer.write(b"%x\r\n%s\r\n" % (len(data), data))
+                await writer.drain()
+        try:
+            result = task.result()
+        except Exception as e:
+            # The status line is already sent, the error can only end the text
+            print(f"Error answering a streamed query: {e}")
+            result = {'answer': None, 'source': 'error'}
+        if result['answer'] is None:
+            data = ("No relevant documents found for the given query." if result['source'] == 'no_context'
+                    else "The answer could not be generated, please try again.").encode('utf-8')
+            writer.write(b"%x\r\n%s\r\n" % (len(data), data))
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def route(self, method, path, body, writer):
+        if path == '/query':
+            if method != 'POST':
+                raise HTTPError(405, "Use POST")
+            self.requests += 1
+            await self.handle_query(body, writer)
+        elif path.startswith('/sessions/'):
+            if method != 'DELETE':
+                raise HTTPError(405, "Use DELETE")
+            await send_json(writer, 200, {'deleted': self.drop_session(path[len('/sessions/'):])})
+        elif path in ('/metrics', '/metrics.jsonl'):
+            if path == '/metrics':
+                await send_text(writer, get_default_metrics().to_prometheus(), 'text/plain; version=0.0.4')
+            else:
+                await send_text(writer, get_default_metrics().to_json_lines(), 'application/x-ndjson')
+        elif path == '/health':
+            await send_json(writer, 200, {'status': 'ok'})
+        elif path == '/stats':
+            await send_json(writer, 200, self.stats())
+        else:
+            raise HTTPError(404, "Not found")
+
+    async def handle_connection(self, reader, writer):
+        try:
+            # Connections are kept alive for the next request until the client closes them
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                try:
+                    await self.route(method, path, body, writer)
+                except HTTPError as e:
+                    await send_json(writer, e.status, {'error': str(e)})
+                except Exception as e:
+                    print(f"Error answering {method} {path}: {e}")
+                    await send_json(writer, 500, {'error': 'Internal error'})
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except HTTPError as e:
+            await send_json(writer, e.status, {'error': str(e)})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def export_metrics(self):
+        interval = float(os.getenv('METRICS_EXPORT_SECONDS', METRICS_EXPORT_SECONDS))
+        while True:
+            await asyncio.sleep(interval)
+            write_metrics_file()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        tasks = [asyncio.ensure_future(self.expire_sessions())]
+        if os.getenv('METRICS_JSONL_PATH'):
+            tasks.append(asyncio.ensure_future(self.export_metrics()))
+        print(f"Query service listening on http://{host}:{port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+            write_metrics_file()
+            self.executor.shutdown(wait=False)
+
+
+async def read_request(reader):
+    """Reads one HTTP/1.1 request; returns (method, path, headers, body), or None when the client closed."""
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+    try:
+        method, path, _ = request_line.decode('ascii').split(' ', 2)
+    except (UnicodeDecodeError, ValueError):
+        raise HTTPError(400, "Malformed request line")
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    try:
+        length = int(headers.get('content-length') or 0)
+    except ValueError:
+        length = -1
+    if length < 0:
+        raise HTTPError(400, "Invalid Content-Length")
+    if length > int(os.getenv('SERVICE_MAX_BODY_BYTES', SERVICE_MAX_BODY_BYTES)):
+        raise HTTPError(413, "Request body too large")
+    body = await reader.readexactly(length) if length else b''
+    return method.upper(), path.split('?', 1)[0], headers, body
+
+
+async def send_text(writer, text, content_type):
+    data = text.encode('utf-8')
+    writer.write(f"HTTP/1.1 200 OK\r\nContent-Type: {content_type}; charset=utf-8\r\n"
+                 f"Content-Length: {len(data)}\r\n\r\n".encode('ascii') + data)
+    await writer.drain()
+
+
+async def send_json(writer, status, payload):
+    data = json.dumps(payload).encode('utf-8')
+    writer.write(f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(data)}\r\n\r\n".encode('ascii') + data)
+    await writer.drain()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the Mithril pricing assistant over HTTP.")
+    parser.add_argument('--host', default=os.getenv('SERVICE_HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=int(os.getenv('SERVICE_PORT', '8080')))
+    args = parser.parse_args()
+    asyncio.run(QueryService().serve(args.host, args.port))
+
+
+if __name__ == '__main__':
+    main()
+
+# Example usage (SEARCH_BACKEND=local and OPENAI_BACKEND=local run it without Azure):
+# python -m scripts.query_service --port 8080
+# curl -X POST localhost:8080/query -d '{"session_id": "analyst-1", "csu": "East", "query": "Average price in Winter?"}'
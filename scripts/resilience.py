@@ -0,0 +1,318 @@
+import concurrent.futures
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import openai
+import requests
+from azure.core.exceptions import (HttpResponseError, ServiceRequestError, ServiceResponseError,
+                                   ClientAuthenticationError, ResourceNotFoundError)
+
+# Retry, circuit breaker and hedging defaults of the calls to the services, overridable from the .env file
+RETRY_MAX_ATTEMPTS = 4
+RETRY_BASE_DELAY_SECONDS = 0.5
+RETRY_MAX_DELAY_SECONDS = 8.0
+# Longest Retry-After honored; a service asking for more is treated as unavailable for this call
+RETRY_MAX_RETRY_AFTER_SECONDS = 30.0
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_SECONDS = 30.0
+# A hedged call sends a second request once the first is slower than this percentile of recent latencies
+HEDGE_PERCENTILE = 0.95
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MAX_WORKERS = 16
+
+# HTTP statuses worth retrying: timeout, conflict, throttling and server errors
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+# Calls that may be hedged: sending them twice has no side effect
+IDEMPOTENT_CALLS = {'embeddings', 'search'}
+
+_callers = {}
+_callers_lock = threading.Lock()
+_hedge_executor = None
+_hedge_executor_lock = threading.Lock()
+
+
+class CircuitOpenError(Exception):
+    """Raised without calling the service while its circuit breaker is open."""
+
+
+def get_retry_after(error):
+    """
+    Reads the Retry-After delay (in seconds) from an OpenAI or Azure error, or None if the service did not send one.
+    Azure OpenAI sends both retry-after-ms and retry-after, the former being more precise.
+    """
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+
+    headers = response.headers
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except ValueError:
+        return None
+    return None
+
+
+def is_retryable(error):
+    """
+    Whether a failed call may succeed if sent again: connection failures, timeouts, throttling and server
+    errors are; invalid requests, authentication errors and missing resources are not.
+    """
+    if isinstance(error, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS_CODES
+    if isinstance(error, (ClientAuthenticationError, ResourceNotFoundError)):
+        return False
+    if isinstance(error, (ServiceRequestError, ServiceResponseError)):
+        return True
+    if isinstance(error, HttpResponseError):
+        return error.status_code in RETRYABLE_STATUS_CODES
+    if isinstance(error, (requests.ConnectionError, requests.Timeout, concurrent.futures.TimeoutError,
+                          ConnectionError, TimeoutError)):
+        return True
+    return False
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter: the delay before retry n is drawn uniformly between 0 and
+    min(max_delay, base_delay * 2 ** n), unless the service sent a Retry-After, which is then waited for.
+    """
+
+    def __init__(self, max_attempts=RETRY_MAX_ATTEMPTS, base_delay=RETRY_BASE_DELAY_SECONDS,
+                 max_delay=RETRY_MAX_DELAY_SECONDS, max_retry_after=RETRY_MAX_RETRY_AFTER_SECONDS):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+
+    def delay(self, attempt, error):
+        """Seconds to wait before retrying after the given (0-based) attempt failed, or None to give up."""
+        if attempt + 1 >= self.max_attempts:
+            return None
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            return retry_after if retry_after <= self.max_retry_after else None
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """
+    Stops calling a service after failure_threshold consecutive failed calls (a call failing once its retries
+    are exhausted): calls then fail at once with CircuitOpenError for reset_seconds, after which one trial call
+    is let through (half-open). Its success closes the circuit again, its failure reopens it.
+    """
+
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_seconds=BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.times_opened = 0
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return 'closed'
+            return 'half_open' if time.monotonic() - self.opened_at >= self.reset_seconds else 'open'
+
+    def allow(self):
+        """Raises CircuitOpenError if the call may not go through; returns True if it is the half-open trial."""
+        with self.lock:
+            if self.opened_at is None:
+                return False
+            if time.monotonic() - self.opened_at >= self.reset_seconds and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            raise CircuitOpenError(f"Circuit open after {self.failures} consecutive failures")
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def release(self):
+        """Ends a trial call that said nothing about the health of the service, so that another one can be made."""
+        with self.lock:
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            reopening = self.trial_in_flight
+            self.trial_in_flight = False
+            if reopening or (self.opened_at is None and self.failures >= self.failure_threshold):
+                self.opened_at = time.monotonic()
+                self.times_opened += 1
+
+
+def get_hedge_executor():
+    """Thread pool running the hedged calls of the process."""
+    global _hedge_executor
+    with _hedge_executor_lock:
+        if _hedge_executor is None:
+            _hedge_executor = ThreadPoolExecutor(max_workers=int(os.getenv('HEDGE_MAX_WORKERS', HEDGE_MAX_WORKERS)),
+                                                 thread_name_prefix='hedge')
+        return _hedge_executor
+
+
+class ResilientCaller:
+    """
+    Calls one service with a retry policy and a circuit breaker. Only retryable errors (see is_retryable) are
+    retried, and the breaker counts a call as failed once its retries are exhausted; other errors are raised at
+    once and leave the breaker as it is.
+
+    With hedge, a call still running after the hedge_percentile latency of the recent successful calls gets a
+    second, identical request, and the first to succeed is used. Only for idempotent calls.
+    """
+
+    def __init__(self, name, policy=None, breaker=None, hedge=False, hedge_percentile=HEDGE_PERCENTILE,
+                 hedge_min_samples=HEDGE_MIN_SAMPLES):
+        self.name = name
+        self.policy = policy or RetryPolicy()
+        self.breaker = breaker or CircuitBreaker()
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.latencies = deque(maxlen=1000)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def _timed(self, function):
+        started = time.monotonic()
+        result = function()
+        with self.lock:
+            self.latencies.append(time.monotonic() - started)
+        return result
+
+    def hedge_threshold(self):
+        with self.lock:
+            if len(self.latencies) < self.hedge_min_samples:
+                return None
+            ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(self.hedge_percentile * len(ordered)))]
+
+    def _call_hedged(self, function):
+        threshold = self.hedge_threshold()
+        if threshold is None:
+            return self._timed(function)
+
+        executor = get_hedge_executor()
+        primary = executor.submit(self._timed, function)
+        if wait([primary], timeout=threshold).done:
+            return primary.result()
+
+        with self.lock:
+            self.hedges += 1
+        hedged = executor.submit(self._timed, function)
+        pending = {primary, hedged}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedged:
+                        with self.lock:
+                            self.hedge_wins += 1
+                    return future.result()
+                error = error or future.exception()
+        raise error
+
+    def call(self, function, *args, retry_if=None, **kwargs):
+        """
+        Calls function(*args, **kwargs) under the policy. retry_if, when given, is an extra condition on the
+        error for retrying, e.g. that no part of a streamed answer was shown yet.
+        """
+        with self.lock:
+            self.calls += 1
+        # The breaker is asked once per call, and its attempts count as one success or failure
+        trial = self.breaker.allow()
+        attempt = 0
+        while True:
+            try:
+                if self.hedge:
+                    result = self._call_hedged(lambda: function(*args, **kwargs))
+                else:
+                    result = self._timed(lambda: function(*args, **kwargs))
+            except Exception as e:
+                if not is_retryable(e):
+                    # The request itself is at fault, not the service
+                    if trial:
+                        self.breaker.release()
+                    raise
+                delay = self.policy.delay(attempt, e)
+                if delay is None or (retry_if is not None and not retry_if(e)):
+                    self.breaker.record_failure()
+                    with self.lock:
+                        self.failures += 1
+                    raise
+                print(f"{self.name} call failed ({e}), retrying in {delay:.1f}s")
+                with self.lock:
+                    self.retries += 1
+                time.sleep(delay)
+                attempt += 1
+            else:
+                self.breaker.record_success()
+                return result
+
+    def stats(self):
+        threshold = self.hedge_threshold()
+        with self.lock:
+            return {
+                'calls': self.calls,
+                'retries': self.retries,
+                'failures': self.failures,
+                'hedges': self.hedges,
+                'hedge_wins': self.hedge_wins,
+                'hedge_threshold_ms': threshold * 1000 if threshold is not None else None,
+                'circuit': self.breaker.state,
+                'circuit_opened': self.breaker.times_opened,
+            }
+
+
+def get_resilient_caller(name):
+    """
+    The process-wide caller of a service ('chat', 'embeddings', 'search', 'search_index'), configured from
+    RETRY_MAX_ATTEMPTS / RETRY_BASE_DELAY_SECONDS / RETRY_MAX_DELAY_SECONDS / BREAKER_FAILURE_THRESHOLD /
+    BREAKER_RESET_SECONDS.
+    HEDGE_CALLS=true hedges the idempotent ones (embeddings and search) at HEDGE_PERCENTILE.
+    """
+    with _callers_lock:
+        caller = _callers.get(name)
+        if caller is None:
+            policy = RetryPolicy(max_attempts=int(os.getenv('RETRY_MAX_ATTEMPTS', RETRY_MAX_ATTEMPTS)),
+                                 base_delay=float(os.getenv('RETRY_BASE_DELAY_SECONDS', RETRY_BASE_DELAY_SECONDS)),
+                                 max_delay=float(os.getenv('RETRY_MAX_DELAY_SECONDS', RETRY_MAX_DELAY_SECONDS)))
+            breaker = CircuitBreaker(
+                failure_threshold=int(os.getenv('BREAKER_FAILURE_THRESHOLD', BREAKER_FAILURE_THRESHOLD)),
+                reset_seconds=float(os.getenv('BREAKER_RESET_SECONDS', BREAKER_RESET_SECONDS)))
+            hedge = name in IDEMPOTENT_CALLS and os.getenv('HEDGE_CALLS', 'false').lower() == 'true'
+            caller = ResilientCaller(name, policy=policy, breaker=breaker, hedge=hedge,
+                                     hedge_percentile=float(os.getenv('HEDGE_PERCENTILE', HEDGE_PERCENTILE)))
+            _callers[name] = caller
+        return caller
+
+
+def resilience_stats():
+    with _callers_lock:
+        callers = dict(_callers)
+    return {name: caller.stats() for name, caller in callers.items()}
+
+# Example usage:
+# response = get_resilient_caller('chat').call(openai_client.chat.completions.create, model='gpt-4o',
+#                                              messages=messages)
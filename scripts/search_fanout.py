@@ -0,0 +1,98 @@
+import itertools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from scripts.resilience import get_resilient_caller
+from scripts.context_packer import CONTEXT_MAX_TOKENS
+from scripts.tokenizer import num_tokens_from_string
+
+# Time budget of the retrieval stage of one query, overridable from the .env file
+SEARCH_DEADLINE_SECONDS = 5.0
+SEARCH_FANOUT_WORKERS = 16
+# Results read from a search without a top or vector query k, as Azure AI Search returns by default
+SEARCH_DEFAULT_TOP = 50
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_search_executor():
+    """Thread pool shared by all fan-out searches of the process."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=int(os.getenv('SEARCH_FANOUT_WORKERS', SEARCH_FANOUT_WORKERS)),
+                                           thread_name_prefix='search')
+        return _executor
+
+
+def search_results(search_client, search_kwargs, max_tokens=None, text_field='description'):
+    """
+    Reads the results of a search, best first, up to top. With max_tokens, reading stops once the results read
+    hold more than max_tokens tokens of text_field: the later ones can not fit in a context of that budget,
+    so their pages are never requested.
+    """
+    results = []
+    used_tokens = 0
+    for doc in itertools.islice(search_client.search(**search_kwargs), search_kwargs['top']):
+        results.append(doc)
+        if max_tokens is not None:
+            used_tokens += num_tokens_from_string(doc.get(text_field) or '') + 1
+            if used_tokens > max_tokens:
+                break
+    return results
+
+
+def run_search(search_client, search_kwargs, max_tokens=None):
+    """
+    Runs a search and reads its results inside the worker (see search_results), so that the pages needed are
+    fetched before the deadline and under the retry policy (see resilience.py), not later on the caller thread.
+    top, when not given, is the largest k of the vector queries.
+    """
+    search_kwargs = dict(search_kwargs)
+    if not search_kwargs.get('top'):
+        search_kwargs['top'] = max([getattr(vector_query, 'k_nearest_neighbors', None) or SEARCH_DEFAULT_TOP
+                                    for vector_query in search_kwargs.get('vector_queries') or []]
+                                   or [SEARCH_DEFAULT_TOP])
+    return get_resilient_caller('search').call(search_results, search_client, search_kwargs, max_tokens)
+
+
+def fan_out_search(searches, deadline_seconds=None, max_tokens=None):
+    """
+    Runs the searches of one query concurrently and waits for them until the deadline.
+    searches maps a target name (e.g. the index name) to a (search_client, search kwargs) pair. Each search is
+    read up to the max_tokens context budget (CONTEXT_MAX_TOKENS by default), the most pack_context can use.
+
+    Returns (results, errors): results maps every target to the list of its documents, and errors maps the
+    targets that failed or missed the deadline to the reason. Those get no documents, so the query goes on
+    with partial context instead of failing.
+    """
+    if deadline_seconds is None:
+        deadline_seconds = float(os.getenv('SEARCH_DEADLINE_SECONDS', SEARCH_DEADLINE_SECONDS))
+    if max_tokens is None:
+        max_tokens = int(os.getenv('CONTEXT_MAX_TOKENS', CONTEXT_MAX_TOKENS))
+
+    executor = get_search_executor()
+    futures = {name: executor.submit(run_search, search_client, search_kwargs, max_tokens)
+               for name, (search_client, search_kwargs) in searches.items()}
+    wait(futures.values(), timeout=deadline_seconds)
+
+    results = {}
+    errors = {}
+    for name, future in futures.items():
+        results[name] = []
+        if not future.done():
+            # The search keeps running in the pool, but its results are no longer waited for
+            future.cancel()
+            errors[name] = f"no answer within {deadline_seconds:.1f}s"
+        elif future.exception() is not None:
+            errors[name] = str(future.exception())
+        else:
+            results[name] = future.result()
+    return results, errors
+
+# Example usage:
+# results, errors = fan_out_search({
+#     customer_index_name: (search_customer_client, {'search_text': None, 'vector_queries': [vector_query]}),
+#     crm_index_name: (search_crm_client, {'search_text': None, 'vector_queries': [vector_query]}),
+# })
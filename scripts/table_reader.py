@@ -0,0 +1,62 @@
+def split_table_line(line):
+    """Splits a pipe-delimited line into its stripped cell values, ignoring empty cells at the edges."""
+    return [cell.strip() for cell in line.split('|') if cell.strip()]
+
+
+def is_separator_line(line):
+    """True for the markdown table separator line (e.g. |---|:---:|)."""
+    stripped = line.strip()
+    return bool(stripped) and set(stripped) <= set('|-: ')
+
+
+def read_table_header(file):
+    """Reads the column names from the first line of a table opened in binary mode."""
+    file.seek(0)
+    return split_table_line(file.readline().decode('utf-8'))
+
+
+def iter_table_rows(file, converters=None, start_offset=0, end_offset=None):
+    """
+    Streams the rows of a pipe-delimited markdown table from a file opened in binary mode, one at a time.
+    Yields (offset, fields) pairs, where offset is the byte offset of the row's line in the file and fields
+    maps each column name to its value, converted by converters[column_name] when given (see build_caster_plan).
+
+    Reading can start at any byte offset (a partial line there is skipped, as it belongs to the previous
+    range) and stop at end_offset, so a large file can be split into ranges processed independently.
+    """
+    header = read_table_header(file)
+    # Resolve the converter of each column once for the whole file
+    column_converters = [(converters or {}).get(column_name, str) for column_name in header]
+
+    if start_offset > file.tell():
+        # Only start at start_offset if it falls on the beginning of a line
+        file.seek(start_offset - 1)
+        if file.read(1) != b'\n':
+            file.readline()
+
+    while True:
+        offset = file.tell()
+        if end_offset is not None and offset >= end_offset:
+            break
+        line = file.readline()
+        if not line:
+            break
+
+        line = line.decode('utf-8')
+        if not line.strip() or is_separator_line(line):  # Skip empty rows and the table separator
+            continue
+
+        # Use the pipes to split row values correctly, handling multiword values.
+        row_data = split_table_line(line)
+        if len(row_data) != len(header):
+            print(f"Skipping malformed row: {line.rstrip()}")
+            continue
+
+        fields = {column_name: convert(value)
+                  for column_name, convert, value in zip(header, column_converters, row_data)}
+        yield offset, fields
+
+# Example usage:
+# with open('data/crm/fully_enriched_crm_data.md', 'rb') as file:
+#     for offset, fields in iter_table_rows(file, start_offset=1024 * 1024):
+#         print(offset, fields['OrderID'])
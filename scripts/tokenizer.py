@@ -1,10 +1,70 @@
-
+import threading
 import tiktoken
 
-def num_tokens_from_string(string: str) -> int:
-    encoding = tiktoken.get_encoding(encoding_name="cl100k_base")
+DEFAULT_ENCODING = "cl100k_base"
+TOKENIZER_THREADS = 8
+
+# Loading an encoding parses its whole BPE table, so each one is loaded once per process
+_encodings = {}
+_encodings_lock = threading.Lock()
+
+
+def get_encoding(encoding_name=DEFAULT_ENCODING):
+    with _encodings_lock:
+        if encoding_name not in _encodings:
+            _encodings[encoding_name] = tiktoken.get_encoding(encoding_name=encoding_name)
+        return _encodings[encoding_name]
+
+
+def num_tokens_from_string(string: str, encoding_name=DEFAULT_ENCODING) -> int:
+    encoding = get_encoding(encoding_name)
     num_tokens = len(encoding.encode(string, disallowed_special=()))
     return num_tokens
 
+
+def num_tokens_from_strings(strings, encoding_name=DEFAULT_ENCODING, num_threads=TOKENIZER_THREADS):
+    """Counts the tokens of many strings at once, encoding them on num_threads threads."""
+    encoding = get_encoding(encoding_name)
+    return [len(tokens) for tokens in encoding.encode_batch(list(strings), num_threads=num_threads,
+                                                             disallowed_special=())]
+
+
+def truncate_to_tokens(string, max_tokens, encoding_name=DEFAULT_ENCODING):
+    """Cuts a string down to its first max_tokens tokens."""
+    encoding = get_encoding(encoding_name)
+    tokens = encoding.encode(string, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return string
+    return encoding.decode(tokens[:max_tokens])
+
+
+def split_by_tokens(string, max_tokens, encoding_name=DEFAULT_ENCODING):
+    """Splits a string into consecutive pieces of at most max_tokens tokens each."""
+    encoding = get_encoding(encoding_name)
+    tokens = encoding.encode(string, disallowed_special=())
+    return [encoding.decode(tokens[start:start + max_tokens]) for start in range(0, len(tokens), max_tokens)]
+
+
+def fit_to_token_limit(strings, max_tokens, encoding_name=DEFAULT_ENCODING, num_threads=TOKENIZER_THREADS):
+    """
+    Enforces a per-input token limit on a list of strings, truncating the ones that are too long.
+    Returns the (possibly truncated) strings and their token counts.
+    """
+    encoding = get_encoding(encoding_name)
+    strings = list(strings)
+    encoded = encoding.encode_batch(strings, num_threads=num_threads, disallowed_special=())
+
+    token_counts = []
+    for position, tokens in enumerate(encoded):
+        if len(tokens) > max_tokens:
+            print(f"Input of {len(tokens)} tokens truncated to the {max_tokens} tokens limit")
+            strings[position] = encoding.decode(tokens[:max_tokens])
+            token_counts.append(max_tokens)
+        else:
+            token_counts.append(len(tokens))
+
+    return strings, token_counts
+
 # Example usage:
 # num_tokens = num_tokens_from_string("Sample text")
+# counts = num_tokens_from_strings(["Sample text", "Another text"])
@@ -1,8 +1,110 @@
 import os
 import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from azure.core.exceptions import HttpResponseError, ServiceRequestError, ServiceResponseError
+from scripts.chunk_manifest import MANIFEST_FILE_NAME, load_manifest, save_manifest
+from scripts.chunk_store import ChunkStoreReader, is_chunk_store
 
+# Azure AI Search accepts at most 1000 documents and 16 MB per indexing request
+UPLOAD_MAX_BATCH_DOCUMENTS = 1000
+UPLOAD_MAX_BATCH_BYTES = 16 * 1024 * 1024
+UPLOAD_MAX_WORKERS = 4
+UPLOAD_MAX_RETRIES = 3
 
-def upload_chunks_to_search(search_client, chunk_directory):
+# Per-document status codes worth retrying: conflict, throttling of the document and service unavailable
+RETRYABLE_STATUS_CODES = {409, 422, 429, 503}
+
+
+def load_chunk_document(chunk_directory, filename):
+    """Reads a chunk file and flattens it into the document layout of the search index."""
+    with open(os.path.join(chunk_directory, filename), 'r', encoding='utf-8') as chunk_file:
+        chunk_data = json.load(chunk_file)
+
+    document = chunk_data['fields']  # Unpack all key-value pairs from the 'fields'
+    document['vector'] = chunk_data['vector']  # Add the vector to the document
+    document['id'] = chunk_data['id']
+    document['description'] = chunk_data['description']
+    return document
+
+
+def make_upload_batches(documents, max_documents=UPLOAD_MAX_BATCH_DOCUMENTS, max_bytes=UPLOAD_MAX_BATCH_BYTES):
+    """
+    Groups documents into batches under the document count and payload size limits of one indexing request.
+    The size is measured on the serialized documents, keeping 10% of the limit for the request envelope.
+    """
+    size_limit = int(max_bytes * 0.9)
+    batch = []
+    batch_bytes = 0
+
+    for document in documents:
+        document_bytes = len(json.dumps(document).encode('utf-8'))
+        if batch and (len(batch) >= max_documents or batch_bytes + document_bytes > size_limit):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(document)
+        batch_bytes += document_bytes
+
+    if batch:
+        yield batch
+
+
+def upload_batch(search_client, batch, max_retries=UPLOAD_MAX_RETRIES):
+    """
+    Sends one batch with merge_or_upload_documents and resends only the documents that failed with a
+    retryable status. Returns the ids that succeeded and a dict of failed ids to their error.
+    """
+    succeeded = set()
+    failed = {}
+    pending = batch
+
+    for attempt in range(max_retries + 1):
+        if attempt:
+            time.sleep(min(30, 2 ** attempt) + random.random())
+
+        try:
+            # retry_total=0: this loop is the only retry layer, whatever retry policy the client was built with
+            results = search_client.merge_or_upload_documents(documents=pending, retry_total=0)
+        except HttpResponseError as e:
+            if e.status_code == 413 and len(pending) > 1:
+                # The payload was still too large: split it and send both halves
+                middle = len(pending) // 2
+                for half in (pending[:middle], pending[middle:]):
+                    half_succeeded, half_failed = upload_batch(search_client, half, max_retries)
+                    succeeded |= half_succeeded
+                    failed.update(half_failed)
+                return succeeded, failed
+            if e.status_code in RETRYABLE_STATUS_CODES:
+                failed = {document['id']: str(e) for document in pending}
+                continue
+            failed = {document['id']: str(e) for document in pending}
+            break
+        except (ServiceRequestError, ServiceResponseError) as e:
+            failed = {document['id']: str(e) for document in pending}
+            continue
+
+        retry_ids = set()
+        failed = {}
+        for result in results:
+            if result.succeeded:
+                succeeded.add(result.key)
+            elif result.status_code in RETRYABLE_STATUS_CODES:
+                retry_ids.add(result.key)
+                failed[result.key] = result.error_message
+            else:
+                failed[result.key] = result.error_message
+
+        pending = [document for document in pending if document['id'] in retry_ids]
+        if not pending:
+            break
+
+    return succeeded, failed
+
+
+def upload_chunks_to_search(search_client, chunk_directory, max_workers=UPLOAD_MAX_WORKERS,
+                            max_batch_documents=UPLOAD_MAX_BATCH_DOCUMENTS, max_batch_bytes=UPLOAD_MAX_BATCH_BYTES):
     print("Uploading to AI Search")
     print("**********************")
 
@@ -16,53 +118,66 @@ def upload_chunks_to_search(search_client, chunk_directory):
         print(f"Chunk directory does not exist: {chunk_directory}")
         return
 
-    # Loop through all the chunk files in the directory
-    for filename in os.listdir(chunk_directory):
-        if filename.endswith('.json'):
-            file_path = os.path.join(chunk_directory, filename)
-            with open(file_path, 'r', encoding='utf-8') as chunk_file:
-                chunk_data = json.load(chunk_file)
-
-                # Unpack the fields and vector for individual upload
-                document = chunk_data['fields']  # Unpack all key-value pairs from the 'fields'
-                document['vector'] = chunk_data['vector']  # Add the vector to the document
-                document['id'] = chunk_data['id']
-                document['description'] = chunk_data['description']
-
-                # Upload each document (normal upload)
-                try:
-                    result = search_client.upload_documents(documents=[document])
-                    print(f"Upload of {filename} succeeded: {result[0].succeeded}")
-                except Exception as e:
-                    print(f"Failed to upload chunk {filename}: {e}")
-
-    # Uncomment below for batch upload
-    """
-    # Batch upload logic
-    documents = []
-    for filename in os.listdir(chunk_directory):
-        if filename.endswith('.json'):
-            file_path = os.path.join(chunk_directory, filename)
-            with open(file_path, 'r', encoding='utf-8') as chunk_file:
-                chunk_data = json.load(chunk_file)
-                document = chunk_data['fields']
-                document['vector'] = chunk_data['vector']
-                document['id'] = chunk_data['id']
-                documents.append(document)
-
-    # Perform batch upload
-    if documents:
+    # Only the documents added or removed since the last upload are sent to the index
+    manifest = load_manifest(chunk_directory)
+    pending_upserts = list(manifest['pending_upserts'])
+    if not os.path.exists(os.path.join(chunk_directory, MANIFEST_FILE_NAME)):
+        pending_upserts = list(manifest['documents'])
+    print(f"{len(pending_upserts)} documents to upload, {len(manifest['pending_deletes'])} to delete")
+
+    start_time = time.perf_counter()
+    uploaded_ids = set()
+    failed = {}
+
+    # Chunks are read lazily, and only a few batches are held in memory while earlier ones are in flight
+    if is_chunk_store(chunk_directory):
+        documents = ChunkStoreReader(chunk_directory).iter_documents(set(pending_upserts))
+    else:
+        documents = (load_chunk_document(chunk_directory, manifest['documents'][document_id])
+                     for document_id in pending_upserts)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = set()
+        for batch in make_upload_batches(documents, max_batch_documents, max_batch_bytes):
+            if len(in_flight) >= max_workers * 2:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    batch_succeeded, batch_failed = future.result()
+                    uploaded_ids |= batch_succeeded
+                    failed.update(batch_failed)
+            in_flight.add(executor.submit(upload_batch, search_client, batch))
+
+        for future in in_flight:
+            batch_succeeded, batch_failed = future.result()
+            uploaded_ids |= batch_succeeded
+            failed.update(batch_failed)
+
+    elapsed = time.perf_counter() - start_time
+    docs_per_second = len(uploaded_ids) / elapsed if elapsed > 0 else 0.0
+    print(f"Uploaded {len(uploaded_ids)} documents in {elapsed:.1f}s ({docs_per_second:.1f} docs/sec), "
+          f"{len(failed)} failed")
+    for document_id, error in list(failed.items())[:10]:
+        print(f"Failed to upload document {document_id}: {error}")
+
+    # Remove the documents of rows that disappeared from the source data
+    deleted_ids = set()
+    pending_deletes = manifest['pending_deletes']
+    for start in range(0, len(pending_deletes), max_batch_documents):
+        delete_batch = pending_deletes[start:start + max_batch_documents]
         try:
-            upload_result = search_client.upload_documents(documents=documents)
-            for result in upload_result:
-                print(f"Upload of document succeeded: {result.succeeded}")
+            results = search_client.delete_documents(documents=[{'id': document_id} for document_id in delete_batch])
+            deleted_ids |= {result.key for result in results if result.succeeded}
         except Exception as e:
-            print(f"Failed to upload documents in batch: {e}")
-    else:
-        print("No chunks found to upload in batch.")
-    """
+            print(f"Failed to delete removed documents: {e}")
+    if pending_deletes:
+        print(f"Deleted {len(deleted_ids)} of {len(pending_deletes)} removed documents")
+
+    # Keep whatever failed queued for the next upload
+    manifest['pending_upserts'] = [document_id for document_id in pending_upserts if document_id not in uploaded_ids]
+    manifest['pending_deletes'] = [document_id for document_id in pending_deletes if document_id not in deleted_ids]
+    save_manifest(chunk_directory, manifest)
     print("**********************")
 
 # Example usage:
 # upload_chunks_to_search(search_customer_client, 'data/chunks/customer_chunks')
 # upload_chunks_to_search(search_crm_client, 'data/chunks/crm_chunks')
+# upload_chunks_to_search(search_crm_client, 'data/chunks/crm_store')
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules are imported as scripts.*, as when run with python -m from the project root
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
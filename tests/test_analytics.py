@@ -0,0 +1,64 @@
+import pytest
+from scripts.analytics import AnalyticsEngine, validate_plan
+
+CRM_TABLE = """OrderID|Mine|Season|Quantity|PricePerUnitUSD|CSU
+ORD001|Iron Hills Mine|Winter|6|100.0|South
+ORD002|Iron Hills Mine|Summer|2|200.0|South
+ORD003|Erebor Mine|Winter|4|300.0|West
+"""
+
+
+@pytest.fixture
+def engine(tmp_path):
+    (tmp_path / 'crm').mkdir()
+    (tmp_path / 'crm' / 'crm.md').write_text(CRM_TABLE, encoding='utf-8')
+    return AnalyticsEngine(tables={'crm': 'crm'}, project_root=str(tmp_path))
+
+
+@pytest.mark.parametrize('plan', [
+    {'table': 'crm', 'group_by': ['Mine'], 'metrics': [{'column': 'Quantity', 'agg': 'sum'}],
+     'filters': [{'column': 'Season', 'op': 'eq', 'value': 'Winter'}],
+     'order_by': {'column': 'sum_Quantity', 'descending': True}, 'limit': 5},
+    {},
+    {'filters': None, 'metrics': [], 'group_by': None, 'order_by': None},
+])
+def test_well_formed_plans_pass(plan):
+    validate_plan(plan)
+
+
+@pytest.mark.parametrize('plan', [
+    None,
+    ['crm'],
+    'select sum(Quantity) from crm',
+    {'table': ['crm']},
+    {'filters': {'column': 'Season', 'value': 'Winter'}},
+    {'filters': ['Season = Winter']},
+    {'filters': [{'op': 'eq', 'value': 'Winter'}]},
+    {'metrics': [{'column': 3, 'agg': 'sum'}]},
+    {'metrics': 'sum_Quantity'},
+    {'group_by': 'Mine'},
+    {'group_by': [['Mine']]},
+    {'order_by': 'sum_Quantity'},
+    {'order_by': ['sum_Quantity']},
+])
+def test_malformed_plans_are_rejected(plan):
+    with pytest.raises(ValueError):
+        validate_plan(plan)
+
+
+@pytest.mark.parametrize('plan', [
+    {'group_by': 'Mine'},
+    {'table': 'orders'},
+    {'filters': [{'column': 'Region', 'value': 'North'}]},
+    {'filters': [{'column': 'Season', 'op': 'like', 'value': 'Win'}]},
+    {'metrics': [{'column': 'Quantity', 'agg': 'average'}]},
+    {'group_by': ['Region']},
+])
+def test_engine_rejects_plans_it_cannot_run(engine, plan):
+    with pytest.raises(ValueError):
+        engine.run(plan)
+
+
+def test_engine_aggregates_all_rows_within_the_csu(engine):
+    result = engine.run({'group_by': ['Mine'], 'metrics': [{'column': 'Quantity', 'agg': 'sum'}]}, csu_name='South')
+    assert result.to_dict('records') == [{'Mine': 'Iron Hills Mine', 'rows': 2, 'sum_Quantity': 8}]
@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+from scripts.ann_index import IVFIndex, encode_ids, normalize
+
+
+@pytest.fixture
+def data():
+    rng = np.random.default_rng(42)
+    # Clustered vectors, as embeddings of similar rows are
+    centers = rng.normal(size=(20, 32))
+    vectors = (centers[rng.integers(0, 20, size=2000)] + 0.3 * rng.normal(size=(2000, 32))).astype(np.float32)
+    ids = [f'd{i}' for i in range(len(vectors))]
+    queries = (centers[rng.integers(0, 20, size=50)] + 0.3 * rng.normal(size=(50, 32))).astype(np.float32)
+    return vectors, ids, queries
+
+
+def exact_search(vectors, ids, query, k, allowed=None):
+    scores = normalize(vectors) @ normalize(query)
+    order = [position for position in np.argsort(-scores) if allowed is None or ids[position] in allowed]
+    return [ids[position] for position in order[:k]]
+
+
+def recall(index, vectors, ids, queries, k=10, nprobe=8, allowed=None):
+    found = 0
+    for query in queries:
+        result, _ = index.search(query, k=k, nprobe=nprobe,
+                                 allowed_ids=sorted(allowed) if allowed is not None else None)
+        found += len(set(result) & set(exact_search(vectors, ids, query, k, allowed)))
+    return found / (k * len(queries))
+
+
+def test_recall_against_exact_search(data):
+    vectors, ids, queries = data
+    index = IVFIndex.build(vectors, ids)
+    assert recall(index, vectors, ids, queries, nprobe=8) >= 0.9
+    # Probing every list is an exact search
+    assert recall(index, vectors, ids, queries, nprobe=index.nlist) == 1.0
+
+
+def test_scores_are_best_first(data):
+    vectors, ids, queries = data
+    index = IVFIndex.build(vectors, ids)
+    _, scores = index.search(queries[0], k=10)
+    assert list(scores) == sorted(scores, reverse=True)
+
+
+def test_selective_filter_still_returns_k_results(data):
+    vectors, ids, queries = data
+    index = IVFIndex.build(vectors, ids)
+    allowed = set(ids[::100])
+    for query in queries[:10]:
+        result, _ = index.search(query, k=10, nprobe=2, allowed_ids=sorted(allowed))
+        assert result == exact_search(vectors, ids, query, 10, allowed)
+
+
+def test_filter_recall(data):
+    vectors, ids, queries = data
+    index = IVFIndex.build(vectors, ids)
+    assert recall(index, vectors, ids, queries, allowed=set(ids[::3])) >= 0.9
+
+
+def test_removed_ids_are_not_returned(data):
+    vectors, ids, queries = data
+    index = IVFIndex.build(vectors, ids)
+    nearest = exact_search(vectors, ids, queries[0], 5)
+    index.remove(nearest)
+
+    result, _ = index.search(queries[0], k=10, nprobe=index.nlist)
+    assert not set(result) & set(nearest)
+    assert len(index) == len(ids) - 5
+    # Nor when a filter makes the search score every allowed vector
+    result, _ = index.search(queries[0], k=10, nprobe=1, allowed_ids=nearest + ids[:20])
+    assert not set(result) & set(nearest)
+
+
+def test_added_vectors_are_searched_before_and_after_compaction(data):
+    vectors, ids, queries = data
+    index = IVFIndex.build(vectors, ids)
+    index.add(queries[:2], ['new0', 'new1'])
+    assert len(index.delta_ids) == 2
+
+    result, scores = index.search(queries[0], k=1)
+    assert result == ['new0']
+    assert scores[0] == pytest.approx(1.0, abs=1e-5)
+    result, _ = index.search(queries[1], k=1, allowed_ids=['new1', 'd0'])
+    assert result == ['new1']
+
+    index.remove(['new0'])
+    index.compact()
+    assert len(index.delta_ids) == 0
+    assert len(index) == len(ids) + 1
+    assert index.search(queries[0], k=10, nprobe=index.nlist)[0][0] != 'new0'
+    assert index.search(queries[1], k=1)[0] == ['new1']
+
+
+def test_save_and_load(tmp_path, data):
+    vectors, ids, queries = data
+    index = IVFIndex.build(vectors, ids)
+    index.add(queries[:1], ['a-much-longer-document-id'])
+    index.remove(['d0'])
+    index.save(str(tmp_path))
+
+    loaded = IVFIndex.load(str(tmp_path))
+    assert len(loaded) == len(index)
+    for query in queries[:5]:
+        assert loaded.search(query, k=10)[0] == index.search(query, k=10)[0]
+
+
+def test_encode_ids_keeps_long_ids():
+    encoded = encode_ids(['a', 'x' * 80])
+    assert encoded[1].decode('utf-8') == 'x' * 80
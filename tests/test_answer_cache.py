@@ -0,0 +1,117 @@
+import os
+import numpy as np
+import pytest
+from scripts.answer_cache import SemanticAnswerCache, key_terms, manifest_generation
+from scripts.chunk_manifest import MANIFEST_FILE_NAME
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr('scripts.answer_cache.time.monotonic', clock)
+    return clock
+
+
+def vector(*values):
+    return np.array(values, dtype=np.float32)
+
+
+def test_similar_question_hits_within_its_scope(clock):
+    cache = SemanticAnswerCache(threshold=0.97)
+    cache.store(vector(1, 0, 0), 'East answer', scope='East')
+    assert cache.lookup(vector(1, 0.05, 0), scope='East') == 'East answer'
+    assert cache.lookup(vector(1, 0.05, 0), scope='West') is None
+    assert cache.lookup(vector(0, 1, 0), scope='East') is None
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 2
+
+
+def test_most_similar_entry_wins(clock):
+    cache = SemanticAnswerCache(threshold=0.9)
+    cache.store(vector(1, 0.2, 0), 'close', scope='East')
+    cache.store(vector(1, 0.01, 0), 'closest', scope='East')
+    assert cache.lookup(vector(1, 0, 0), scope='East') == 'closest'
+
+
+def test_key_terms_must_match(clock):
+    cache = SemanticAnswerCache(threshold=0.97)
+    cache.store(vector(1, 0, 0), 'winter answer', scope='East',
+                question='What was the average price in Winter for Iron Hills Mine?')
+    assert cache.lookup(vector(1, 0, 0), scope='East',
+                        question='What was the average price in Summer for Iron Hills Mine?') is None
+    assert cache.lookup(vector(1, 0, 0), scope='East',
+                        question='what was the average price in winter for Iron Hills Mine') == 'winter answer'
+
+
+def test_key_terms():
+    assert key_terms('Show the top 5 orders of Erebor Mine in Q3 2024.') == {'5', '2024', 'erebor', 'mine', 'q3'}
+    # The first word of a sentence is capitalized anyway
+    assert key_terms('Which customers buy the most? Show them.') == frozenset()
+
+
+def test_entries_expire(clock):
+    cache = SemanticAnswerCache(ttl_seconds=60)
+    cache.store(vector(1, 0), 'answer', scope='East')
+    clock.now += 59
+    assert cache.lookup(vector(1, 0), scope='East') == 'answer'
+    clock.now += 2
+    assert cache.lookup(vector(1, 0), scope='East') is None
+    assert cache.stats()['entries'] == 0
+
+
+def test_least_recently_used_entries_are_evicted(clock):
+    cache = SemanticAnswerCache(max_entries=2)
+    cache.store(vector(1, 0, 0), 'first', scope='East')
+    clock.now += 1
+    cache.store(vector(0, 1, 0), 'second', scope='West')
+    clock.now += 1
+    # Using the first entry makes the second the least recently used
+    assert cache.lookup(vector(1, 0, 0), scope='East') == 'first'
+    clock.now += 1
+    cache.store(vector(0, 0, 1), 'third', scope='East')
+
+    assert cache.lookup(vector(0, 1, 0), scope='West') is None
+    assert cache.lookup(vector(1, 0, 0), scope='East') == 'first'
+    assert cache.stats()['evictions'] == 1 and cache.stats()['entries'] == 2
+
+
+def test_invalidate_drops_every_scope(clock):
+    cache = SemanticAnswerCache()
+    cache.store(vector(1, 0), 'answer', scope='East')
+    cache.store(vector(1, 0), 'answer', scope='West')
+    cache.invalidate()
+    assert cache.lookup(vector(1, 0), scope='East') is None
+    assert cache.stats()['entries'] == 0 and cache.stats()['invalidations'] == 1
+
+
+def test_new_generation_invalidates(clock):
+    generation = [1]
+    cache = SemanticAnswerCache(generation=lambda: generation[0])
+    cache.store(vector(1, 0), 'answer', scope='East')
+    assert cache.lookup(vector(1, 0), scope='East') == 'answer'
+
+    generation[0] = 2
+    assert cache.lookup(vector(1, 0), scope='East') is None
+    assert cache.stats()['invalidations'] == 1
+
+
+def test_manifest_generation_follows_the_manifests(tmp_path):
+    directory = tmp_path / 'crm_store'
+    assert manifest_generation([str(directory)]) == (None,)
+    directory.mkdir()
+    manifest = directory / MANIFEST_FILE_NAME
+    manifest.write_text('{}', encoding='utf-8')
+    first = manifest_generation([str(directory)])
+    assert first != (None,)
+
+    stat = manifest.stat()
+    manifest.write_text('{"documents": {}}', encoding='utf-8')
+    os.utime(manifest, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    assert manifest_generation([str(directory)]) != first
@@ -0,0 +1,70 @@
+from scripts.chunk_manifest import apply_delta, load_manifest, make_document_id, save_manifest
+
+
+def empty_manifest():
+    return {'documents': {}, 'pending_upserts': [], 'pending_deletes': []}
+
+
+def test_document_id_follows_the_content():
+    row = {'OrderID': 'ORD 1/2', 'Quantity': '10'}
+    assert make_document_id(row, 'OrderID') == make_document_id(dict(reversed(list(row.items()))), 'OrderID')
+    assert make_document_id(row, 'OrderID').startswith('ORD_1_2-')
+    assert make_document_id(row, 'OrderID') != make_document_id({**row, 'Quantity': '11'}, 'OrderID')
+
+
+def test_first_run_queues_every_document():
+    manifest = empty_manifest()
+    added, removed = apply_delta(manifest, {'b': 'b.json', 'a': 'a.json'})
+    assert added == ['a', 'b']
+    assert removed == []
+    assert manifest['pending_upserts'] == ['a', 'b']
+    assert manifest['documents'] == {'a': 'a.json', 'b': 'b.json'}
+
+
+def test_changed_and_deleted_rows_are_detected():
+    manifest = {'documents': {'a': 'a.json', 'b': 'b.json', 'c': 'c.json'}, 'pending_upserts': [],
+                'pending_deletes': []}
+    # Row b changed (new id b2), row c was deleted
+    added, removed = apply_delta(manifest, {'a': 'a.json', 'b2': 'b2.json'})
+    assert added == ['b2']
+    assert removed == ['b', 'c']
+    assert manifest['pending_upserts'] == ['b2']
+    assert manifest['pending_deletes'] == ['b', 'c']
+
+
+def test_unchanged_run_queues_nothing():
+    manifest = {'documents': {'a': 'a.json'}, 'pending_upserts': [], 'pending_deletes': []}
+    assert apply_delta(manifest, {'a': 'a.json'}) == ([], [])
+    assert manifest['pending_upserts'] == [] and manifest['pending_deletes'] == []
+
+
+def test_document_removed_before_upload_is_not_deleted():
+    manifest = empty_manifest()
+    apply_delta(manifest, {'a': 'a.json'})
+    added, removed = apply_delta(manifest, {})
+    assert removed == ['a']
+    assert manifest['pending_upserts'] == []
+    assert manifest['pending_deletes'] == []
+
+
+def test_document_back_before_its_delete_is_upserted():
+    manifest = {'documents': {'a': 'a.json'}, 'pending_upserts': [], 'pending_deletes': []}
+    apply_delta(manifest, {})
+    assert manifest['pending_deletes'] == ['a']
+    apply_delta(manifest, {'a': 'a.json'})
+    assert manifest['pending_upserts'] == ['a']
+    assert manifest['pending_deletes'] == []
+
+
+def test_save_and_load(tmp_path):
+    manifest = empty_manifest()
+    apply_delta(manifest, {'a': 'a.json'})
+    save_manifest(str(tmp_path), manifest)
+    assert load_manifest(str(tmp_path)) == manifest
+
+
+def test_directory_without_manifest_is_read_from_its_chunks(tmp_path):
+    (tmp_path / 'a.json').write_text('{"id": "a-123"}', encoding='utf-8')
+    manifest = load_manifest(str(tmp_path))
+    assert manifest['documents'] == {'a-123': 'a.json'}
+    assert manifest['pending_upserts'] == [] and manifest['pending_deletes'] == []
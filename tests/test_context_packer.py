@@ -0,0 +1,86 @@
+import pytest
+from scripts.context_packer import pack_context
+from scripts.search_fanout import search_results
+
+
+def count_words(text):
+    return len(text.split())
+
+
+@pytest.fixture(autouse=True)
+def word_tokens(monkeypatch):
+    # One token per word, so the budgets are easy to follow
+    monkeypatch.setattr('scripts.context_packer.num_tokens_from_string', count_words)
+    monkeypatch.setattr('scripts.search_fanout.num_tokens_from_string', count_words)
+
+
+def doc(text, score):
+    return {'description': text, '@search.score': score}
+
+
+def test_lists_are_merged_best_first():
+    customers = [doc('customer one', 0.9), doc('customer two', 0.5)]
+    orders = [doc('order one', 0.8), doc('order two', 0.7)]
+    packed, tokens = pack_context([customers, orders], max_tokens=100)
+    assert [d['description'] for d in packed] == ['customer one', 'order one', 'order two', 'customer two']
+    # Each document costs its tokens plus one for its line
+    assert tokens == 4 * 3
+
+
+def test_budget_is_not_exceeded():
+    results = [doc('a b c d', 0.9), doc('e f g', 0.8), doc('h i', 0.7)]
+    packed, tokens = pack_context([results], max_tokens=9)
+    assert [d['description'] for d in packed] == ['a b c d', 'e f g']
+    assert tokens == 9
+
+    packed, tokens = pack_context([results], max_tokens=8)
+    assert [d['description'] for d in packed] == ['a b c d']
+    assert tokens == 5
+
+
+def test_packing_stops_at_the_first_document_that_does_not_fit():
+    # A shorter, lower scoring document is not packed in place of a better one
+    results = [doc('a b', 0.9), doc('c d e f g h', 0.8), doc('i', 0.7)]
+    packed, tokens = pack_context([results], max_tokens=6)
+    assert [d['description'] for d in packed] == ['a b']
+    assert tokens == 3
+
+
+def test_duplicates_and_empty_texts_cost_nothing():
+    results = [doc('Same  text', 0.9), doc('same text ', 0.8), doc('', 0.7), {'@search.score': 0.6},
+               doc('other', 0.5)]
+    packed, tokens = pack_context([results], max_tokens=5)
+    assert [d['description'] for d in packed] == ['Same  text', 'other']
+    assert tokens == 5
+
+
+def test_default_budget_comes_from_the_environment(monkeypatch):
+    monkeypatch.setenv('CONTEXT_MAX_TOKENS', '4')
+    packed, tokens = pack_context([[doc('a b', 0.9), doc('c d', 0.8)]])
+    assert len(packed) == 1 and tokens == 3
+
+
+class CountingSearchClient:
+    def __init__(self, docs):
+        self.docs = docs
+        self.read = 0
+
+    def search(self, **kwargs):
+        for document in self.docs:
+            self.read += 1
+            yield document
+
+
+def test_search_is_read_only_up_to_the_budget():
+    client = CountingSearchClient([doc(f'word{i} word', 1.0 - i / 100) for i in range(50)])
+    results = search_results(client, {'top': 50}, max_tokens=10)
+    # The fourth document takes the read results past the budget, the ones after it are not read
+    assert client.read == 4
+    packed, tokens = pack_context([results], max_tokens=10)
+    assert len(packed) == 3 and tokens == 9
+
+
+def test_search_is_read_up_to_top_without_a_budget():
+    client = CountingSearchClient([doc('text', 1.0)] * 20)
+    assert len(search_results(client, {'top': 5})) == 5
+    assert client.read == 5
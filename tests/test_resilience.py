@@ -0,0 +1,131 @@
+import httpx
+import openai
+import pytest
+from scripts.resilience import CircuitBreaker, CircuitOpenError, ResilientCaller, RetryPolicy
+
+
+def status_error(status_code):
+    request = httpx.Request('POST', 'https://example.openai.azure.com/openai/deployments/gpt-4o/chat/completions')
+    return openai.APIStatusError('error', response=httpx.Response(status_code, request=request), body=None)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr('scripts.resilience.time.monotonic', clock)
+    monkeypatch.setattr('scripts.resilience.time.sleep', lambda seconds: None)
+    return clock
+
+
+def failing(error, calls):
+    def function():
+        calls.append(True)
+        raise error
+    return function
+
+
+def make_caller(max_attempts=3, failure_threshold=2, reset_seconds=30.0):
+    return ResilientCaller('test', policy=RetryPolicy(max_attempts=max_attempts, base_delay=0.0),
+                           breaker=CircuitBreaker(failure_threshold=failure_threshold, reset_seconds=reset_seconds))
+
+
+def test_breaker_opens_after_threshold_of_failed_calls(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_seconds=30.0)
+    for _ in range(2):
+        breaker.allow()
+        breaker.record_failure()
+    assert breaker.state == 'closed'
+
+    breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert breaker.times_opened == 1
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+
+
+def test_success_resets_the_failure_count(clock):
+    breaker = CircuitBreaker(failure_threshold=2)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == 'closed'
+
+
+def test_half_open_lets_one_trial_through(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=30.0)
+    breaker.record_failure()
+    clock.now += 30.0
+    assert breaker.state == 'half_open'
+
+    assert breaker.allow() is True
+    # A second call while the trial is in flight fails at once
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+
+
+def test_trial_success_closes_and_failure_reopens(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=30.0)
+    breaker.record_failure()
+    clock.now += 30.0
+    breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert breaker.times_opened == 2
+
+    clock.now += 30.0
+    breaker.allow()
+    breaker.record_success()
+    assert breaker.state == 'closed'
+    assert breaker.allow() is False
+
+
+def test_retries_of_one_call_count_as_one_failure(clock):
+    caller = make_caller(max_attempts=3, failure_threshold=2)
+    calls = []
+    with pytest.raises(openai.APIStatusError):
+        caller.call(failing(status_error(503), calls))
+    assert len(calls) == 3
+    assert caller.breaker.failures == 1
+    assert caller.breaker.state == 'closed'
+
+    with pytest.raises(openai.APIStatusError):
+        caller.call(failing(status_error(503), calls))
+    assert caller.breaker.state == 'open'
+    with pytest.raises(CircuitOpenError):
+        caller.call(failing(status_error(503), calls))
+    assert len(calls) == 6
+
+
+def test_non_retryable_error_leaves_the_breaker_alone(clock):
+    caller = make_caller(failure_threshold=1)
+    caller.breaker.record_failure()
+    clock.now += 30.0
+    calls = []
+
+    with pytest.raises(openai.APIStatusError):
+        caller.call(failing(status_error(400), calls))
+    assert len(calls) == 1
+    # The bad request neither closed the circuit nor kept the trial slot
+    assert caller.breaker.state == 'half_open'
+    assert caller.breaker.failures == 1
+
+    assert caller.call(lambda: 'ok') == 'ok'
+    assert caller.breaker.state == 'closed'
+
+
+def test_retry_if_false_stops_retrying(clock):
+    caller = make_caller(max_attempts=4)
+    calls = []
+    with pytest.raises(openai.APIStatusError):
+        caller.call(failing(status_error(503), calls), retry_if=lambda error: False)
+    assert len(calls) == 1
+    assert caller.breaker.failures == 1